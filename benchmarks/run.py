@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Offline benchmarks for the Shelfari plugin, run against the local stand-in
+server so results are repeatable and need no network access.
+
+Run with calibre-debug so the calibre modules are available:
+
+    calibre-debug -e benchmarks/run.py -- --books 200 --concurrency 8
+"""
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import os, sys, imp, copy, time, json, tempfile, argparse, resource, threading, subprocess
+from Queue import Queue, Empty
+from threading import Event
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.abspath(__file__)
+PLUGIN_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src', 'shelfari')
+sys.path.insert(0, BENCH_DIR)
+
+from server import StandInServer, isbn_for_book
+
+
+def load_plugin(prefs=()):
+    '''
+    Import the plugin from this working tree rather than any copy installed
+    in calibre, keeping its caches in a throwaway directory and running with
+    the default preferences plus prefs, a list of (key, value) pairs. The
+    user's own calibre preferences are never read or written.
+    '''
+    parent = sys.modules.setdefault(str('calibre_plugins'), imp.new_module(str('calibre_plugins')))
+    # 'import calibre_plugins.shelfari.x as y' looks the package up as an
+    # attribute of its parent, and the package runs such imports while it is
+    # still loading, so it has to be attached before load_module fills it in
+    plugin = sys.modules.get(str('calibre_plugins.shelfari'))
+    if plugin is None:
+        plugin = imp.new_module(str('calibre_plugins.shelfari'))
+        sys.modules[str('calibre_plugins.shelfari')] = plugin
+    parent.shelfari = plugin
+    plugin = imp.load_module(str('calibre_plugins.shelfari'), None, PLUGIN_DIR,
+            (str(''), str(''), imp.PKG_DIRECTORY))
+    plugin.config_dir = tempfile.mkdtemp(prefix='shelfari-bench-')
+    cfg = plugin.cfg
+    options = copy.deepcopy(cfg.DEFAULT_STORE_VALUES)
+    options.update(prefs)
+    cfg.plugin_prefs = {cfg.STORE_NAME: options}
+    cfg.invalidate_prefs()
+    return plugin
+
+
+def measure_import(path):
+    '''
+    Run in a fresh interpreter: time loading the plugin as calibre does when
+    it starts, then, for the 'config' path, the extra import done by the
+    first call to config_widget(). Prints the result as json.
+    '''
+    if path == 'config':
+        load_plugin()
+    before = set(sys.modules)
+    start = time.time()
+    if path == 'config':
+        import calibre_plugins.shelfari.config
+    else:
+        load_plugin()
+    elapsed = time.time() - start
+    added = set(sys.modules) - before
+    print(json.dumps({'seconds': elapsed, 'modules': len(added),
+        'qt': any(name.startswith('PyQt') for name in added)}))
+
+
+def bench_import(runs):
+    '''
+    Time the plugin's import on both paths, each run in a new calibre-debug
+    process so nothing is already loaded. CALIBRE_DEBUG overrides the
+    command used.
+    '''
+    command = [os.environ.get('CALIBRE_DEBUG', 'calibre-debug'), '-e', SCRIPT, '--']
+    stages, details = [], {}
+    for path in ('source', 'config'):
+        stage = Stage('import_' + path)
+        with stage:
+            for i in range(runs):
+                out = subprocess.check_output(command + ['--measure-import', path])
+                result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+                stage.record(result['seconds'])
+        details[stage.name] = result
+        stages.append(stage)
+    return stages, details
+
+
+def parse_pref(text):
+    key, sep, value = text.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, value
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def peak_memory_mb():
+    # ru_maxrss is kilobytes on linux and bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+class Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.started_at = self.finished_at = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.finished_at = time.time()
+
+    def record(self, elapsed, ok=True):
+        with self._lock:
+            self.latencies.append(elapsed)
+            if not ok:
+                self.errors += 1
+
+    def stats(self):
+        wall = (self.finished_at or time.time()) - (self.started_at or time.time())
+        return {
+            'count': len(self.latencies),
+            'errors': self.errors,
+            'wall_s': wall,
+            'throughput_per_s': len(self.latencies) / wall if wall else 0.0,
+            'p50_ms': percentile(self.latencies, 50) * 1000,
+            'p90_ms': percentile(self.latencies, 90) * 1000,
+            'p99_ms': percentile(self.latencies, 99) * 1000,
+            'max_ms': max(self.latencies or [0]) * 1000,
+        }
+
+    def report(self):
+        s = self.stats()
+        return ('%-16s %6d ops %4d err %8.1f/s   p50 %8.1fms  p90 %8.1fms  '
+                'p99 %8.1fms  max %8.1fms' % (self.name, s['count'], s['errors'],
+                s['throughput_per_s'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['max_ms']))
+
+
+def run_concurrently(items, concurrency, fn):
+    work = Queue()
+    for item in items:
+        work.put(item)
+
+    def loop():
+        while True:
+            try:
+                item = work.get_nowait()
+            except Empty:
+                return
+            fn(item)
+
+    threads = [threading.Thread(target=loop) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def book_query(n, isbn_fraction):
+    identifiers = {}
+    if n % 100 < isbn_fraction * 100:
+        identifiers['isbn'] = isbn_for_book(n)
+    return ('Benchmark Book %d' % n, ['Author %d' % n], identifiers)
+
+
+class TimedQueue(Queue):
+
+    # Remembers when the last result arrived, to measure how long identify
+    # takes to return once its workers are done
+
+    def __init__(self):
+        Queue.__init__(self)
+        self.last_put = None
+
+    def put(self, item, *args, **kwargs):
+        self.last_put = time.time()
+        Queue.put(self, item, *args, **kwargs)
+
+
+def bench_identify(plugin, log, books, concurrency, isbn_fraction):
+    stage = Stage('identify')
+    tail = Stage('identify_return')
+    found = {}
+
+    def one(n):
+        title, authors, identifiers = book_query(n, isbn_fraction)
+        rq = TimedQueue()
+        start = time.time()
+        try:
+            plugin.identify(log, rq, Event(), title=title, authors=authors,
+                    identifiers=identifiers)
+        except Exception:
+            log.exception('identify failed for book %d' % n)
+        returned = time.time()
+        if rq.last_put is not None:
+            tail.record(returned - rq.last_put)
+        results = []
+        while True:
+            try:
+                results.append(rq.get_nowait())
+            except Empty:
+                break
+        stage.record(returned - start, bool(results))
+        if results:
+            found[n] = results[0].identifiers
+
+    with stage, tail:
+        run_concurrently(books, concurrency, one)
+    return stage, tail, found
+
+
+def bench_identify_abort(plugin, log, books, concurrency, isbn_fraction, abort_after):
+    # How quickly identify gives up once calibre sets abort part way through
+    stage = Stage('identify_abort')
+
+    def one(n):
+        title, authors, identifiers = book_query(n, isbn_fraction)
+        abort, aborted_at = Event(), []
+
+        def fire():
+            aborted_at.append(time.time())
+            abort.set()
+
+        timer = threading.Timer(abort_after, fire)
+        timer.start()
+        try:
+            plugin.identify(log, Queue(), abort, title=title, authors=authors,
+                    identifiers=identifiers)
+        except Exception:
+            log.exception('identify failed for book %d' % n)
+        returned = time.time()
+        timer.cancel()
+        if aborted_at:
+            stage.record(returned - aborted_at[0])
+
+    with stage:
+        run_concurrently(books, concurrency, one)
+    return stage
+
+
+def bench_identify_many(plugin, log, books, isbn_fraction):
+    stage = Stage('identify_many')
+    with stage:
+        start = time.time()
+        for i, results in plugin.identify_many(log,
+                [book_query(n, isbn_fraction) for n in books], Event()):
+            # Time to each result from the start of the batch
+            stage.record(time.time() - start, bool(results))
+    return stage
+
+
+def bench_download_cover(plugin, log, found, concurrency):
+    stage = Stage('download_cover')
+
+    def one(identifiers):
+        rq = Queue()
+        start = time.time()
+        try:
+            plugin.download_cover(log, rq, Event(), identifiers=identifiers)
+        except Exception:
+            log.exception('download_cover failed for %r' % identifiers)
+        stage.record(time.time() - start, not rq.empty())
+
+    with stage:
+        run_concurrently(list(found.values()), concurrency, one)
+    return stage
+
+
+def bench_ingest(plugin_module, server, books):
+    '''
+    Turn the search and book pages into trees the way the plugin used to
+    (strip, decode, clean_ascii_chars, then parse the unicode) and with
+    parse_page_bytes, timing the whole of each. Also totals the size of the
+    full page copies each way makes before lxml sees the page, the memory
+    churned per page; this is worked out outside the timings.
+    '''
+    from lxml.html import fromstring
+    from calibre.utils.cleantext import clean_ascii_chars
+    parse_page_bytes = plugin_module.worker.parse_page_bytes
+    CONTROL_BYTES = plugin_module.worker.CONTROL_BYTES
+
+    def unicode_copies(raw):
+        copies = [raw.strip()]
+        copies.append(copies[-1].decode('utf-8', errors='replace'))
+        copies.append(clean_ascii_chars(copies[-1]))
+        return copies
+
+    def via_unicode(raw):
+        fromstring(unicode_copies(raw)[-1])
+
+    def bytes_copies(raw):
+        copies = [raw.translate(None, CONTROL_BYTES)]
+        try:
+            copies[0].decode('utf-8')
+        except UnicodeDecodeError:
+            # Only pages lxml finds invalid UTF-8 in are decoded and parsed again
+            copies.append(copies[0].decode('utf-8', errors='replace'))
+            copies.append(copies[-1].encode('utf-8'))
+        return copies
+
+    pages = [server.search_page(n) for n in books] + [server.book_page(n) for n in books]
+    stages, churn = [], {}
+    for name, fn, copies in (('ingest_unicode', via_unicode, unicode_copies),
+            ('ingest_bytes', parse_page_bytes, bytes_copies)):
+        stage = Stage(name)
+        with stage:
+            for raw in pages:
+                start = time.time()
+                fn(raw)
+                stage.record(time.time() - start)
+        copied = sum(sys.getsizeof(c) for raw in pages for c in copies(raw))
+        churn[name] = copied / len(pages) / 1024
+        stages.append(stage)
+    return stages, churn
+
+
+def bench_search_results(plugin_module, server, books):
+    '''
+    Read the rows of the search pages by building the whole tree and
+    querying it, as the plugin used to, and with the streaming
+    SearchResultsParser it uses now
+    '''
+    parse_page_bytes = plugin_module.worker.parse_page_bytes
+    SearchResultsParser = plugin_module.search.SearchResultsParser
+
+    def via_tree(raw):
+        rows = []
+        for li in parse_page_bytes(raw).xpath('//ol[@class="book_results"]/li'):
+            rows.append((li.get('id'), li.xpath('./div[@class="text"]/h3/a')[0].text_content(),
+                li.xpath('./div[@class="text"]/a')[0].text_content(),
+                li.xpath('./div[@class="text"]/h3/a/@href')[0]))
+        return rows
+
+    def via_stream(raw):
+        parser = SearchResultsParser()
+        for i in range(0, len(raw), plugin_module.STREAM_CHUNK_SIZE):
+            if parser.feed(raw[i:i + plugin_module.STREAM_CHUNK_SIZE]):
+                break
+        return parser.close()
+
+    pages = [server.search_page(n) for n in books]
+    stages = []
+    for name, fn in (('search_tree', via_tree), ('search_stream', via_stream)):
+        stage = Stage(name)
+        with stage:
+            for raw in pages:
+                start = time.time()
+                rows = fn(raw)
+                stage.record(time.time() - start, len(rows) > 0)
+        stages.append(stage)
+    return stages
+
+
+def bench_parse_details(plugin_module, plugin, log, server, books):
+    Worker = plugin_module.worker.Worker
+    parse_page_bytes = plugin_module.worker.parse_page_bytes
+
+    pages = [('%s/books/%d' % (server.base_url, n), server.book_page(n)) for n in books]
+    stage = Stage('parse_details')
+    fields = {}
+    with stage:
+        for url, raw in pages:
+            start = time.time()
+            rq = Queue()
+            root = parse_page_bytes(raw)
+            w = Worker(url, rq, log, 0, plugin)
+            w.parse_details(root)
+            stage.record(time.time() - start, not rq.empty())
+            for name, elapsed in w.timings.items():
+                fields.setdefault(name, Stage(name)).record(elapsed)
+    return stage, sorted(fields.values(), key=lambda f: -sum(f.latencies))
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark the Shelfari metadata plugin '
+            'against a local stand-in server')
+    parser.add_argument('--books', type=int, default=100, help='Number of distinct books to look up')
+    parser.add_argument('--concurrency', type=int, default=4,
+            help='Number of simultaneous identify/download_cover calls, like calibre\'s bulk download')
+    parser.add_argument('--isbn-fraction', type=float, default=0.3,
+            help='Fraction of the books that are looked up by ISBN')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Random extra seconds per response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+            help='Fraction of requests answered with a 503')
+    parser.add_argument('--passes', type=int, default=1,
+            help='Repeat the lookups this many times, later passes exercise the caches')
+    parser.add_argument('--batch', action='store_true', help='Also benchmark identify_many')
+    parser.add_argument('--abort-after', type=float, default=0.0,
+            help='Also benchmark how quickly identify returns when aborted this many seconds in')
+    parser.add_argument('--json', help='Write the results to this file as json')
+    parser.add_argument('--pref', action='append', default=[], type=parse_pref,
+            help='Override a plugin preference for this run, e.g. --pref useFetchEngine=true')
+    parser.add_argument('--imports', type=int, default=0,
+            help='Also time importing the plugin, and its settings screen, in this many new processes')
+    parser.add_argument('--measure-import', choices=('source', 'config'), help=argparse.SUPPRESS)
+    parser.add_argument('--verbose', action='store_true', help='Show the plugin log')
+    opts = parser.parse_args(args)
+    if opts.measure_import:
+        measure_import(opts.measure_import)
+        return
+
+    results = {'options': vars(opts), 'passes': []}
+    if opts.imports:
+        print('Plugin import')
+        stages, details = bench_import(opts.imports)
+        for stage in stages:
+            d = details[stage.name]
+            print('  %s  %d modules%s' % (stage.report(), d['modules'],
+                ', loads Qt' if d['qt'] else ''))
+        results['imports'] = dict((stage.name, dict(stage.stats(), **details[stage.name]))
+                for stage in stages)
+
+    from calibre.utils.logging import ThreadSafeLog
+    log = ThreadSafeLog(level=ThreadSafeLog.DEBUG if opts.verbose else ThreadSafeLog.ERROR)
+
+    plugin_module = load_plugin(opts.pref)
+    server = StandInServer(latency=opts.latency, jitter=opts.jitter,
+            error_rate=opts.error_rate).start()
+    plugin_module.Shelfari.BASE_URL = server.base_url
+    plugin = plugin_module.Shelfari(None)
+
+    books = range(1, opts.books + 1)
+    for p in range(opts.passes):
+        print('Pass %d' % (p + 1))
+        requests_before = server.requests
+        stages = []
+        stage, tail, found = bench_identify(plugin, log, books, opts.concurrency,
+                opts.isbn_fraction)
+        stages.extend((stage, tail))
+        if opts.abort_after:
+            stages.append(bench_identify_abort(plugin, log,
+                [n + opts.books * (opts.passes + p + 1) for n in books],
+                opts.concurrency, opts.isbn_fraction, opts.abort_after))
+        if opts.batch:
+            stages.append(bench_identify_many(plugin, log,
+                [n + opts.books * (p + 1) for n in books], opts.isbn_fraction))
+        stages.append(bench_download_cover(plugin, log, found, opts.concurrency))
+        parse_stage, field_stages = bench_parse_details(plugin_module, plugin, log,
+                server, books)
+        stages.append(parse_stage)
+        ingest_stages, churn = bench_ingest(plugin_module, server, books)
+        stages.extend(ingest_stages)
+        stages.extend(bench_search_results(plugin_module, server, books))
+        for stage in stages:
+            print('  ' + stage.report())
+        for name, kb in sorted(churn.items()):
+            print('  %-16s %8.1f KB of page copies per page' % (name, kb))
+        for field in field_stages:
+            s = field.stats()
+            print('    %-28s p50 %7.3fms  p99 %7.3fms  total %8.1fms' % (field.name,
+                s['p50_ms'], s['p99_ms'], sum(field.latencies) * 1000))
+        requests = server.requests - requests_before
+        print('  %d requests to the stand-in server' % requests)
+        results['passes'].append(dict([(stage.name, stage.stats()) for stage in stages],
+            requests=requests, fields=dict((f.name, f.stats()) for f in field_stages),
+            churn_kb=churn))
+    print('Stages recorded by the plugin, all passes:')
+    for line in plugin.metrics.aggregate.summary_text().splitlines():
+        print('  ' + line)
+    results['peak_memory_mb'] = peak_memory_mb()
+    print('Peak memory: %.1f MB' % results['peak_memory_mb'])
+
+    if opts.json:
+        with open(opts.json, 'wb') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A local stand-in for www.shelfari.com serving the fixture pages, used by the
+benchmarks so they can run without network access.
+"""
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import os, re, time, random, threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlsplit, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Book ids are edition * EDITION_STRIDE + book number, so every edition of
+# benchmark book n has its own page
+EDITION_STRIDE = 1000000
+EDITIONS_PER_SEARCH = 3
+
+# What the editions page of every book lists, as (title, format) with %d for
+# the book number. The plugin should skip the audio and foreign editions.
+EDITIONS = (
+    ('Benchmark Book %d', 'Paperback'),
+    ('Benchmark Book %d', 'Hardcover'),
+    ('Benchmark Book %d (Audio CD)', 'Audio CD'),
+    ('Libro de Referencia', 'Tapa blanda'),
+    ('Benchmark Book %d', 'Kindle Edition'),
+)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+def isbn_for_book(n):
+    '''
+    A valid ISBN-13 that the stand-in server maps back to book n
+    '''
+    digits = '978%09d' % n
+    total = sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(digits))
+    return digits + str((10 - total % 10) % 10)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        server = self.server
+        server.count_request()
+        if server.latency:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        if server.error_rate and random.random() < server.error_rate:
+            return self.send_body(503, b'Service unavailable', 'text/plain', head)
+
+        parts = urlsplit(self.path)
+        match = re.match(r'/books/(\d+)/[^/]+/editions$', parts.path)
+        if match:
+            return self.send_body(200, server.editions_page(int(match.group(1))),
+                    'text/html; charset=utf-8', head)
+        match = re.match(r'/books/(\d+)', parts.path)
+        if match:
+            return self.send_body(200, server.book_page(int(match.group(1))),
+                    'text/html; charset=utf-8', head)
+        match = re.match(r'/covers/(\d+)(\._[A-Z0-9_,]+_)?\.jpg', parts.path)
+        if match:
+            # Book pages link to the thumbnail, without the size modifier
+            # the full size cover is served
+            cover = server.thumbnail if match.group(2) else server.cover
+            return self.send_body(200, cover, 'image/jpeg', head)
+        if parts.path == '/search/books':
+            query = parse_qs(parts.query)
+            if 'Isbn' in query:
+                n = int(query['Isbn'][0][3:12])
+                self.send_response(302)
+                self.send_header('Location', '%s/books/%d' % (server.base_url, n))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            numbers = re.findall(r'\d+', query.get('Title', [''])[0])
+            n = int(numbers[0]) if numbers else 1
+            return self.send_body(200, server.search_page(n),
+                    'text/html; charset=utf-8', head)
+        self.send_body(404, b'<html><head><title>404 - Not found</title></head></html>',
+                'text/html', head)
+
+    def send_body(self, code, body, content_type, head=False):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+    '''
+    Serves templated copies of the fixture pages for any book number.
+
+    latency seconds (plus up to jitter seconds) are added to every response,
+    and error_rate is the fraction of requests answered with a 503.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandInHandler)
+        self.latency, self.jitter, self.error_rate = latency, jitter, error_rate
+        self.base_url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.book_template = load_fixture('book.html')
+        self.search_template = load_fixture('search.html')
+        self.result_template = load_fixture('search_result.html')
+        self.editions_template = load_fixture('editions.html')
+        self.edition_template = load_fixture('edition.html')
+        self.cover = bytes(bytearray(random.getrandbits(8) for i in range(20 * 1024)))
+        self.thumbnail = self.cover[:4 * 1024]
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def fill(self, template, shelfari_id):
+        n = shelfari_id % EDITION_STRIDE
+        for placeholder, value in (('@@BASE@@', self.base_url), ('@@ID@@', shelfari_id),
+                ('@@N@@', n), ('@@ISBN@@', isbn_for_book(n)), ('@@PAGES@@', 100 + n % 900),
+                ('@@SERIES_INDEX@@', 1 + n % 12), ('@@EDITION_COUNT@@', len(EDITIONS))):
+            template = template.replace(placeholder, '%s' % value)
+        return template
+
+    def book_page(self, shelfari_id):
+        return self.fill(self.book_template, shelfari_id).encode('utf-8')
+
+    def search_page(self, n):
+        results = []
+        for edition in range(EDITIONS_PER_SEARCH):
+            result = self.fill(self.result_template, edition * EDITION_STRIDE + n)
+            results.append(result.replace('@@EDITION@@', ' (Edition %d)' % edition if edition else ''))
+        return self.search_template.replace('@@RESULTS@@', ''.join(results)).encode('utf-8')
+
+    def editions_page(self, shelfari_id):
+        n = shelfari_id % EDITION_STRIDE
+        editions = []
+        for edition, (title, format) in enumerate(EDITIONS):
+            row = self.fill(self.edition_template, edition * EDITION_STRIDE + n)
+            row = row.replace('@@TITLE@@', title.replace('%d', '%d' % n))
+            editions.append(row.replace('@@FORMAT@@', format))
+        page = self.fill(self.editions_template, shelfari_id)
+        return page.replace('@@EDITIONS@@', ''.join(editions)).encode('utf-8')
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name='Shelfari stand-in server')
+        t.daemon = True
+        t.start()
+        return self
+
+
+if __name__ == '__main__':
+    import sys
+    server = StandInServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8800)
+    print('Serving Shelfari fixtures on', server.base_url)
+    server.serve_forever()
@@ -32,20 +32,31 @@ from __future__ import (unicode_literals, division, absolute_import,
 import sys, os
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
 
-import time
+import atexit
+from collections import OrderedDict
+from functools import partial
 from urllib import quote
+from urlparse import urljoin
 from Queue import Queue, Empty
+from threading import Lock
 
-from lxml.html import fromstring, tostring
-
-from calibre import as_unicode
+from calibre import as_unicode, get_proxies
 from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.sources.base import Source
-from calibre.utils.icu import lower
-from calibre.utils.cleantext import clean_ascii_chars
+from calibre.utils.config import config_dir
 
-import calibre_plugins.shelfari.config as cfg
-from calibre_plugins.shelfari.worker import Worker
+import calibre_plugins.shelfari.prefs as cfg
+from calibre_plugins.shelfari.worker import Worker, parse_page_bytes
+from calibre_plugins.shelfari.search import SearchResultsParser, parse_editions
+from calibre_plugins.shelfari.pool import WorkerPool, Latch, ResultGate
+from calibre_plugins.shelfari.cache import ResponseCache, normalize_url
+from calibre_plugins.shelfari.ratelimit import RateLimiter
+from calibre_plugins.shelfari.flight import SingleFlight, Aborted
+from calibre_plugins.shelfari.matcher import QueryMatcher
+from calibre_plugins.shelfari.metrics import (Metrics, JsonLinesSink,
+        PrometheusSink)
+from calibre_plugins.shelfari.store import (MetadataStore, IdentifierStore,
+                                            metadata_from_record)
 
 __author__ = "Casey Duquette"
 __copyright__ = "Copyright 2013"
@@ -57,6 +68,30 @@ __maintainer__ = "Casey Duquette"
 __email__ = ""
 __url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
 
+# Size of the reads used when streaming a book page into the parser
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# Text in the title or format of an edition that marks it as an audio book
+AUDIO_EDITION_MARKERS = ('audio cd', 'compact disc', 'audio cassette', 'audiobook', 'mp3')
+
+
+class NullProfiler(object):
+
+    '''
+    Stands in for the Profiler until profiling is first switched on, so that
+    cProfile and pstats are never imported otherwise
+    '''
+
+    enabled = False
+
+    def call(self, name, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def report(self, log):
+        pass
+
+NULL_PROFILER = NullProfiler()
+
 
 class Shelfari(Source):
 
@@ -75,6 +110,23 @@ class Shelfari(Source):
 
     BASE_URL = 'http://www.shelfari.com'
     MAX_EDITIONS = 5
+    # Search results whose covers download_cover considers
+    MAX_COVER_CANDIDATES = 3
+
+    # Shared by every instance so concurrent identify calls from a bulk
+    # download all draw from the same bounded set of threads
+    _worker_pool = None
+    _worker_pool_lock = Lock()
+    _response_cache = None
+    _metadata_store = None
+    _identifier_store = None
+    _fetch_engine = None
+    _connection_pool = None
+    _rate_limiter = None
+    _single_flight = None
+    _cover_cache = None
+    _metrics = None
+    _profiler = None
 
     def config_widget(self):
         '''
@@ -83,6 +135,339 @@ class Shelfari(Source):
         from calibre_plugins.shelfari.config import ConfigWidget
         return ConfigWidget(self)
 
+    @property
+    def worker_pool(self):
+        prefs = cfg.prefs_snapshot()
+        max_workers = prefs[cfg.KEY_MAX_WORKERS]
+        with Shelfari._worker_pool_lock:
+            if Shelfari._worker_pool is None:
+                Shelfari._worker_pool = WorkerPool(max_workers)
+            elif Shelfari._worker_pool.max_workers != max_workers:
+                Shelfari._worker_pool.resize(max_workers)
+            return Shelfari._worker_pool
+
+    @property
+    def response_cache(self):
+        prefs = cfg.prefs_snapshot()
+        hours = prefs[cfg.KEY_CACHE_HOURS]
+        if not hours:
+            return None
+        with Shelfari._worker_pool_lock:
+            if Shelfari._response_cache is None:
+                Shelfari._response_cache = ResponseCache(os.path.join(config_dir,
+                    'plugins', 'shelfari_cache', 'http'))
+            Shelfari._response_cache.ttl = hours * 60 * 60
+            return Shelfari._response_cache
+
+    @property
+    def metadata_store(self):
+        prefs = cfg.prefs_snapshot()
+        days = prefs[cfg.KEY_METADATA_CACHE_DAYS]
+        if not days:
+            return None
+        with Shelfari._worker_pool_lock:
+            if Shelfari._metadata_store is None:
+                Shelfari._metadata_store = MetadataStore(os.path.join(config_dir,
+                    'plugins', 'shelfari_cache', 'metadata.db'),
+                    max_age=days * 24 * 60 * 60)
+                Shelfari._metadata_store.purge()
+            Shelfari._metadata_store.max_age = days * 24 * 60 * 60
+            return Shelfari._metadata_store
+
+    @property
+    def identifier_store(self):
+        with Shelfari._worker_pool_lock:
+            if Shelfari._identifier_store is None:
+                Shelfari._identifier_store = IdentifierStore(os.path.join(config_dir,
+                    'plugins', 'shelfari_cache', 'identifiers.db'))
+                atexit.register(Shelfari._identifier_store.flush)
+            return Shelfari._identifier_store
+
+    @property
+    def metrics(self):
+        sink = cfg.prefs_snapshot()[cfg.KEY_METRICS_SINK]
+        with Shelfari._worker_pool_lock:
+            if Shelfari._metrics is None or Shelfari._metrics.sink_name != sink:
+                cache_dir = os.path.join(config_dir, 'plugins', 'shelfari_cache')
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                sinks = []
+                if sink == 'jsonl':
+                    sinks.append(JsonLinesSink(os.path.join(cache_dir, 'metrics.jsonl')))
+                elif sink == 'prometheus':
+                    sinks.append(PrometheusSink(os.path.join(cache_dir, 'shelfari.prom')))
+                if Shelfari._metrics is None:
+                    atexit.register(lambda: Shelfari._metrics.flush())
+                else:
+                    Shelfari._metrics.flush()
+                Shelfari._metrics = Metrics(sinks, sink)
+            return Shelfari._metrics
+
+    @property
+    def profiler(self):
+        enabled = cfg.prefs_snapshot()[cfg.KEY_PROFILE]
+        with Shelfari._worker_pool_lock:
+            if Shelfari._profiler is None:
+                if not enabled:
+                    return NULL_PROFILER
+                # cProfile and pstats are only needed once profiling is used
+                from calibre_plugins.shelfari.profiling import Profiler
+                Shelfari._profiler = Profiler(os.path.join(config_dir,
+                    'plugins', 'shelfari_cache', 'profiles'))
+        Shelfari._profiler.configure(enabled)
+        return Shelfari._profiler
+
+    @property
+    def cover_cache(self):
+        with Shelfari._worker_pool_lock:
+            if Shelfari._cover_cache is None:
+                from calibre_plugins.shelfari.covers import CoverCache
+                Shelfari._cover_cache = CoverCache(os.path.join(config_dir,
+                    'plugins', 'shelfari_cache', 'covers'))
+            return Shelfari._cover_cache
+
+    def cache_isbn_to_identifier(self, isbn, identifier):
+        Source.cache_isbn_to_identifier(self, isbn, identifier)
+        self.identifier_store.add_isbn(isbn, identifier)
+
+    def cached_isbn_to_identifier(self, isbn):
+        ans = Source.cached_isbn_to_identifier(self, isbn)
+        if ans is None:
+            ans = self.identifier_store.isbn_to_identifier(isbn)
+            if ans is not None:
+                Source.cache_isbn_to_identifier(self, isbn, ans)
+        return ans
+
+    def cache_identifier_to_cover_url(self, id_, url):
+        Source.cache_identifier_to_cover_url(self, id_, url)
+        self.identifier_store.add_cover_url(id_, url)
+
+    def cached_identifier_to_cover_url(self, id_):
+        ans = Source.cached_identifier_to_cover_url(self, id_)
+        if ans is None:
+            ans = self.identifier_store.identifier_to_cover_url(id_)
+            if ans is not None:
+                Source.cache_identifier_to_cover_url(self, id_, ans)
+        return ans
+
+    @property
+    def single_flight(self):
+        with Shelfari._worker_pool_lock:
+            if Shelfari._single_flight is None:
+                Shelfari._single_flight = SingleFlight()
+            return Shelfari._single_flight
+
+    def fetch_url(self, log, url, timeout, consumer=None, partial_key=None, abort=None):
+        '''
+        Download url via the persistent response cache. Returns the raw bytes
+        and the url we ended up at after any redirects. Concurrent calls for
+        the same url share one download.
+
+        If consumer is given the body is also passed to it as it arrives, in
+        chunks, and reading stops early as soon as consumer returns True. Only
+        the part of the page read so far is returned. Such a truncated body
+        is never cached as the page: it is only cached when partial_key names
+        what consumer stops after, and is only served to calls passing the
+        same partial_key. Full pages are served to every call.
+
+        If abort is set while waiting for the rate limiter the download fails
+        with Aborted, and any calls sharing it download the page themselves.
+        '''
+        key = ('fetch', normalize_url(url), consumer is not None, partial_key)
+        (raw, location), shared = self.single_flight.do(key, self._fetch_url,
+                log, url, timeout, consumer, partial_key, abort)
+        if shared and consumer is not None:
+            consumer(raw)
+        return raw, location
+
+    def _fetch_url(self, log, url, timeout, consumer, partial_key, abort):
+        cache = self.response_cache
+        entry = cache.get(url) if cache is not None else None
+        if consumer is not None and partial_key and (entry is None or
+                not cache.is_fresh(entry)):
+            entry = cache.get(url, partial_key) or entry
+        if entry is not None and cache.is_fresh(entry):
+            cache.record('hits')
+            if consumer is not None:
+                consumer(entry.raw)
+            return entry.raw, entry.final_url
+
+        headers = cache.revalidation_headers(entry) if cache is not None else {}
+        try:
+            response = self._open(url, headers, timeout, abort=abort)
+        except Exception as e:
+            if entry is not None and callable(getattr(e, 'getcode', None)) and \
+                    e.getcode() == 304:
+                cache.refresh(entry)
+                cache.record('revalidated')
+                if consumer is not None:
+                    consumer(entry.raw)
+                return entry.raw, entry.final_url
+            raise
+        location = response.geturl()
+        stopped = False
+        if consumer is None:
+            raw = response.read()
+        else:
+            chunks = []
+            while True:
+                chunk = response.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                if consumer(chunk):
+                    stopped = True
+                    break
+            response.close()
+            raw = b''.join(chunks)
+        if cache is not None:
+            cache.record('misses')
+            if not stopped:
+                cache.put(url, location, raw, response.info())
+            elif partial_key:
+                cache.put(url, location, raw, response.info(), partial_key=partial_key)
+        return raw, location
+
+    def fetch_url_async(self, log, url, timeout, callback, cancelled=None):
+        '''
+        Download url via the persistent response cache and the fetch engine
+        without blocking the calling thread. callback(raw, location, error)
+        is called on the engine's thread once the page is available, so it
+        should hand any real work to another thread. Concurrent calls for the
+        same url share one download.
+
+        cancelled is an optional function returning True once this call no
+        longer wants the page, when callback is called with Aborted. The
+        download itself, or the wait for the rate limiter, is only dropped
+        once every call sharing it has been cancelled.
+        '''
+        self.single_flight.do_async(('fetch', normalize_url(url), False), callback,
+                partial(self._fetch_url_async, log, url, timeout),
+                failed=lambda e: (None, None, e), cancelled=cancelled)
+
+    def _fetch_url_async(self, log, url, timeout, callback, flight):
+        cache = self.response_cache
+        entry = cache.get(url) if cache is not None else None
+        if entry is not None and cache.is_fresh(entry):
+            cache.record('hits')
+            return callback(entry.raw, entry.final_url, None)
+
+        limiter = self.rate_limiter
+
+        def finish(response, error):
+            if error is not None:
+                if entry is not None and callable(getattr(error, 'getcode', None)) and \
+                        error.getcode() == 304:
+                    cache.refresh(entry)
+                    cache.record('revalidated')
+                    return entry.raw, entry.final_url, None
+                return None, None, error
+            raw, location = response.read(), response.geturl()
+            if cache is not None:
+                cache.record('misses')
+                try:
+                    cache.put(url, location, raw, response.info())
+                except Exception:
+                    # The page is still good, it just has to be fetched again
+                    log.exception('Failed to cache: %r' % url)
+            return raw, location, None
+
+        def on_response(response, error):
+            limiter.report(error)
+            # Whatever happens callback must be called, or every later
+            # caller for this url would wait on it forever
+            try:
+                result = finish(response, error)
+            except Exception as e:
+                result = (None, None, e)
+            callback(*result)
+
+        headers = cache.revalidation_headers(entry) if cache is not None else {}
+        if not limiter.acquire(flight):
+            return callback(None, None, Aborted('Aborted'))
+        self.fetch_engine.fetch(url, on_response, headers=headers, timeout=timeout, log=log,
+                cancelled=flight.is_set)
+
+    @property
+    def fetch_engine(self):
+        prefs = cfg.prefs_snapshot()
+        if not prefs[cfg.KEY_FETCH_ENGINE]:
+            return None
+        with Shelfari._worker_pool_lock:
+            if Shelfari._fetch_engine is None:
+                # asyncore is only loaded for those who switch the engine on
+                from calibre_plugins.shelfari.engine import AsyncFetchEngine
+                Shelfari._fetch_engine = AsyncFetchEngine(user_agent=self.user_agent,
+                        proxies=get_proxies(debug=False))
+            return Shelfari._fetch_engine
+
+    @property
+    def connection_pool(self):
+        with Shelfari._worker_pool_lock:
+            if Shelfari._connection_pool is None:
+                from calibre_plugins.shelfari.connpool import ConnectionPool
+                Shelfari._connection_pool = ConnectionPool(user_agent=self.user_agent,
+                        proxies=get_proxies(debug=False))
+            return Shelfari._connection_pool
+
+    @property
+    def rate_limiter(self):
+        prefs = cfg.prefs_snapshot()
+        max_rate = prefs[cfg.KEY_REQUESTS_PER_SECOND]
+        adaptive = prefs[cfg.KEY_ADAPT_RATE]
+        with Shelfari._worker_pool_lock:
+            if Shelfari._rate_limiter is None:
+                Shelfari._rate_limiter = RateLimiter(max_rate, adaptive)
+            else:
+                Shelfari._rate_limiter.configure(max_rate, adaptive)
+            return Shelfari._rate_limiter
+
+    @property
+    def user_agent(self):
+        return dict((name.lower(), value) for name, value in
+                self.browser.addheaders).get('user-agent')
+
+    def _open(self, url, headers, timeout, method='GET', abort=None):
+        limiter = self.rate_limiter
+        if not limiter.acquire(abort):
+            raise Aborted('Aborted')
+        engine = self.fetch_engine
+        try:
+            if engine is not None and engine.can_fetch(url):
+                response = engine.fetch_sync(url, headers=headers, method=method,
+                        timeout=timeout, abort=abort)
+            else:
+                response = self.connection_pool.open(url, headers=headers,
+                        method=method, timeout=timeout, abort=abort)
+        except Exception as e:
+            limiter.report(e)
+            raise
+        limiter.report()
+        return response
+
+    def _submit_worker(self, log, pool, worker, abort, **kwargs):
+        '''
+        Queue a Worker on the pool. With the fetch engine the page is
+        downloaded first without holding a pool thread, and the task is only
+        queued to parse it once it has arrived. Cancelling the task before the
+        page arrives stops it waiting, and drops the download unless another
+        lookup is sharing it. Pages the engine cannot fetch
+        (https, or behind a proxy) are downloaded by the Worker as usual.
+        '''
+        engine = self.fetch_engine
+        if engine is None or not engine.can_fetch(worker.url):
+            return pool.submit(worker.run, abort=abort, name=worker.url, log=log, **kwargs)
+        task = pool.prepare(worker.run_fetched, abort=abort, name=worker.url, log=log,
+                **kwargs)
+        self.fetch_url_async(log, worker.url, worker.timeout,
+                partial(self._page_fetched, pool, worker, task),
+                cancelled=lambda: task.cancel_requested)
+        return task
+
+    def _page_fetched(self, pool, worker, task, raw, location, error):
+        worker.fetched = (raw, location, error)
+        pool.start(task)
+
     def get_book_url(self, identifiers):
         shelfari_id = identifiers.get('shelfari', None)
         if shelfari_id:
@@ -136,12 +521,33 @@ class Shelfari(Source):
 
         return url
 
-    def identify(self, log, result_queue, abort, title=None, authors=None,
-            identifiers={}, timeout=30):
+    def _identify_from_store(self, log, result_queue, shelfari_id):
         '''
-        .. note::
-            this method will retry without identifiers automatically if no
-            match is found with identifiers.
+        Queue the details we stored the last time we parsed this book's page,
+        returning False if there is nothing current to use
+        '''
+        store = self.metadata_store
+        if store is None or not shelfari_id:
+            return False
+        record = store.get(shelfari_id)
+        if record is None:
+            return False
+        log.info('Using stored details for shelfari id: %s' % shelfari_id)
+        mi = metadata_from_record(shelfari_id, record)
+        mi.source_relevance = 0
+        if mi.isbn:
+            self.cache_isbn_to_identifier(mi.isbn, shelfari_id)
+        if record.get('cover_url'):
+            self.cache_identifier_to_cover_url(shelfari_id, record['cover_url'])
+        self.clean_downloaded_metadata(mi)
+        result_queue.put(mi)
+        return True
+
+    def _find_matches(self, log, title, authors, identifiers, timeout, prefs=None,
+            abort=None):
+        '''
+        Work out which Shelfari book pages to examine for a book. Returns the
+        list of book urls and an error message if the search itself failed.
         '''
         matches = []
         # Unlike the other metadata sources, if we have a shelfari id then we
@@ -149,205 +555,465 @@ class Shelfari(Source):
         # able to go straight to the URL for that book.
         shelfari_id = identifiers.get('shelfari', None)
         isbn = check_isbn(identifiers.get('isbn', None))
-        br = self.browser
         if shelfari_id:
             matches.append('%s/books/%s' % (Shelfari.BASE_URL, shelfari_id))
-        else:
+            return matches, None
+
+        metrics = self.metrics
+        with metrics.span('query'):
             query = self._create_query(log, title=title, authors=authors,
                     identifiers=identifiers)
-            if query is None:
-                log.error('Insufficient metadata to construct query')
-                return
-            try:
-                log.info('Querying: %s' % query)
-                response = br.open_novisit(query, timeout=timeout)
-                if isbn:
-                    # Check whether we got redirected to a book page for ISBN searches.
-                    # If we did, will use the url.
-                    # If we didn't then treat it as no matches on Shelfari
-                    location = response.geturl()
-                    if '/search/' not in location:
-                        log.info('ISBN match location: %r' % location)
-                        matches.append(location)
-            except Exception as e:
-                err = 'Failed to make identify query: %r' % query
-                log.exception(err)
-                return as_unicode(e)
-
-            # For ISBN based searches we have already done everything we need to
-            # So anything from this point below is for title/author based searches.
-            if not isbn:
-                try:
-                    raw = response.read().strip()
-                    #open('E:\\t.html', 'wb').write(raw)
-                    raw = raw.decode('utf-8', errors='replace')
-                    if not raw:
-                        log.error('Failed to get raw result for query: %r' % query)
-                        return
-                    root = fromstring(clean_ascii_chars(raw))
-                except:
-                    msg = 'Failed to parse shelfari page for query: %r' % query
-                    log.exception(msg)
-                    return msg
-                # Now grab the first value from the search results, provided the
-                # title and authors appear to be for the same book
-                self._parse_search_results(log, title, authors, root, matches, timeout)
+        if query is None:
+            log.error('Insufficient metadata to construct query')
+            return matches, None
+        # Title/author searches are parsed as they download, ISBN searches
+        # only need to know where they were redirected to
+        prefs = prefs or cfg.prefs_snapshot()
+        parser = None if isbn else SearchResultsParser(editions=prefs[cfg.KEY_GET_EDITIONS])
+        try:
+            log.info('Querying: %s' % query)
+            with metrics.span('search.fetch'):
+                raw, location = self.fetch_url(log, query, timeout,
+                        consumer=parser.feed if parser is not None else None,
+                        partial_key=parser.PARTIAL_KEY if parser is not None else None,
+                        abort=abort)
+            if isbn:
+                # Check whether we got redirected to a book page for ISBN searches.
+                # If we did, will use the url.
+                # If we didn't then treat it as no matches on Shelfari
+                if '/search/' not in location:
+                    log.info('ISBN match location: %r' % location)
+                    matches.append(location)
+        except Exception as e:
+            err = 'Failed to make identify query: %r' % query
+            log.exception(err)
+            return matches, as_unicode(e)
 
-        if abort.is_set():
-            return
+        # For ISBN based searches we have already done everything we need to
+        # So anything from this point below is for title/author based searches.
+        if not isbn:
+            try:
+                #open('E:\\t.html', 'wb').write(raw)
+                if not raw or raw.isspace():
+                    log.error('Failed to get raw result for query: %r' % query)
+                    return matches, None
+                results = parser.close()
+                metrics.record_all('search.', parser.timings)
+            except:
+                msg = 'Failed to parse shelfari page for query: %r' % query
+                log.exception(msg)
+                return matches, msg
+            # Now grab the first value from the search results, provided the
+            # title and authors appear to be for the same book
+            with metrics.span('search.parse'):
+                self._parse_search_results(log, title, authors, results, matches, timeout,
+                        prefs, abort)
 
         if not matches:
             # If there's no matches, normally we would try to query with less info, but shelfari's search is already fuzzy
             log.error('No matches found with query: %r' % query)
+        return matches, None
+
+    def identify(self, log, result_queue, abort, title=None, authors=None,
+            identifiers={}, timeout=30):
+        '''
+        .. note::
+            this method will retry without identifiers automatically if no
+            match is found with identifiers.
+        '''
+        profiler = self.profiler
+        try:
+            with self.metrics.span('identify'):
+                return profiler.call('identify', self._identify, log, result_queue,
+                        abort, title, authors, identifiers, timeout)
+        finally:
+            profiler.report(log)
+
+    def _identify(self, log, result_queue, abort, title, authors, identifiers, timeout):
+        isbn = check_isbn(identifiers.get('isbn', None))
+        known_id = identifiers.get('shelfari', None) or \
+                (isbn and self.cached_isbn_to_identifier(isbn))
+        if self._identify_from_store(log, result_queue, known_id):
+            return None
+
+        # Read the preferences once, for the whole lookup
+        prefs = cfg.prefs_snapshot()
+        matches, err = self._find_matches(log, title, authors, identifiers, timeout, prefs,
+                abort)
+        if err is not None:
+            return err
+
+        if abort.is_set() or not matches:
             return
 
-        # Setup worker threads to look more thoroughly at matching books to extract information
-        workers = [Worker(url, result_queue, br, log, i, self) for i, url in
+        # Setup workers to look more thoroughly at matching books to extract information
+        # Workers still running when we return, because abort was set or a
+        # confident match was found, have their results dropped
+        results = ResultGate(result_queue)
+        workers = [Worker(url, results, log, i, self, prefs=prefs, abort=abort) for i, url in
                 enumerate(matches)]
 
-        # Start the workers and stagger them so we don't hammer shelfari :)
-        for w in workers:
-            w.start()
-            time.sleep(0.1)
+        # Run them on the shared pool, with every fetch going through the
+        # shared rate limiter so we don't hammer shelfari. Tasks still queued
+        # when abort is set are skipped, and we return as soon as the last
+        # worker finishes or abort is set, whichever is first. With the fetch
+        # engine the downloads themselves don't use the pool.
+        tasks, latch = self._submit_workers(log, workers, abort, title, authors,
+                identifiers, prefs)
+        if not latch.wait(abort):
+            log.info('Aborted with %d of %d workers outstanding' % (latch.count, len(tasks)))
+        results.close()
+        for t in tasks:
+            if t.done():
+                log.info('Worker %s' % t.timing_text())
+
+        self._identify_finished(log)
+        return None
+
+    def _submit_workers(self, log, workers, abort, title, authors, identifiers, prefs):
+        '''
+        Queue the Workers for an identify, most relevant first. Returns their
+        tasks and a Latch released once identify has all it needs.
+
+        Normally that is every worker finishing. In early return mode a
+        confident match also cancels the workers ranked below it that have
+        not started, along with any of their downloads still in flight, and
+        the latch is released as soon as it and the workers ranked above it
+        are done. identify drops the results of workers that finish later.
+        '''
+        pool = self.worker_pool
+        latch = Latch(len(workers))
+        if not prefs[cfg.KEY_EARLY_RETURN]:
+            return [self._submit_worker(log, pool, w, abort, callback=latch.count_down)
+                    for w in workers], latch
+
+        keygen = self.identify_results_keygen(title=title, authors=authors,
+                identifiers=identifiers)
+        tasks, lock = [], Lock()
+        cutoff = [len(workers)]
+
+        def worker_done(index, task):
+            try:
+                with lock:
+                    mi = workers[index].mi
+                    if index < cutoff[0] and mi is not None and \
+                            self.is_confident_match(mi, identifiers, keygen):
+                        cutoff[0] = index
+                        skipped = [t for t in tasks[index + 1:] if t.cancel()]
+                        log.info('Confident match at %s, skipping %d lower ranked pages' % (
+                            workers[index].url, len(skipped)))
+                    if cutoff[0] < len(workers) and all(t.done() for t in tasks[:cutoff[0] + 1]):
+                        latch.release()
+            finally:
+                # Counted even if the match check failed, or identify would
+                # wait on this worker until calibre gave up
+                latch.count_down()
+
+        with lock:
+            for index, w in enumerate(workers):
+                tasks.append(self._submit_worker(log, pool, w, abort,
+                    callback=partial(worker_done, index)))
+        return tasks, latch
+
+    def is_confident_match(self, mi, identifiers, keygen):
+        '''
+        True when mi is as good as a match for identifiers can get, judged by
+        the key from identify_results_keygen that calibre ranks results with:
+        the Shelfari id or ISBN we were asked for, or with neither of those an
+        exact title with all the fields we can fill in.
+        '''
+        shelfari_id = identifiers.get('shelfari', None)
+        if shelfari_id and mi.identifiers.get('shelfari', None) == shelfari_id:
+            return True
+        base = getattr(keygen(mi), 'base', None)
+        if not base:
+            return False
+        isbn_match, has_cover, all_fields, exact_title = base[:4]
+        if check_isbn(identifiers.get('isbn', None)):
+            return isbn_match == 1
+        return all_fields == 1 and exact_title == 1
+
+    def _identify_finished(self, log):
+        self.identifier_store.flush()
+        if self.response_cache is not None:
+            log.info(self.response_cache.stats_text())
+        if self.fetch_engine is not None:
+            log.info(self.fetch_engine.stats_text())
+        else:
+            log.info(self.connection_pool.stats_text())
+        log.info(self.rate_limiter.stats_text())
+        log.info(self.single_flight.stats_text())
+        log.debug('Time spent per stage so far:\n' + self.metrics.aggregate.summary_text())
+
+    def identify_many(self, log, books, abort, timeout=30):
+        '''
+        Identify a whole batch of books in one go, for library wide refreshes.
+
+        books is a sequence of (title, authors, identifiers) tuples. This is a
+        generator yielding (index, results) for each book as soon as its lookup
+        is complete, where results is the list of Metadata found for the book
+        at that index. Identical queries and book pages shared between books
+        are only searched, downloaded and parsed once. Every search and book
+        page fetch runs through the shared worker pool, with book pages ahead
+        of searches so results stream back while later searches are pending.
+        '''
+        pool = self.worker_pool
+        prefs = cfg.prefs_snapshot()
+        completed = Queue()
+        search_done = lambda task: completed.put(('search', task))
+        details_done = lambda task: completed.put(('details', task))
+
+        groups = OrderedDict()   # search key -> indices of the books needing it
+        group_matches = {}       # search key -> book urls it found
+        waiting_on = {}          # search key -> book urls not yet parsed
+        url_waiters = {}         # book url -> search keys waiting on it
+        details = {}             # book url -> result queue of its Worker
+        detail_results = {}      # book url -> Metadata parsed from the page
+        outstanding = 0
 
-        while not abort.is_set():
-            a_worker_is_alive = False
-            for w in workers:
-                w.join(0.2)
+        for i, (title, authors, identifiers) in enumerate(books):
+            identifiers = identifiers or {}
+            isbn = check_isbn(identifiers.get('isbn', None))
+            shelfari_id = identifiers.get('shelfari', None)
+            rq = Queue()
+            if self._identify_from_store(log, rq, shelfari_id or
+                    (isbn and self.cached_isbn_to_identifier(isbn))):
+                yield i, [rq.get_nowait()]
+                continue
+            key = shelfari_id or self._create_query(log, title=title,
+                    authors=authors, identifiers=identifiers)
+            if key is None:
+                log.error('Insufficient metadata to construct query for book: %r' % title)
+                yield i, []
+                continue
+            if key not in groups:
+                groups[key] = []
+                pool.submit(self._find_matches, log, title, authors,
+                        identifiers, timeout, prefs, abort, abort=abort, name=key,
+                        callback=search_done, priority=1, log=log)
+                outstanding += 1
+            groups[key].append(i)
+
+        while outstanding:
+            try:
+                kind, task = completed.get(timeout=Latch.ABORT_CHECK_INTERVAL)
+            except Empty:
                 if abort.is_set():
+                    log.info('Aborted with %d lookups outstanding' % outstanding)
                     break
-                if w.is_alive():
-                    a_worker_is_alive = True
-            if not a_worker_is_alive:
-                break
+                continue
+            outstanding -= 1
+            if task.exception is not None:
+                log.error('%s failed for: %r %r' % (kind, task.name, task.exception))
+            finished_keys = []
+            if kind == 'search':
+                key = task.name
+                matches = task.result[0] if task.result and not abort.is_set() else []
+                group_matches[key] = matches
+                waiting_on[key] = set()
+                for url in matches:
+                    if url in detail_results:
+                        continue
+                    waiting_on[key].add(url)
+                    url_waiters.setdefault(url, []).append(key)
+                    if url in details:
+                        continue
+                    details[url] = Queue()
+                    w = Worker(url, details[url], log, 0, self, prefs=prefs, abort=abort)
+                    self._submit_worker(log, pool, w, abort, callback=details_done)
+                    outstanding += 1
+                if not waiting_on[key]:
+                    finished_keys.append(key)
+            else:
+                url = task.name
+                detail_results[url] = []
+                while True:
+                    try:
+                        detail_results[url].append(details[url].get_nowait())
+                    except Empty:
+                        break
+                for key in url_waiters.pop(url, []):
+                    waiting_on[key].discard(url)
+                    if not waiting_on[key]:
+                        finished_keys.append(key)
 
-        return None
+            for key in finished_keys:
+                del waiting_on[key]
+                matches = group_matches.pop(key)
+                for i in groups[key]:
+                    results = []
+                    for relevance, url in enumerate(matches):
+                        for mi in detail_results[url]:
+                            mi = mi.deepcopy()
+                            mi.source_relevance = relevance
+                            results.append(mi)
+                    yield i, results
+
+        self._identify_finished(log)
 
-    def _parse_search_results(self, log, orig_title, orig_authors, root, matches, timeout):
-        results = root.xpath('//ol[@class="book_results"]/li')
+    def _parse_search_results(self, log, orig_title, orig_authors, results, matches, timeout,
+            prefs=None, abort=None):
+        '''
+        Add the urls of the results, a list of SearchResult, that match the
+        query to matches, closest first
+        '''
         if not results:
             return
+        prefs = prefs or cfg.prefs_snapshot()
         title_tokens = list(self.get_title_tokens(orig_title))
         author_tokens = list(self.get_author_tokens(orig_authors))
+        matcher = QueryMatcher(title_tokens, author_tokens)
 
-        def ismatch(title, authors):
-            authors = lower(' '.join(authors))
-            title = lower(title)
-            match = not title_tokens
-            for t in title_tokens:
-                if lower(t) in title:
-                    match = True
-                    break
-            amatch = not author_tokens
-            for a in author_tokens:
-                if lower(a) in authors:
-                    amatch = True
-                    break
-            if not author_tokens: amatch = True
-            return match and amatch
-
-        for result in results:
-            # Shelfari id that can be used to go directly to book
-            shelfari_id = result.get('id', None)
-            if shelfari_id:
-                shelfari_id = shelfari.replace("SR", "")
-            
-            # Grab title and author
-            title = result.xpath('./div[@class="text"]/h3/a')[0].text_content().strip()
-            authors = result.xpath('./div[@class="text"]/a')[0].text_content().strip().split(',')
-            if not ismatch(title, authors):
+        rows = [(result.title, ', '.join(result.authors.split(','))) for result in results]
+
+        # Score every result against the query in one pass, then look at the
+        # closest matches first with Shelfari's own order breaking ties
+        ranked = []
+        for score, (title, authors), result in zip(matcher.score_rows(rows), rows, results):
+            if score is None:
                 log.error('Rejecting as not close enough match: %s %s' % (title, authors))
                 continue
+            ranked.append((score, result))
+        ranked.sort(key=lambda x: -x[0])
 
-            # Get the url for the book
-            url_node = root.xpath('./div[@class="text"]/h3/a/@href')
-            if url_node:
-                c = cfg.plugin_prefs[cfg.STORE_NAME]
-                if c[cfg.KEY_GET_EDITIONS]:
-                    log.info("Getting editions is not currently supported")
+        for score, result in ranked:
+            if result.url:
+                if prefs[cfg.KEY_GET_EDITIONS]:
                     # We need to read the editions for this book and get the matches from those
-                    # for editions_text in root.xpath('//table[@class="tableList"]/tr/td[2]/span/a[@href]/text()'):
-                    #     #editions_text = tostring(editions_node, method='text').strip()
-                    #     if editions_text == '1 edition':
-                    #         # There is no point in doing the extra hop
-                    #         log.info('Not scanning editions as only one edition found')
-                    #         break
-                    #     #editions_url = Shelfari.BASE_URL + editions_node.get('href')
-                    #     editions_url = Shelfari.BASE_URL + editions_text.getparent().get('href')
-                    #     if '/work/editions/' in editions_url:
-                    #         log.info('Examining up to %s: %s' % (editions_text, editions_url))
-                    #         self._parse_editions_for_book(log, editions_url, matches, timeout, title_tokens)
-                    #         return
-                result_url = url_node[0]
-                matches.append(result_url)
-
-    # def _parse_editions_for_book(self, log, editions_url, matches, timeout, title_tokens):
-    # 
-    #     def ismatch(title):
-    #         title = lower(title)
-    #         match = not title_tokens
-    #         for t in title_tokens:
-    #             if lower(t) in title:
-    #                 match = True
-    #                 break
-    #         return match
-    # 
-    #     br = self.browser
-    #     try:
-    #         raw = br.open_novisit(editions_url, timeout=timeout).read().strip()
-    #     except Exception as e:
-    #         err = 'Failed identify editions query: %r' % editions_url
-    #         log.exception(err)
-    #         return as_unicode(e)
-    #     try:
-    #         raw = raw.decode('utf-8', errors='replace')
-    #         if not raw:
-    #             log.error('Failed to get raw result for query: %r' % editions_url)
-    #             return
-    #         #open('E:\\s.html', 'wb').write(raw)
-    #         root = fromstring(clean_ascii_chars(raw))
-    #     except:
-    #         msg = 'Failed to parse shelfari page for query: %r' % editions_url
-    #         log.exception(msg)
-    #         return msg
-    # 
-    #     first_non_valid = None
-    #     for div_link in root.xpath('//div[@class="editionData"]/div[1]/a[@class="bookTitle"]'):
-    #         title = tostring(div_link, 'text').strip().lower()
-    #         if title:
-    #             # Verify it is not an audio edition
-    #             valid_title = True
-    #             for exclusion in ['(audio cd)', '(compact disc)', '(audio cassette)']:
-    #                 if exclusion in title:
-    #                     log.info('Skipping audio edition: %s' % title)
-    #                     valid_title = False
-    #                     if first_non_valid is None:
-    #                         first_non_valid = Shelfari.BASE_URL + div_link.get('href')
-    #                     break
-    #             if valid_title:
-    #                 # Verify it is not a foreign language edition
-    #                 if not ismatch(title):
-    #                     log.info('Skipping alternate title:', title)
-    #                     continue
-    #                 matches.append(Shelfari.BASE_URL + div_link.get('href'))
-    #                 if len(matches) >= Shelfari.MAX_EDITIONS:
-    #                     return
-    #     if len(matches) == 0 and first_non_valid:
-    #         # We have found only audio editions. In which case return the first match
-    #         # rather than tell the user there are no matches.
-    #         log.info('Choosing the first audio edition as no others found.')
-    #         matches.append(first_non_valid)
+                    if not result.editions_url or result.editions_text == '1 edition':
+                        # There is no point in doing the extra hop
+                        log.info('Not scanning editions as only one edition found')
+                    else:
+                        editions_url = urljoin(Shelfari.BASE_URL, result.editions_url)
+                        log.info('Examining up to %s: %s' % (result.editions_text, editions_url))
+                        if self._parse_editions_for_book(log, result.shelfari_id, editions_url,
+                                matches, timeout, title_tokens, abort):
+                            return
+                matches.append(result.url)
+
+    def _parse_editions_for_book(self, log, shelfari_id, editions_url, matches, timeout, title_tokens,
+            abort=None):
+        '''
+        Add the urls of up to MAX_EDITIONS editions of the book to matches,
+        skipping audio books and editions with a foreign title. identify then
+        fetches them all in parallel on the worker pool. The editions of each
+        work are remembered, so the editions page is not crawled again for
+        any edition of it. Returns False if the editions could not be read.
+        '''
+
+        matcher = QueryMatcher(title_tokens, [])
+
+        def ismatch(title):
+            return matcher.score_rows([(title, '')])[0] is not None
+
+        store = self.identifier_store
+        work_id = store.identifier_to_work(shelfari_id) if shelfari_id else None
+        editions = store.work_to_editions(work_id) if work_id else None
+        if editions is not None:
+            log.info('Using the %d editions already found for work %s' % (len(editions), work_id))
+        else:
+            editions, work_id = self._fetch_editions(log, editions_url, timeout, abort)
+            if editions is None:
+                return False
+            store.add_editions(work_id or shelfari_id, editions,
+                    [shelfari_id] if shelfari_id else [])
+
+        first_non_valid, added = None, 0
+        for edition in editions:
+            title = edition['title'].lower()
+            description = ' '.join((title, edition['format'].lower()))
+            if any(marker in description for marker in AUDIO_EDITION_MARKERS):
+                # Verify it is not an audio edition
+                log.info('Skipping audio edition: %s' % title)
+                if first_non_valid is None:
+                    first_non_valid = edition['url']
+                continue
+            # Verify it is not a foreign language edition
+            if not ismatch(title):
+                log.info('Skipping alternate title: %s' % title)
+                continue
+            matches.append(edition['url'])
+            added += 1
+            if added >= Shelfari.MAX_EDITIONS:
+                return True
+        if not added and first_non_valid:
+            # We have found only audio editions. In which case return the first match
+            # rather than tell the user there are no matches.
+            log.info('Choosing the first audio edition as no others found.')
+            matches.append(first_non_valid)
+        return True
+
+    def _fetch_editions(self, log, editions_url, timeout, abort=None):
+        '''
+        Download and parse an editions page. Returns the list of editions, as
+        stored by the identifier store, and the work id if the page has one.
+        '''
+        try:
+            with self.metrics.span('editions.fetch'):
+                raw = self.fetch_url(log, editions_url, timeout, abort=abort)[0]
+        except Exception:
+            log.exception('Failed identify editions query: %r' % editions_url)
+            return None, None
+        try:
+            if not raw or raw.isspace():
+                log.error('Failed to get raw result for query: %r' % editions_url)
+                return None, None
+            root = parse_page_bytes(raw)
+        except:
+            log.exception('Failed to parse shelfari page for query: %r' % editions_url)
+            return None, None
+
+        return parse_editions(root, raw, editions_url, Shelfari.BASE_URL)
 
     def download_cover(self, log, result_queue, abort,
             title=None, authors=None, identifiers={}, timeout=30):
+        profiler = self.profiler
+        try:
+            profiler.call('download_cover', self._download_cover, log, result_queue,
+                    abort, title, authors, identifiers, timeout)
+        finally:
+            profiler.report(log)
+
+    def _download_cover(self, log, result_queue, abort, title, authors,
+            identifiers, timeout):
+        candidates = self._cover_candidates(log, abort, title, authors,
+                identifiers, timeout)
+        if abort.is_set():
+            return
+        if not candidates:
+            log.info('No cover found')
+            return
+
+        cache = self.cover_cache
+        for url in candidates:
+            cdata = cache.get(url)
+            if cdata is not None:
+                log('Using the cover already downloaded from:', url)
+                result_queue.put((self, cdata))
+                return
+
+        cdata = self._download_best_cover(log, candidates, abort, timeout)
+        log.info(cache.stats_text())
+        if cdata is not None:
+            result_queue.put((self, cdata))
+
+    def _cover_candidates(self, log, abort, title, authors, identifiers, timeout):
+        '''
+        The cover urls for a book, best first: the renditions of the cover we
+        know for its identifiers or, failing that, of the covers of the top
+        results of an identify.
+        '''
+        urls = []
         cached_url = self.get_cached_cover_url(identifiers)
-        if cached_url is None:
+        if cached_url is not None:
+            urls.append(cached_url)
+        else:
             log.info('No cached cover found, running identify')
             rq = Queue()
             self.identify(log, rq, abort, title=title, authors=authors,
                     identifiers=identifiers)
             if abort.is_set():
-                return
+                return []
             results = []
             while True:
                 try:
@@ -358,22 +1024,58 @@ class Shelfari(Source):
                 title=title, authors=authors, identifiers=identifiers))
             for mi in results:
                 cached_url = self.get_cached_cover_url(mi.identifiers)
-                if cached_url is not None:
-                    break
-        if cached_url is None:
-            log.info('No cover found')
-            return
+                if cached_url is not None and cached_url not in urls:
+                    urls.append(cached_url)
+                    if len(urls) >= Shelfari.MAX_COVER_CANDIDATES:
+                        break
+        from calibre_plugins.shelfari.covers import renditions
+        candidates = []
+        for url in urls:
+            candidates.extend(r for r in renditions(url) if r not in candidates)
+        return candidates
 
-        if abort.is_set():
-            return
-        br = self.browser
-        log('Downloading cover from:', cached_url)
-        try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
-            result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download cover from:', cached_url)
+    def _download_best_cover(self, log, candidates, abort, timeout):
+        '''
+        Probe the size of every candidate at once on the worker pool, then
+        download the largest, falling back to the next largest if that
+        fails. Candidates whose size the server would not tell us are tried
+        last, in their original order.
+        '''
+        from calibre_plugins.shelfari.covers import probe_size
+        pool = self.worker_pool
+        metrics = self.metrics
+        latch = Latch(len(candidates))
+        with metrics.span('cover.probe'):
+            tasks = [pool.submit(probe_size, partial(self._open, abort=abort), url, timeout,
+                abort=abort, name=url, callback=latch.count_down) for url in candidates]
+            if not latch.wait(abort):
+                return None
 
+        probed = []
+        for rank, (url, task) in enumerate(zip(candidates, tasks)):
+            if task.exception is not None:
+                log.info('Skipping cover %s: %s' % (url, task.exception))
+                continue
+            if task.result is None:
+                continue
+            size, data = task.result
+            probed.append((-(size or 0), rank, url, data))
+        probed.sort(key=lambda x: x[:2])
+
+        for neg_size, rank, url, cdata in probed:
+            if abort.is_set():
+                return None
+            log('Downloading cover from:', url, '(%d bytes)' % -neg_size if neg_size else '')
+            try:
+                if cdata is None:
+                    with metrics.span('cover.download'):
+                        cdata = self._open(url, {}, timeout, abort=abort).read()
+            except:
+                log.exception('Failed to download cover from:', url)
+                continue
+            self.cover_cache.put(url, cdata)
+            return cdata
+        return None
 
 if __name__ == '__main__': # tests
     # To run these test use:
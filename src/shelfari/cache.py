@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import time, json, hashlib
+from collections import OrderedDict
+from threading import Lock
+from urllib import urlencode
+from urlparse import urlsplit, urlunsplit, parse_qsl
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+def normalize_url(url):
+    '''
+    Reduce a url to a canonical form so that trivially different spellings of
+    the same page (host case, query parameter order, fragments) share a cache
+    entry
+    '''
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    return urlunsplit((scheme.lower(), netloc.lower(), path or '/', query, ''))
+
+
+class CachedResponse(object):
+
+    def __init__(self, key, meta, raw):
+        self.key, self.raw = key, raw
+        self.url = meta['url']
+        self.final_url = meta.get('final_url') or self.url
+        self.etag = meta.get('etag')
+        self.last_modified = meta.get('last_modified')
+        self.stored_at = meta.get('stored_at', 0)
+        self.partial_key = meta.get('partial_key')
+
+    def age(self):
+        return time.time() - self.stored_at
+
+
+class ResponseCache(object):
+
+    '''
+    Persistent cache of raw Shelfari responses stored under the calibre config
+    directory, one body and one json metadata file per normalized url.
+
+    Entries younger than ttl seconds are served without touching the network.
+    Older entries are revalidated with If-None-Match/If-Modified-Since when the
+    server gave us an ETag or Last-Modified header. The total size of the
+    bodies is kept under max_size bytes by evicting the least recently used.
+
+    A body that was only read up to some point is stored under a partial_key
+    naming how far, apart from the full page, and is only returned to
+    callers asking for that same partial_key.
+    '''
+
+    def __init__(self, cache_dir, ttl=24*60*60, max_size=50*1024*1024):
+        self.cache_dir = cache_dir
+        self.ttl, self.max_size = ttl, max_size
+        self.hits = self.misses = self.revalidated = 0
+        self._lock = Lock()
+        self._index = None
+        self._total_size = 0
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def _load_index(self):
+        # Called with the lock held. Rebuild the LRU order from the access
+        # times we left on the metadata files last time calibre ran.
+        if self._index is not None:
+            return
+        self._index = OrderedDict()
+        self._total_size = 0
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-5]
+            try:
+                mtime = os.path.getmtime(self._path(key, '.json'))
+                size = os.path.getsize(self._path(key, '.html'))
+            except OSError:
+                continue
+            entries.append((mtime, key, size))
+        for mtime, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_size += size
+
+    def key_for(self, url, partial_key=None):
+        name = normalize_url(url)
+        if partial_key:
+            name += ' partial:' + partial_key
+        return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+    def get(self, url, partial_key=None):
+        '''
+        Return the CachedResponse for url, fresh or stale, or None
+        '''
+        key = self.key_for(url, partial_key)
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                return None
+            try:
+                with open(self._path(key, '.json'), 'rb') as f:
+                    meta = json.loads(f.read().decode('utf-8'))
+                with open(self._path(key, '.html'), 'rb') as f:
+                    raw = f.read()
+            except (IOError, OSError, ValueError):
+                self._remove(key)
+                return None
+            self._touch(key)
+        return CachedResponse(key, meta, raw)
+
+    def is_fresh(self, entry):
+        return entry.age() < self.ttl
+
+    def can_revalidate(self, entry):
+        return bool(entry.etag or entry.last_modified)
+
+    def revalidation_headers(self, entry):
+        '''
+        The conditional request headers that let the server answer 304 if our
+        copy of entry is still current
+        '''
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def put(self, url, final_url, raw, headers=None, partial_key=None):
+        headers = headers or {}
+        key = self.key_for(url, partial_key)
+        meta = {
+            'url': url,
+            'final_url': final_url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'stored_at': time.time(),
+            'partial_key': partial_key,
+        }
+        with self._lock:
+            self._load_index()
+            self._write(key, '.html', raw)
+            self._write(key, '.json', json.dumps(meta).encode('utf-8'))
+            self._total_size += len(raw) - self._index.pop(key, 0)
+            self._index[key] = len(raw)
+            self._evict()
+
+    def refresh(self, entry):
+        '''
+        The server told us our copy is still current, restart its ttl
+        '''
+        meta = {
+            'url': entry.url,
+            'final_url': entry.final_url,
+            'etag': entry.etag,
+            'last_modified': entry.last_modified,
+            'stored_at': time.time(),
+            'partial_key': entry.partial_key,
+        }
+        with self._lock:
+            self._load_index()
+            if entry.key in self._index:
+                self._write(entry.key, '.json', json.dumps(meta).encode('utf-8'))
+                self._touch(entry.key)
+
+    def _write(self, key, ext, data):
+        path = self._path(key, ext)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+    def _touch(self, key):
+        size = self._index.pop(key)
+        self._index[key] = size
+        try:
+            os.utime(self._path(key, '.json'), None)
+        except OSError:
+            pass
+
+    def _remove(self, key):
+        self._total_size -= self._index.pop(key, 0)
+        for ext in ('.json', '.html'):
+            try:
+                os.remove(self._path(key, ext))
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._total_size > self.max_size and len(self._index) > 1:
+            oldest = next(iter(self._index))
+            self._remove(oldest)
+
+    def record(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats_text(self):
+        return 'HTTP cache: %d hits, %d revalidated, %d misses' % (self.hits,
+                self.revalidated, self.misses)
@@ -32,18 +32,22 @@ from __future__ import (unicode_literals, division, absolute_import,
 import sys, os
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
 
-import copy
 from functools import partial
 from PyQt4 import QtGui
 from PyQt4.Qt import (QTableWidgetItem, QVBoxLayout, Qt, QGroupBox, QTableWidget,
                       QCheckBox, QAbstractItemView, QHBoxLayout, QIcon,
-                      QInputDialog)
+                      QInputDialog, QLabel, QSpinBox, QComboBox)
 from calibre.gui2 import get_current_db, question_dialog, error_dialog
 from calibre.gui2.complete import MultiCompleteLineEdit
 from calibre.gui2.metadata.config import ConfigWidget as DefaultConfigWidget
-from calibre.utils.config import JSONConfig
 
 from calibre_plugins.shelfari.common_utils import ReadOnlyTableWidgetItem
+from calibre_plugins.shelfari.prefs import (STORE_NAME, KEY_GET_ALL_AUTHORS,
+        KEY_GET_EDITIONS, KEY_GENRE_MAPPINGS, KEY_MAX_WORKERS, KEY_CACHE_HOURS,
+        KEY_METADATA_CACHE_DAYS, KEY_FETCH_ENGINE, KEY_REQUESTS_PER_SECOND,
+        KEY_ADAPT_RATE, KEY_EARLY_RETURN, KEY_METRICS_SINK, KEY_PROFILE,
+        METRICS_SINKS, DEFAULT_GENRE_MAPPINGS, DEFAULT_STORE_VALUES, plugin_prefs,
+        invalidate_prefs)
 
 __author__ = "Casey Duquette"
 __copyright__ = "Copyright 2013"
@@ -56,84 +60,6 @@ __email__ = ""
 __url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
 
 
-STORE_NAME = 'Options'
-KEY_GET_ALL_AUTHORS = 'getAllAuthors'
-KEY_GET_EDITIONS = 'getEditions'
-KEY_GENRE_MAPPINGS = 'genreMappings'
-
-DEFAULT_GENRE_MAPPINGS = {
-                'Anthologies': ['Anthologies'],
-                'Adventure': ['Adventure'],
-                'Adult Fiction': ['Adult'],
-                'Adult': ['Adult'],
-                'Art': ['Art'],
-                'Biography': ['Biography'],
-                'Biography Memoir': ['Biography'],
-                'Business': ['Business'],
-                'Chick-lit': ['Chick-lit'],
-                'Childrens': ['Childrens'],
-                'Classics': ['Classics'],
-                'Comics': ['Comics'],
-                'Graphic Novels Comics': ['Comics'],
-                'Contemporary': ['Contemporary'],
-                'Cookbooks': ['Cookbooks'],
-                'Crime': ['Crime'],
-                'Fantasy': ['Fantasy'],
-                'Feminism': ['Feminism'],
-                'Gardening': ['Gardening'],
-                'Gay': ['Gay'],
-                'Glbt': ['Gay'],
-                'Health': ['Health'],
-                'History': ['History'],
-                'Historical Fiction': ['Historical'],
-                'Horror': ['Horror'],
-                'Comedy': ['Humour'],
-                'Humor': ['Humour'],
-                'Health': ['Health'],
-                'Inspirational': ['Inspirational'],
-                'Sequential Art > Manga': ['Manga'],
-                'Modern': ['Modern'],
-                'Music': ['Music'],
-                'Mystery': ['Mystery'],
-                'Non Fiction': ['Non-Fiction'],
-                'Paranormal': ['Paranormal'],
-                'Religion': ['Religion'],
-                'Philosophy': ['Philosophy'],
-                'Politics': ['Politics'],
-                'Poetry': ['Poetry'],
-                'Psychology': ['Psychology'],
-                'Reference': ['Reference'],
-                'Romance': ['Romance'],
-                'Science': ['Science'],
-                'Science Fiction': ['Science Fiction'],
-                'Science Fiction Fantasy': ['Science Fiction', 'Fantasy'],
-                'Self Help': ['Self Help'],
-                'Sociology': ['Sociology'],
-                'Spirituality': ['Spirituality'],
-                'Suspense': ['Suspense'],
-                'Thriller': ['Thriller'],
-                'Travel': ['Travel'],
-                'Paranormal > Vampires': ['Vampires'],
-                'War': ['War'],
-                'Western': ['Western'],
-                'Language > Writing': ['Writing'],
-                'Writing > Essays': ['Writing'],
-                'Young Adult': ['Young Adult'],
-                }
-
-DEFAULT_STORE_VALUES = {
-    KEY_GET_EDITIONS: False,
-    KEY_GET_ALL_AUTHORS: False,
-    KEY_GENRE_MAPPINGS: copy.deepcopy(DEFAULT_GENRE_MAPPINGS)
-}
-
-# This is where all preferences for this plugin will be stored
-plugin_prefs = JSONConfig('plugins/Shelfari')
-
-# Set defaults
-plugin_prefs.defaults[STORE_NAME] = DEFAULT_STORE_VALUES
-
-
 class GenreTagMappingsTableWidget(QTableWidget):
     def __init__(self, parent, all_tags):
         QTableWidget.__init__(self, parent)
@@ -281,6 +207,109 @@ class ConfigWidget(DefaultConfigWidget):
                                               'e.g. "A (Editor), B (Series Editor)" will return author A\n')
         self.all_authors_checkbox.setChecked(c[KEY_GET_ALL_AUTHORS])
         other_group_box_layout.addWidget(self.all_authors_checkbox)
+        self.fetch_engine_checkbox = QCheckBox('Download pages on a single shared connection engine (experimental)', self)
+        self.fetch_engine_checkbox.setToolTip('When checked all downloads from Shelfari run on one background thread\n'
+                                              'over a few reused connections, instead of each download holding a\n'
+                                              'pool thread while it waits. Useful for very large bulk downloads.')
+        self.fetch_engine_checkbox.setChecked(c.get(KEY_FETCH_ENGINE, DEFAULT_STORE_VALUES[KEY_FETCH_ENGINE]))
+        other_group_box_layout.addWidget(self.fetch_engine_checkbox)
+        self.early_return_checkbox = QCheckBox('Stop at the first confident match (faster)', self)
+        self.early_return_checkbox.setToolTip('When checked, as soon as a book page matching the Shelfari id or ISBN\n'
+                                              'being searched for (or the exact title, with all details available) has\n'
+                                              'been read, the lower ranked search results are not downloaded.\n'
+                                              'Uncheck to always see every result Shelfari finds.')
+        self.early_return_checkbox.setChecked(c.get(KEY_EARLY_RETURN, DEFAULT_STORE_VALUES[KEY_EARLY_RETURN]))
+        other_group_box_layout.addWidget(self.early_return_checkbox)
+
+        max_workers_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(max_workers_layout)
+        max_workers_label = QLabel('Maximum simultaneous book page downloads:', self)
+        max_workers_label.setToolTip('The number of Shelfari book pages that will be downloaded at the same\n'
+                                     'time, shared across all books being looked up. Higher values are faster\n'
+                                     'for bulk downloads but put more load on Shelfari.')
+        max_workers_layout.addWidget(max_workers_label)
+        self.max_workers_spin = QSpinBox(self)
+        self.max_workers_spin.setMinimum(1)
+        self.max_workers_spin.setMaximum(16)
+        self.max_workers_spin.setValue(c.get(KEY_MAX_WORKERS, DEFAULT_STORE_VALUES[KEY_MAX_WORKERS]))
+        max_workers_label.setBuddy(self.max_workers_spin)
+        max_workers_layout.addWidget(self.max_workers_spin)
+        max_workers_layout.addStretch(1)
+
+        cache_hours_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(cache_hours_layout)
+        cache_hours_label = QLabel('Reuse downloaded Shelfari pages for (hours):', self)
+        cache_hours_label.setToolTip('Search and book pages are kept on disk and reused for this many hours\n'
+                                     'before being checked with Shelfari again. Set to 0 to always download.')
+        cache_hours_layout.addWidget(cache_hours_label)
+        self.cache_hours_spin = QSpinBox(self)
+        self.cache_hours_spin.setMinimum(0)
+        self.cache_hours_spin.setMaximum(24*30)
+        self.cache_hours_spin.setValue(c.get(KEY_CACHE_HOURS, DEFAULT_STORE_VALUES[KEY_CACHE_HOURS]))
+        cache_hours_label.setBuddy(self.cache_hours_spin)
+        cache_hours_layout.addWidget(self.cache_hours_spin)
+        cache_hours_layout.addStretch(1)
+
+        metadata_days_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(metadata_days_layout)
+        metadata_days_label = QLabel('Reuse book details already found by id or ISBN for (days):', self)
+        metadata_days_label.setToolTip('Details parsed from a Shelfari book page are remembered for this many\n'
+                                       'days, so looking up the same Shelfari id or ISBN again does not need\n'
+                                       'to contact Shelfari at all. Set to 0 to always download.')
+        metadata_days_layout.addWidget(metadata_days_label)
+        self.metadata_days_spin = QSpinBox(self)
+        self.metadata_days_spin.setMinimum(0)
+        self.metadata_days_spin.setMaximum(365)
+        self.metadata_days_spin.setValue(c.get(KEY_METADATA_CACHE_DAYS, DEFAULT_STORE_VALUES[KEY_METADATA_CACHE_DAYS]))
+        metadata_days_label.setBuddy(self.metadata_days_spin)
+        metadata_days_layout.addWidget(self.metadata_days_spin)
+        metadata_days_layout.addStretch(1)
+
+        rate_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(rate_layout)
+        rate_label = QLabel('Maximum requests to Shelfari per second:', self)
+        rate_label.setToolTip('Shared by every download the plugin makes, including several books\n'
+                              'being looked up at once.')
+        rate_layout.addWidget(rate_label)
+        self.rate_spin = QSpinBox(self)
+        self.rate_spin.setMinimum(1)
+        self.rate_spin.setMaximum(50)
+        self.rate_spin.setValue(c.get(KEY_REQUESTS_PER_SECOND, DEFAULT_STORE_VALUES[KEY_REQUESTS_PER_SECOND]))
+        rate_label.setBuddy(self.rate_spin)
+        rate_layout.addWidget(self.rate_spin)
+        self.adapt_rate_checkbox = QCheckBox('Slow down automatically when Shelfari is busy', self)
+        self.adapt_rate_checkbox.setToolTip('When checked the request rate is halved whenever Shelfari answers\n'
+                                            '"too many requests" or "service unavailable", or a download times\n'
+                                            'out, and then creeps back up to the maximum as requests succeed.')
+        self.adapt_rate_checkbox.setChecked(c.get(KEY_ADAPT_RATE, DEFAULT_STORE_VALUES[KEY_ADAPT_RATE]))
+        rate_layout.addWidget(self.adapt_rate_checkbox)
+        rate_layout.addStretch(1)
+
+        metrics_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(metrics_layout)
+        metrics_label = QLabel('Record how long each step of a download takes:', self)
+        metrics_label.setToolTip('Timings for each stage (searching, downloading and parsing pages,\n'
+                                 'covers...) are written to the shelfari_cache folder in calibre\'s\n'
+                                 'configuration directory, as metrics.jsonl (one line per step) or\n'
+                                 'shelfari.prom (totals in the Prometheus text format).')
+        metrics_layout.addWidget(metrics_label)
+        self.metrics_combo = QComboBox(self)
+        for value, text in METRICS_SINKS:
+            self.metrics_combo.addItem(text, value)
+        sinks = [value for value, text in METRICS_SINKS]
+        sink = c.get(KEY_METRICS_SINK, DEFAULT_STORE_VALUES[KEY_METRICS_SINK])
+        self.metrics_combo.setCurrentIndex(sinks.index(sink) if sink in sinks else 0)
+        metrics_label.setBuddy(self.metrics_combo)
+        metrics_layout.addWidget(self.metrics_combo)
+        metrics_layout.addStretch(1)
+
+        self.profile_checkbox = QCheckBox('Profile downloads (slower, for troubleshooting)', self)
+        self.profile_checkbox.setToolTip('When checked, every search, book page and cover download is run under\n'
+                                         'the Python profiler. The combined profile is saved as a .pstats file in\n'
+                                         'the shelfari_cache/profiles folder of calibre\'s configuration directory\n'
+                                         'and the slowest functions are listed in the download log.')
+        self.profile_checkbox.setChecked(c.get(KEY_PROFILE, DEFAULT_STORE_VALUES[KEY_PROFILE]))
+        other_group_box_layout.addWidget(self.profile_checkbox)
 
         self.edit_table.populate_table(c[KEY_GENRE_MAPPINGS])
 
@@ -290,11 +319,23 @@ class ConfigWidget(DefaultConfigWidget):
         new_prefs[KEY_GET_EDITIONS] = self.get_editions_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_GET_ALL_AUTHORS] = self.all_authors_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_GENRE_MAPPINGS] = self.edit_table.get_data()
+        new_prefs[KEY_MAX_WORKERS] = self.max_workers_spin.value()
+        new_prefs[KEY_CACHE_HOURS] = self.cache_hours_spin.value()
+        new_prefs[KEY_METADATA_CACHE_DAYS] = self.metadata_days_spin.value()
+        new_prefs[KEY_FETCH_ENGINE] = self.fetch_engine_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_REQUESTS_PER_SECOND] = self.rate_spin.value()
+        new_prefs[KEY_ADAPT_RATE] = self.adapt_rate_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_EARLY_RETURN] = self.early_return_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_METRICS_SINK] = METRICS_SINKS[self.metrics_combo.currentIndex()][0]
+        new_prefs[KEY_PROFILE] = self.profile_checkbox.checkState() == Qt.Checked
         plugin_prefs[STORE_NAME] = new_prefs
+        invalidate_prefs()
 
     def add_mapping(self):
         new_genre_name, ok = QInputDialog.getText(self, 'Add new mapping',
-                    'Enter a Shelfari genre name to create a mapping for:', text='')
+                    'Enter a Shelfari genre name to create a mapping for\n'
+                    '(e.g. "Paranormal > Vampires", use * for any one level and end\n'
+                    'with ** to include every genre below, e.g. "Paranormal > **"):', text='')
         if not ok:
             # Operation cancelled
             return
@@ -325,7 +366,9 @@ class ConfigWidget(DefaultConfigWidget):
         if not selected_genre:
             return
         new_genre_name, ok = QInputDialog.getText(self, 'Add new mapping',
-                    'Enter a Shelfari genre name to create a mapping for:', text=selected_genre)
+                    'Enter a Shelfari genre name to create a mapping for\n'
+                    '(e.g. "Paranormal > Vampires", use * for any one level and end\n'
+                    'with ** to include every genre below, e.g. "Paranormal > **"):', text=selected_genre)
         if not ok:
             # Operation cancelled
             return
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import zlib, socket, httplib, time
+from threading import Lock, Condition
+from urllib2 import URLError
+from urlparse import urlsplit, urljoin
+
+from calibre_plugins.shelfari.flight import Aborted
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class HTTPError(Exception):
+
+    '''
+    A non 2xx response, with the getcode() the rest of the plugin already
+    checks mechanize errors for
+    '''
+
+    def __init__(self, url, code, response=None):
+        Exception.__init__(self, 'HTTP Error %d: %s' % (code, url))
+        self.url, self.code, self.response = url, code, response
+
+    def getcode(self):
+        return self.code
+
+
+class Headers(dict):
+
+    # Header names are stored lower cased
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+    getheader = get
+
+
+class PooledResponse(object):
+
+    '''
+    A response read from a pooled connection. Its connection goes back to the
+    pool once the body has been read to the end, or is dropped if the reader
+    stops early.
+    '''
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool, self._key, self._conn = pool, key, conn
+        self._response, self.url = response, url
+        self.code = response.status
+        self.headers = Headers((name.lower(), value) for name, value in response.getheaders())
+        self._decoder = None
+        if self.headers.get('content-encoding', '').lower() == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._released = False
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        if self._released:
+            return b''
+        while True:
+            data = self._response.read() if size is None or size < 0 else self._response.read(size)
+            if self._decoder is not None:
+                data = self._decoder.decompress(data)
+                if self._response.isclosed():
+                    data += self._decoder.flush()
+            if self._response.isclosed():
+                self._release(reusable=True)
+                return data
+            # A gzip chunk can end inside the header or a deflate block and
+            # decompress to nothing, which callers would take for the end
+            if data:
+                return data
+
+    def close(self):
+        if not self._released:
+            self._release(reusable=self._response.isclosed())
+
+    def _release(self, reusable):
+        self._released = True
+        reusable = reusable and not self._response.will_close
+        self._pool.release(self._key, self._conn, reusable)
+
+
+class ConnectionPool(object):
+
+    '''
+    Keep-alive HTTP connections shared by every download the plugin makes,
+    with at most max_per_host open to any one host at a time. Callers wait in
+    open(), for up to their timeout, while all of a host's connections are
+    busy.
+
+    proxies maps a url scheme to the 'host:port' of the proxy to send those
+    requests through, as returned by calibre.get_proxies(). https requests are
+    tunnelled through their proxy with CONNECT.
+
+    Unlike calibre's browser() there is no cookie jar, and https connections
+    use the default certificate handling of httplib.
+    '''
+
+    def __init__(self, user_agent=None, max_per_host=4, proxies=None):
+        self.user_agent, self.max_per_host = user_agent, max_per_host
+        self.proxies = proxies or {}
+        self.requests = self.connections_opened = 0
+        self._lock = Lock()
+        self._freed = Condition(self._lock)
+        self._idle = {}
+        self._busy = {}
+
+    def _acquire(self, key, timeout, abort=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._busy.get(key, 0) >= self.max_per_host:
+                if abort is not None and abort.is_set():
+                    raise Aborted('Aborted')
+                wait = 0.25
+                if deadline is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        raise URLError(socket.timeout(
+                            'timed out waiting for a connection to %s' % key[1]))
+                self._freed.wait(min(wait, 0.25))
+            self._busy[key] = self._busy.get(key, 0) + 1
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.connections_opened += 1
+        scheme, host, port, tunnel = key
+        cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        conn = cls(host, port, timeout=timeout)
+        if tunnel is not None:
+            conn.set_tunnel(*tunnel)
+        return conn, False
+
+    def release(self, key, conn, reusable):
+        if not reusable:
+            conn.close()
+        with self._lock:
+            if reusable:
+                self._idle.setdefault(key, []).append(conn)
+            self._busy[key] -= 1
+            self._freed.notify_all()
+
+    def open(self, url, headers=None, method='GET', timeout=30, redirects=5,
+            abort=None):
+        '''
+        Request url, following redirects, and return a PooledResponse. Non 2xx
+        responses raise HTTPError and network failures raise URLError, like
+        urllib2 does. Waiting longer than timeout for a free connection to the
+        host raises URLError too, and Aborted is raised if abort is set while
+        waiting.
+        '''
+        while True:
+            parts = urlsplit(url)
+            scheme = parts.scheme or 'http'
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            target = (parts.hostname, parts.port or (443 if scheme == 'https' else 80))
+            proxy = self.proxies.get(scheme)
+            if proxy:
+                proxy = proxy.partition('://')[2] or proxy
+                host, sep, port = proxy.rpartition(':') if ':' in proxy else (proxy, '', '')
+                if scheme == 'https':
+                    # https goes through a CONNECT tunnel to the real host
+                    key = ('https', host, int(port or 80), target)
+                else:
+                    # Plain http proxies take the whole url as the request path
+                    key = ('http', host, int(port or 80), None)
+                    path = url
+            else:
+                key = (scheme, target[0], target[1], None)
+
+            request_headers = {'Accept-Encoding': 'gzip'}
+            if self.user_agent:
+                request_headers['User-Agent'] = self.user_agent
+            request_headers.update(headers or {})
+
+            response = self._request(key, method, path, request_headers, timeout, abort)
+            location = response.headers.get('location')
+            if response.code in (301, 302, 303, 307) and location and redirects:
+                response.read()
+                response.close()
+                url, redirects = urljoin(url, location), redirects - 1
+                if response.code == 303:
+                    method = 'GET'
+                continue
+            if not 200 <= response.code < 300:
+                response.read()
+                response.close()
+                raise HTTPError(url, response.code, response)
+            response.url = url
+            return response
+
+    def _request(self, key, method, path, headers, timeout, abort):
+        for attempt in (0, 1):
+            conn, reused = self._acquire(key, timeout, abort)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error) as e:
+                self.release(key, conn, False)
+                if reused and attempt == 0 and not isinstance(e, socket.timeout):
+                    # The server closed the idle keep-alive connection, send
+                    # the request again on a fresh one
+                    continue
+                raise URLError(e)
+            except:
+                self.release(key, conn, False)
+                raise
+            with self._lock:
+                self.requests += 1
+            return PooledResponse(self, key, conn, response, None)
+
+    def stats_text(self):
+        reused = self.requests - self.connections_opened
+        ratio = 100 * reused / self.requests if self.requests else 0
+        return 'Connection pool: %d requests over %d connections (%.0f%% reused)' % (
+                self.requests, self.connections_opened, ratio)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import re, os, hashlib
+from collections import OrderedDict
+from threading import Lock
+
+from calibre_plugins.shelfari.cache import normalize_url
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+# The size modifier in Amazon image urls, e.g. the ._SX150_ in
+# 51Kq0abcdeL._SX150_.jpg, without which the full size image is served
+RE_IMAGE_SIZE = re.compile(r'\._[A-Z0-9_,]+_(?=\.[A-Za-z]+$)')
+
+
+def renditions(url):
+    '''
+    The urls worth trying for the cover at url, largest rendition first
+    '''
+    full_size = RE_IMAGE_SIZE.sub('', url)
+    return [full_size, url] if full_size != url else [url]
+
+
+def probe_size(open_url, url, timeout):
+    '''
+    Find how many bytes the image at url is without downloading it, using a
+    HEAD request or failing that a one byte range request. Returns (size,
+    data) where data is the whole image if the server ignored the range and
+    sent it anyway, and size is None if the server would not say. Raises if
+    url is not an image.
+
+    open_url(url, headers, timeout, method) makes the requests.
+    '''
+    response = open_url(url, {}, timeout, 'HEAD')
+    response.read()
+    headers = response.info()
+    if not headers.get('content-type', 'image/').startswith('image/'):
+        raise ValueError('Not an image: %s' % url)
+    if headers.get('content-length'):
+        return int(headers.get('content-length')), None
+
+    response = open_url(url, {'Range': 'bytes=0-0'}, timeout, 'GET')
+    data = response.read()
+    if response.getcode() == 206:
+        # e.g. Content-Range: bytes 0-0/34567
+        total = response.info().get('content-range', '').rpartition('/')[2]
+        return (int(total) if total.isdigit() else None), None
+    return len(data), data
+
+
+class CoverCache(object):
+
+    '''
+    Content addressed on disk cache of cover images. Each image is stored
+    once under the sha1 of its bytes, however many urls (or editions) it was
+    downloaded for, and each url refers to its image by that digest. The
+    total size of the images is kept under max_size bytes by evicting the
+    least recently used.
+    '''
+
+    def __init__(self, cache_dir, max_size=100*1024*1024):
+        self.cache_dir, self.max_size = cache_dir, max_size
+        self.hits = self.misses = 0
+        self._lock = Lock()
+        self._index = None
+        self._total_size = 0
+
+    def _ref_path(self, url):
+        key = hashlib.sha1(normalize_url(url).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'refs', key)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, 'blobs', digest)
+
+    def _load_index(self):
+        # Called with the lock held. Rebuild the LRU order from the access
+        # times we left on the images last time calibre ran.
+        if self._index is not None:
+            return
+        self._index = OrderedDict()
+        self._total_size = 0
+        for sub in ('refs', 'blobs'):
+            if not os.path.exists(os.path.join(self.cache_dir, sub)):
+                os.makedirs(os.path.join(self.cache_dir, sub))
+        entries = []
+        for digest in os.listdir(os.path.join(self.cache_dir, 'blobs')):
+            try:
+                stat = os.stat(self._blob_path(digest))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, digest, stat.st_size))
+        for mtime, digest, size in sorted(entries):
+            self._index[digest] = size
+            self._total_size += size
+
+    def get(self, url):
+        '''
+        The cached image for url, or None
+        '''
+        with self._lock:
+            self._load_index()
+            try:
+                with open(self._ref_path(url), 'rb') as f:
+                    digest = f.read().decode('ascii')
+                if digest in self._index:
+                    with open(self._blob_path(digest), 'rb') as f:
+                        data = f.read()
+                    self._touch(digest)
+                    self.hits += 1
+                    return data
+            except (IOError, OSError):
+                pass
+            self.misses += 1
+            return None
+
+    def put(self, url, data):
+        digest = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            self._load_index()
+            if digest not in self._index:
+                self._write(self._blob_path(digest), data)
+                self._index[digest] = len(data)
+                self._total_size += len(data)
+            else:
+                self._touch(digest)
+            self._write(self._ref_path(url), digest.encode('ascii'))
+            self._evict()
+
+    def _write(self, path, data):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+    def _touch(self, digest):
+        self._index[digest] = self._index.pop(digest)
+        try:
+            os.utime(self._blob_path(digest), None)
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Urls referring to an evicted image are just misses from then on
+        while self._total_size > self.max_size and len(self._index) > 1:
+            digest, size = self._index.popitem(last=False)
+            self._total_size -= size
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+
+    def stats_text(self):
+        return 'Cover cache: %d hits, %d misses' % (self.hits, self.misses)
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import time, zlib, socket, asyncore, traceback
+from collections import deque
+from io import BytesIO
+from threading import Thread, Lock, Event
+from urllib2 import URLError
+from urlparse import urlsplit, urljoin
+
+from calibre_plugins.shelfari.connpool import HTTPError, Headers
+from calibre_plugins.shelfari.flight import Aborted
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class Response(object):
+
+    '''
+    A completed response, looking enough like a mechanize response for the
+    code that reads it
+    '''
+
+    def __init__(self, url, code, headers, body):
+        self.url, self.code, self.headers = url, code, headers
+        self._body = BytesIO(body)
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+    def close(self):
+        pass
+
+
+class Request(object):
+
+    def __init__(self, method, url, headers, timeout, callback, redirects=5, log=None,
+            cancelled=None):
+        self.method, self.url, self.headers = method, url, headers or {}
+        self.deadline = time.time() + timeout
+        self.callback, self.redirects, self.log = callback, redirects, log
+        self.cancelled = cancelled
+        self.retried = False
+        self.address = None
+        parts = urlsplit(url)
+        self.scheme = parts.scheme.lower()
+        self.netloc = parts.netloc
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.key = (parts.hostname, parts.port or 80)
+
+
+class Trigger(asyncore.dispatcher):
+
+    '''
+    A connected socket pair that lets other threads wake the event loop when
+    they queue a request
+    '''
+
+    def __init__(self, map):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self._writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._writer.connect(listener.getsockname())
+        reader = listener.accept()[0]
+        listener.close()
+        asyncore.dispatcher.__init__(self, reader, map=map)
+        self._lock = Lock()
+
+    def pull(self):
+        with self._lock:
+            try:
+                self._writer.send(b'x')
+            except socket.error:
+                pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except socket.error:
+            pass
+
+
+class Connection(asyncore.dispatcher):
+
+    '''
+    One keep-alive HTTP/1.1 connection to a host, carrying one request at a
+    time
+    '''
+
+    def __init__(self, engine, key, address, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.engine, self.key = engine, key
+        self.request = None
+        self.requests_sent = 0
+        self._out = self._in = b''
+        # address is already resolved, so connecting never blocks the loop
+        # on a DNS lookup
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def send_request(self, request):
+        self.request = request
+        self.requests_sent += 1
+        self._state, self._received = 'head', False
+        self._code, self._headers, self._body = None, Headers(), []
+        self._length = self._chunked = None
+        lines = ['%s %s HTTP/1.1' % (request.method, request.path),
+                 'Host: %s' % request.netloc,
+                 'Accept-Encoding: gzip',
+                 'Connection: keep-alive']
+        if self.engine.user_agent:
+            lines.append('User-Agent: %s' % self.engine.user_agent)
+        lines.extend('%s: %s' % header for header in request.headers.items())
+        self._out = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(64 * 1024)
+        if not data:
+            return
+        if self.request is None:
+            # Nothing should arrive on an idle connection
+            return self.handle_close()
+        self._received = True
+        self._in += data
+        self._parse()
+
+    def handle_close(self):
+        if self.request is not None and self._state == 'body' and \
+                self._length is None and not self._chunked:
+            # The body of this response runs until the server hangs up
+            self._body.append(self._in)
+            self._finish(keep_alive=False)
+        else:
+            self.engine.connection_lost(self, None)
+        self.close()
+
+    def handle_error(self):
+        self.engine.connection_lost(self, URLError(traceback.format_exc()))
+        self.close()
+
+    def _parse(self):
+        while self.request is not None:
+            if self._state == 'head':
+                end = self._in.find(b'\r\n\r\n')
+                if end < 0:
+                    return
+                head, self._in = self._in[:end], self._in[end+4:]
+                lines = head.decode('latin-1').split('\r\n')
+                self._code = int(lines[0].split(None, 2)[1])
+                if 100 <= self._code < 200:
+                    continue
+                for line in lines[1:]:
+                    name, sep, value = line.partition(':')
+                    self._headers[name.strip().lower()] = value.strip()
+                if self.request.method == 'HEAD' or self._code in (204, 304):
+                    self._length = 0
+                elif self._headers.get('transfer-encoding', '').lower() == 'chunked':
+                    self._chunked, self._length = True, None
+                elif self._headers.get('content-length'):
+                    self._length = int(self._headers.get('content-length'))
+                self._state = 'body'
+            elif self._chunked:
+                end = self._in.find(b'\r\n')
+                if end < 0:
+                    return
+                size = int(self._in[:end].split(b';')[0], 16)
+                if size == 0:
+                    # Ignore any trailers, we never ask for them
+                    if self._in.find(b'\r\n\r\n', end) < 0:
+                        return
+                    return self._finish()
+                if len(self._in) < end + 2 + size + 2:
+                    return
+                self._body.append(self._in[end+2:end+2+size])
+                self._in = self._in[end+2+size+2:]
+            elif self._length is not None:
+                if len(self._in) < self._length:
+                    return
+                self._body.append(self._in[:self._length])
+                return self._finish()
+            else:
+                self._body.append(self._in)
+                self._in = b''
+                return
+
+    def _finish(self, keep_alive=True):
+        body = b''.join(self._body)
+        if self._headers.get('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        keep_alive = keep_alive and self._headers.get('connection', '').lower() != 'close'
+        request, self.request, self._in = self.request, None, b''
+        self.engine.completed(self, request, self._code, self._headers, body, keep_alive)
+        if not keep_alive:
+            self.close()
+
+
+class AsyncFetchEngine(object):
+
+    '''
+    Runs every request on one event loop thread over keep-alive connections,
+    at most max_per_host of them to each host. Requests in flight cost
+    no thread of their own.
+
+    fetch() queues a request from any thread and calls callback(response,
+    error) on the loop thread when it completes, so callbacks should hand
+    real work to another thread. fetch_sync() blocks the calling thread, for
+    no longer than the request's timeout.
+
+    Only plain http without a proxy is spoken: check can_fetch() and send
+    anything else (https, or any url when an http proxy is configured) down
+    a blocking path instead. Host names are resolved on the calling thread
+    and remembered for DNS_TTL seconds, so the loop only ever blocks on DNS
+    for a redirect to a host it has not seen recently. An exception raised
+    by a callback is reported to the log passed to fetch(), and counted in
+    stats_text().
+    '''
+
+    #: Seconds a resolved host address is reused for
+    DNS_TTL = 300
+
+    def __init__(self, user_agent=None, max_per_host=4, tick=0.25, proxies=None):
+        self.user_agent, self.max_per_host, self.tick = user_agent, max_per_host, tick
+        self.proxies = proxies or {}
+        self.connections_opened = self.requests_sent = self.callback_errors = 0
+        self.cancelled = 0
+        self._map = {}
+        self._hosts = {}
+        self._addresses = {}
+        self._incoming = deque()
+        self._lock = Lock()
+        self._thread = self._trigger = None
+
+    def can_fetch(self, url):
+        '''
+        True if url can go through the engine rather than a blocking opener
+        '''
+        return urlsplit(url).scheme.lower() == 'http' and 'http' not in self.proxies
+
+    def _resolve(self, key):
+        now = time.time()
+        with self._lock:
+            cached = self._addresses.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        host, port = key
+        address = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        with self._lock:
+            self._addresses[key] = (address, now + self.DNS_TTL)
+        return address
+
+    def _prepare(self, request):
+        '''
+        Resolve request's host, or fail it, before it reaches the loop
+        '''
+        if request.scheme != 'http' or 'http' in self.proxies:
+            error = URLError('The fetch engine cannot open %s' % request.url)
+        else:
+            try:
+                request.address = self._resolve(request.key)
+                return True
+            except socket.error as e:
+                error = URLError(e)
+        self._callback(request, None, error)
+        return False
+
+    def fetch(self, url, callback, headers=None, method='GET', timeout=30, log=None,
+            cancelled=None):
+        '''
+        Queue a request for url. A url the engine cannot fetch, or whose host
+        cannot be resolved, fails straight away: callback is then called
+        with the error on the calling thread.
+
+        cancelled is an optional function the loop calls every tick while
+        the request is waiting or in flight. Once it returns True the
+        request is dropped, closing its connection if it had been sent, and
+        fails with a URLError.
+        '''
+        request = Request(method, url, headers, timeout, callback, log=log,
+                cancelled=cancelled)
+        if not self._prepare(request):
+            return
+        self._submit(request)
+
+    def _submit(self, request):
+        with self._lock:
+            self._incoming.append(request)
+            if self._thread is None:
+                self._trigger = Trigger(self._map)
+                self._thread = Thread(target=self._run, name='Shelfari fetch engine')
+                self._thread.daemon = True
+                self._thread.start()
+        self._trigger.pull()
+
+    def fetch_sync(self, url, headers=None, method='GET', timeout=30, log=None,
+            abort=None):
+        '''
+        Fetch url and wait for the response. The loop fails the request once
+        its timeout has passed; should it not have called back a couple of
+        ticks later the wait is given up on with a URLError anyway. Setting
+        abort gives it up straight away with Aborted. Either way the request
+        is cancelled.
+        '''
+        done, given_up, result = Event(), Event(), []
+
+        def callback(response, error):
+            result.append((response, error))
+            done.set()
+
+        self.fetch(url, callback, headers=headers, method=method, timeout=timeout,
+                log=log, cancelled=given_up.is_set)
+        deadline = time.time() + timeout + 2 * self.tick
+        while not done.wait(self.tick):
+            if abort is not None and abort.is_set():
+                given_up.set()
+                raise Aborted('Aborted')
+            if time.time() > deadline:
+                given_up.set()
+                raise URLError(socket.timeout('timed out'))
+        response, error = result[0]
+        if error is not None:
+            raise error
+        return response
+
+    def stats_text(self):
+        text = 'Fetch engine: %d requests over %d connections' % (self.requests_sent,
+                self.connections_opened)
+        if self.cancelled:
+            text += ', %d cancelled' % self.cancelled
+        if self.callback_errors:
+            text += ', %d failed callbacks' % self.callback_errors
+        return text
+
+    def _run(self):
+        while True:
+            asyncore.loop(timeout=self.tick, map=self._map, count=1)
+            with self._lock:
+                incoming, self._incoming = self._incoming, deque()
+            for request in incoming:
+                self._queue(request)
+            self._expire()
+
+    def _host(self, key):
+        if key not in self._hosts:
+            self._hosts[key] = {'idle': [], 'busy': set(), 'pending': deque()}
+        return self._hosts[key]
+
+    def _queue(self, request, first=False):
+        host = self._host(request.key)
+        if first:
+            host['pending'].appendleft(request)
+        else:
+            host['pending'].append(request)
+        self._assign(request.key)
+
+    def _assign(self, key):
+        host = self._host(key)
+        while host['pending']:
+            if host['idle']:
+                conn = host['idle'].pop()
+            elif len(host['busy']) < self.max_per_host:
+                try:
+                    conn = Connection(self, key, host['pending'][0].address, self._map)
+                except socket.error as e:
+                    self._callback(host['pending'].popleft(), None, URLError(e))
+                    continue
+                self.connections_opened += 1
+            else:
+                return
+            host['busy'].add(conn)
+            conn.send_request(host['pending'].popleft())
+            self.requests_sent += 1
+
+    def _callback(self, request, response, error):
+        try:
+            request.callback(response, error)
+        except:
+            self.callback_errors += 1
+            if request.log is not None:
+                request.log.exception('Fetch engine callback failed for: %r' % request.url)
+            else:
+                traceback.print_exc()
+
+    def completed(self, conn, request, code, headers, body, keep_alive):
+        host = self._host(conn.key)
+        host['busy'].discard(conn)
+        if keep_alive:
+            host['idle'].append(conn)
+        location = headers.get('location')
+        if code in (301, 302, 303, 307) and location and request.redirects:
+            redirect = Request('GET' if code == 303 else request.method,
+                    urljoin(request.url, location), request.headers,
+                    max(0, request.deadline - time.time()), request.callback,
+                    request.redirects - 1, request.log, request.cancelled)
+            # A redirect to another host is resolved here, on the loop, but
+            # only once per DNS_TTL
+            if self._prepare(redirect):
+                self._queue(redirect)
+        else:
+            response = Response(request.url, code, headers, body)
+            if 200 <= code < 300:
+                self._callback(request, response, None)
+            else:
+                self._callback(request, None, HTTPError(request.url, code, response))
+        self._assign(conn.key)
+
+    def connection_lost(self, conn, error):
+        host = self._host(conn.key)
+        host['busy'].discard(conn)
+        if conn in host['idle']:
+            host['idle'].remove(conn)
+        request, conn.request = conn.request, None
+        if request is not None:
+            if conn.requests_sent > 1 and not conn._received and not request.retried:
+                # The server dropped a keep-alive connection we were reusing
+                # before it saw our request, so it is safe to send it again
+                request.retried = True
+                self._queue(request, first=True)
+            else:
+                self._callback(request, None, error or
+                        URLError('Connection closed by %s:%s' % conn.key))
+        self._assign(conn.key)
+
+    def _expire(self):
+        now = time.time()
+        for key, host in self._hosts.items():
+            for conn in list(host['busy']):
+                error = conn.request is not None and self._expired(conn.request, now)
+                if error:
+                    request, conn.request = conn.request, None
+                    host['busy'].discard(conn)
+                    conn.close()
+                    self._callback(request, None, error)
+            for request in list(host['pending']):
+                error = self._expired(request, now)
+                if error:
+                    host['pending'].remove(request)
+                    self._callback(request, None, error)
+            self._assign(key)
+
+    def _expired(self, request, now):
+        '''
+        The error to fail request with if it timed out or was cancelled
+        '''
+        if request.deadline < now:
+            return URLError(socket.timeout('timed out'))
+        if request.cancelled is not None and request.cancelled():
+            self.cancelled += 1
+            return URLError('Cancelled')
+        return None
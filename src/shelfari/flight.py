@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+from threading import Lock, Event
+from urllib2 import URLError
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class Aborted(URLError):
+
+    '''
+    Raised by work that was given up on because the abort of the caller
+    doing it was set. Callers who were sharing that work did not ask for it
+    to stop, so they do it again themselves instead of failing.
+    '''
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.result = self.error = None
+        self.done = Event()
+
+
+class AsyncFlight(object):
+
+    '''
+    The callers waiting on one piece of SingleFlight.do_async() work, as
+    (callback, cancelled) pairs
+    '''
+
+    def __init__(self, owner, key, failed):
+        self.owner, self.key, self.failed = owner, key, failed
+        self.waiters = []
+
+    def is_set(self):
+        '''
+        Call back the waiters that have been cancelled, and return True once
+        no one is waiting for the work any more
+        '''
+        with self.owner._lock:
+            dropped = [w for w in self.waiters if w[1] is not None and w[1]()]
+        if dropped:
+            self.owner._call_back(self.owner._detach(self, dropped),
+                    self.failed(Aborted('Cancelled')))
+        with self.owner._lock:
+            return not self.waiters
+
+
+class SingleFlight(object):
+
+    '''
+    Lets concurrent callers asking for the same thing share one piece of
+    work. The first caller for a key does it, and anyone asking for that key
+    while it is in progress waits for and gets the same result (or error),
+    except for Aborted which only the caller that aborted sees. Nothing is
+    remembered once the work is done, that is the caches' job.
+
+    Keys are tuples starting with the kind of work, which the hit counts
+    are broken down by.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flights = {}
+        self._waiters = {}
+        self.calls, self.shared = {}, {}
+
+    def _count(self, key, shared):
+        # Called with the lock held
+        counts = self.shared if shared else self.calls
+        counts[key[0]] = counts.get(key[0], 0) + 1
+
+    def do(self, key, fn, *args, **kwargs):
+        '''
+        Return (fn(*args, **kwargs), shared), where shared is True if the
+        result came from another caller's call. If that call was aborted
+        this caller makes its own call instead.
+        '''
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = Flight()
+                self._count(key, not leader)
+            if leader:
+                break
+            flight.done.wait()
+            if isinstance(flight.error, Aborted):
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn(*args, **kwargs)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def do_async(self, key, callback, start, failed=None, cancelled=None):
+        '''
+        The callback based version of do(), for work that finishes on another
+        thread. start(done, flight) is called for the first caller only and
+        must call done(*result) once, which then calls callback(*result) for
+        every caller still waiting.
+
+        cancelled is an optional function returning True once this caller no
+        longer wants the result. The work should treat flight as its abort:
+        flight.is_set() calls back the callers that have been cancelled
+        straight away, with Aborted, and is True once none are left waiting.
+
+        If start raises, every caller gets callback(*failed(error)) instead,
+        failed defaulting to giving (None, error). The key is free for new
+        work as soon as done is called, start raises or every caller has
+        been cancelled.
+        '''
+        failed = failed or (lambda e: (None, e))
+        with self._lock:
+            flight = self._waiters.get(key)
+            self._count(key, flight is not None)
+            if flight is not None:
+                flight.waiters.append((callback, cancelled))
+                return
+            flight = self._waiters[key] = AsyncFlight(self, key, failed)
+            flight.waiters.append((callback, cancelled))
+
+        def done(*result):
+            self._call_back(self._detach(flight), result)
+
+        try:
+            start(done, flight)
+        except Exception as e:
+            done(*failed(e))
+
+    def _detach(self, flight, waiters=None):
+        '''
+        Take waiters, or all of them, off flight and return them, freeing the
+        key once nobody is left waiting on it
+        '''
+        with self._lock:
+            if waiters is None:
+                waiters, flight.waiters = flight.waiters, []
+            else:
+                flight.waiters = [w for w in flight.waiters if w not in waiters]
+            if not flight.waiters and self._waiters.get(flight.key) is flight:
+                del self._waiters[flight.key]
+        return waiters
+
+    def _call_back(self, waiters, result):
+        errors = []
+        for callback, cancelled in waiters:
+            try:
+                callback(*result)
+            except Exception as e:
+                # Still call back everyone else that is waiting
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def stats_text(self):
+        kinds = sorted(set(self.calls) | set(self.shared))
+        return 'Single flight: ' + ', '.join('%s %d shared of %d' % (kind,
+            self.shared.get(kind, 0), self.calls.get(kind, 0) + self.shared.get(kind, 0))
+            for kind in kinds)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+from collections import OrderedDict
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+SEPARATOR = '>'
+# Matches any one segment of a genre path
+WILDCARD = '*'
+# As the last segment, matches the genre path so far and everything below it
+PREFIX = '**'
+
+
+def split_genre(genre):
+    return [segment.strip().lower() for segment in genre.split(SEPARATOR)]
+
+
+class Node(object):
+
+    __slots__ = ('children', 'tags', 'prefix_tags')
+
+    def __init__(self):
+        self.children = {}
+        self.tags = self.prefix_tags = ()
+
+
+class GenreMapper(object):
+
+    '''
+    Genre to calibre tag mappings compiled into a trie over the ' > '
+    separated segments of the Shelfari genre path, so converting a book's
+    genres costs a walk down the trie per genre however many mappings there
+    are. Segments are compared case insensitively.
+
+    Besides plain paths like 'Paranormal > Vampires' a mapping can use * for
+    any one segment, as in '* > Vampires', and end in ** to also match every
+    genre below it, as in 'Paranormal > **'.
+    '''
+
+    #: Distinct genres whose tags are remembered
+    MAX_MEMO = 10000
+
+    def __init__(self, mappings):
+        self._root = Node()
+        for genre, tags in mappings.iteritems():
+            segments = split_genre(genre)
+            prefix = segments[-1] == PREFIX
+            if prefix:
+                segments.pop()
+            node = self._root
+            for segment in segments:
+                node = node.children.setdefault(segment, Node())
+            if prefix:
+                node.prefix_tags += tuple(tags)
+            else:
+                node.tags += tuple(tags)
+        self._memo = {}
+
+    def lookup(self, genre):
+        '''
+        The tags for one genre path, most specific mapping first
+        '''
+        tags = self._memo.get(genre)
+        if tags is not None:
+            return tags
+        nodes, below = [self._root], []
+        for segment in split_genre(genre):
+            children = []
+            for node in nodes:
+                if node.prefix_tags:
+                    below.append(node.prefix_tags)
+                for key in (segment, WILDCARD):
+                    child = node.children.get(key)
+                    if child is not None:
+                        children.append(child)
+            nodes = children
+        found = [node.tags for node in nodes] + [node.prefix_tags for node in nodes]
+        tags = tuple(tag for group in found + below[::-1] for tag in group)
+        if len(self._memo) >= self.MAX_MEMO:
+            self._memo.clear()
+        self._memo[genre] = tags
+        return tags
+
+    def tags_for(self, genres):
+        '''
+        The calibre tags for a list of genre paths, in order and without
+        duplicates
+        '''
+        tags = OrderedDict()
+        for genre in genres:
+            for tag in self.lookup(genre):
+                tags[tag] = True
+        return list(tags)
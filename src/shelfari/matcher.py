@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import re
+from bisect import bisect_left
+
+from calibre.utils.icu import lower
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+RE_WORD = re.compile(r'\w+', re.UNICODE)
+
+# How much the title and the authors count towards a row's score
+TITLE_WEIGHT = 0.7
+AUTHOR_WEIGHT = 0.3
+# How much a query token counts when it only starts a word of the row, e.g.
+# "hobbit" in "The Hobbits", rather than being a whole word of it
+PREFIX_WEIGHT = 0.5
+
+
+def tokenize(text):
+    return RE_WORD.findall(lower(text))
+
+
+class QueryMatcher(object):
+
+    '''
+    Scores search result rows against the title and author tokens of a query.
+
+    The query is normalized once when the matcher is made. score_rows() then
+    lower cases and tokenizes each row once, indexes which rows contain each
+    token and looks every query token up in that index, so the cost is one
+    pass over the rows rather than a substring scan per query token per row.
+
+    A row's score is the Dice similarity of its title tokens with the query
+    title tokens, and likewise for the authors, weighted by TITLE_WEIGHT and
+    AUTHOR_WEIGHT. A query token that is not a word of the row but starts
+    one counts PREFIX_WEIGHT towards it. As before a row only matches at all
+    if a title token and an author token of the query (when it has any) are
+    found in it, but only at the start of a word where the substring search
+    used to find them anywhere.
+    '''
+
+    def __init__(self, title_tokens, author_tokens):
+        self.title_tokens = self._normalize(title_tokens)
+        self.author_tokens = self._normalize(author_tokens)
+
+    def _normalize(self, tokens):
+        normalized = set()
+        for token in tokens:
+            normalized.update(tokenize(token))
+        return frozenset(normalized)
+
+    def _similarity(self, query, rows, field):
+        '''
+        Dice similarity of the query tokens with field (0 for the title, 1
+        for the authors) of each row, and whether any query token was found
+        in the row. An empty query matches everything equally.
+        '''
+        index, sizes = {}, []
+        for i, row in enumerate(rows):
+            tokens = set(tokenize(row[field]))
+            sizes.append(len(tokens))
+            for token in tokens:
+                index.setdefault(token, []).append(i)
+        if not query:
+            return [(1.0, True)] * len(rows)
+        vocabulary = sorted(index)
+        hits = [0] * len(rows)
+        for token in query:
+            found = dict.fromkeys(index.get(token, ()), 1)
+            # The words starting with token sort right after it
+            pos = bisect_left(vocabulary, token)
+            while pos < len(vocabulary) and vocabulary[pos].startswith(token):
+                for i in index[vocabulary[pos]]:
+                    found.setdefault(i, PREFIX_WEIGHT)
+                pos += 1
+            for i, weight in found.iteritems():
+                hits[i] += weight
+        return [(2.0 * h / (len(query) + size) if size else 0.0, h > 0)
+                for h, size in zip(hits, sizes)]
+
+    def score_rows(self, rows):
+        '''
+        rows is a sequence of (title, authors text) pairs. Returns a list of
+        scores between 0 and 1, in the same order, with None for the rows
+        that do not match the query at all.
+        '''
+        rows = list(rows)
+        titles = self._similarity(self.title_tokens, rows, 0)
+        authors = self._similarity(self.author_tokens, rows, 1)
+        scores = []
+        for (title_score, title_match), (author_score, author_match) in zip(titles, authors):
+            if title_match and author_match:
+                scores.append(TITLE_WEIGHT * title_score + AUTHOR_WEIGHT * author_score)
+            else:
+                scores.append(None)
+        return scores
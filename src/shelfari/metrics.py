@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import time, json
+from threading import Lock
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class Span(object):
+
+    '''
+    Times a with block and records it on metrics under name when it ends,
+    whether or not it raised
+    '''
+
+    __slots__ = ('metrics', 'name', 'tags', 'start')
+
+    def __init__(self, metrics, name, tags):
+        self.metrics, self.name, self.tags = metrics, name, tags
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.record(self.name, time.time() - self.start, **self.tags)
+
+
+class MemorySink(object):
+
+    '''
+    Aggregates the count, total, minimum and maximum seconds of every stage
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self.stages = {}
+
+    def emit(self, name, seconds, tags):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = [1, seconds, seconds, seconds]
+            else:
+                stage[0] += 1
+                stage[1] += seconds
+                stage[2] = min(stage[2], seconds)
+                stage[3] = max(stage[3], seconds)
+
+    def snapshot(self):
+        '''
+        {stage: (count, total, min, max)}
+        '''
+        with self._lock:
+            return dict((name, tuple(stage)) for name, stage in self.stages.items())
+
+    def summary_text(self):
+        lines = ['%-32s %7s %10s %10s %10s' % ('stage', 'count', 'total s', 'mean ms', 'max ms')]
+        for name, (count, total, low, high) in sorted(self.snapshot().items(),
+                key=lambda x: -x[1][1]):
+            lines.append('%-32s %7d %10.3f %10.2f %10.2f' % (name, count, total,
+                1000 * total / count, 1000 * high))
+        return '\n'.join(lines)
+
+    def flush(self):
+        pass
+
+
+class JsonLinesSink(object):
+
+    '''
+    Appends every span to path as a line of json, for offline analysis
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+
+    def emit(self, name, seconds, tags):
+        line = dict(tags, stage=name, seconds=round(seconds, 6), at=round(time.time(), 3))
+        data = (json.dumps(line, sort_keys=True) + '\n').encode('utf-8')
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                f.write(data)
+
+    def flush(self):
+        pass
+
+
+class PrometheusSink(MemorySink):
+
+    '''
+    Keeps the same aggregates as MemorySink and writes them to path in the
+    Prometheus text exposition format, for a node exporter textfile
+    collector to pick up. The file is rewritten at most every interval
+    seconds, and on flush().
+    '''
+
+    def __init__(self, path, interval=10):
+        MemorySink.__init__(self)
+        self.path, self.interval = path, interval
+        self._written = 0
+
+    def emit(self, name, seconds, tags):
+        MemorySink.emit(self, name, seconds, tags)
+        if time.time() - self._written >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self._written = time.time()
+        lines = ['# HELP shelfari_stage_seconds Time spent in each stage of a Shelfari lookup',
+                 '# TYPE shelfari_stage_seconds summary']
+        maxima = ['# HELP shelfari_stage_seconds_max Longest single run of each stage',
+                  '# TYPE shelfari_stage_seconds_max gauge']
+        for name, (count, total, low, high) in sorted(self.snapshot().items()):
+            label = '{stage="%s"}' % name.replace('\\', '\\\\').replace('"', '\\"')
+            lines.append('shelfari_stage_seconds_count%s %d' % (label, count))
+            lines.append('shelfari_stage_seconds_sum%s %.6f' % (label, total))
+            maxima.append('shelfari_stage_seconds_max%s %.6f' % (label, high))
+        tmp = self.path + '.tmp'
+        with self._lock:
+            with open(tmp, 'wb') as f:
+                f.write(('\n'.join(lines + maxima) + '\n').encode('utf-8'))
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+
+
+class Metrics(object):
+
+    '''
+    Collects timing spans for the stages of a lookup and passes each one to
+    every sink. The MemorySink in aggregate is always present, the others
+    are optional. sink_name is the preference the sinks were chosen by.
+    '''
+
+    def __init__(self, sinks=(), sink_name=None):
+        self.sink_name = sink_name
+        self.aggregate = MemorySink()
+        self.sinks = [self.aggregate] + list(sinks)
+
+    def span(self, name, **tags):
+        return Span(self, name, tags)
+
+    def record(self, name, seconds, **tags):
+        for sink in self.sinks:
+            try:
+                sink.emit(name, seconds, tags)
+            except (IOError, OSError):
+                # Never let a full disk break a metadata download
+                pass
+
+    def record_all(self, prefix, timings):
+        for name, seconds in timings.items():
+            self.record(prefix + name, seconds)
+
+    def flush(self):
+        for sink in self.sinks:
+            try:
+                sink.flush()
+            except (IOError, OSError):
+                pass
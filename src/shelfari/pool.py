@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import time
+from itertools import count
+from threading import Thread, Event, Lock, Condition, current_thread
+from Queue import PriorityQueue
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class Task(object):
+
+    '''
+    A unit of work submitted to a WorkerPool. Records how long it sat in the
+    queue and how long it took to run so callers can log per-task timings.
+    '''
+
+    def __init__(self, fn, args, kwargs, abort=None, name=None, callback=None,
+            priority=0, log=None):
+        self.fn, self.args, self.kwargs = fn, args, kwargs
+        self.abort, self.callback, self.priority = abort, callback, priority
+        self.name = name or getattr(fn, '__name__', 'task')
+        self.log = log
+        self.result = self.exception = self.callback_exception = None
+        self.cancelled = self._cancel = False
+        self.submitted_at = time.time()
+        self.started_at = self.finished_at = None
+        self._done = Event()
+
+    def run(self):
+        self.started_at = time.time()
+        try:
+            if self.cancel_requested:
+                # Calibre gave up on this lookup while we were queued, or we
+                # no longer need it, do not bother hitting the network for it
+                self.cancelled = True
+            else:
+                self.result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            self.exception = e
+        finally:
+            self.finished_at = time.time()
+            self._done.set()
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception as e:
+                # Never let a callback take the pool thread down with it
+                self.callback_exception = e
+                if self.log is not None:
+                    self.log.exception('Callback failed for task: %s' % self.name)
+
+    def cancel(self):
+        '''
+        Skip this task if it has not started yet. It still completes, and
+        its callback is still called, when it reaches the front of the queue.
+        '''
+        self._cancel = True
+        return self.started_at is None
+
+    @property
+    def cancel_requested(self):
+        '''
+        True once the task has been cancelled or its abort set, so work done
+        on its behalf before it runs can stop too
+        '''
+        return self._cancel or (self.abort is not None and self.abort.is_set())
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    @property
+    def queued_time(self):
+        if self.started_at is None:
+            return None
+        return self.started_at - self.submitted_at
+
+    @property
+    def run_time(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def timing_text(self):
+        if self.cancelled:
+            return '%s cancelled after %.3fs in queue' % (self.name, self.queued_time)
+        return '%s ran in %.3fs (queued %.3fs)' % (self.name, self.run_time or 0,
+                self.queued_time or 0)
+
+
+class Latch(object):
+
+    '''
+    Counts down as tasks finish, so a caller can sleep until the last of them
+    is done instead of waiting on each in turn. Pass count_down as the task
+    callback.
+    '''
+
+    #: Calibre's abort is a plain Event we cannot be woken by, so while tasks
+    #: are outstanding it is checked this often (seconds)
+    ABORT_CHECK_INTERVAL = 0.1
+
+    def __init__(self, count):
+        self.count = count
+        self.released_at = time.time() if count <= 0 else None
+        self._cond = Condition()
+
+    def count_down(self, task=None):
+        with self._cond:
+            self.count -= 1
+            if self.count <= 0:
+                self.release()
+
+    def release(self):
+        '''
+        Wake the waiter now, whatever is still outstanding
+        '''
+        with self._cond:
+            if self.released_at is None:
+                self.released_at = time.time()
+            self.count = min(self.count, 0)
+            self._cond.notify_all()
+
+    def wait(self, abort=None, timeout=None):
+        '''
+        Block until the count reaches zero, abort is set or timeout seconds
+        have passed. Returns True only if the count reached zero.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self.count > 0:
+                if abort is not None and abort.is_set():
+                    return False
+                wait = None if abort is None else self.ABORT_CHECK_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+        return True
+
+
+class ResultGate(object):
+
+    '''
+    Passes results on to a queue until closed, and drops them after that, so
+    tasks still running when identify returns cannot add results calibre is
+    no longer expecting.
+    '''
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.closed = False
+        self.dropped = 0
+        self._lock = Lock()
+
+    def put(self, item):
+        with self._lock:
+            if self.closed:
+                self.dropped += 1
+                return False
+            self.queue.put(item)
+            return True
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+
+
+class WorkerPool(object):
+
+    '''
+    A bounded pool of daemon threads shared by every lookup the plugin runs.
+
+    Threads are started lazily up to max_workers and then reused for the
+    lifetime of calibre, so bulk metadata downloads no longer create and tear
+    down a thread per book. How fast the tasks hit shelfari is up to the
+    plugin's RateLimiter, not the pool.
+    '''
+
+    def __init__(self, max_workers=4, name='Shelfari'):
+        self.max_workers = max(1, int(max_workers))
+        self.name = name
+        self._queue = PriorityQueue()
+        self._sequence = count()
+        self._threads = []
+        self._lock = Lock()
+        self._idle = 0
+
+    def submit(self, fn, *args, **kwargs):
+        '''
+        Queue fn(*args, **kwargs) to run on a pool thread. The optional abort,
+        name, callback and priority keyword arguments are consumed by the pool:
+        a task whose abort event is set before it starts is skipped without
+        running, callback(task) is called on the pool thread once the task is
+        done, queued tasks with a lower priority run first and an exception
+        raised by the callback is reported to log.
+        '''
+        return self.start(self.prepare(fn, *args, **kwargs))
+
+    def prepare(self, fn, *args, **kwargs):
+        '''
+        Create a task exactly as submit() would, but without queueing it yet.
+        Callers can wait() on it straight away and start() it later, for
+        example once the page it parses has been downloaded.
+        '''
+        priority = kwargs.pop('priority', 0)
+        abort = kwargs.pop('abort', None)
+        name = kwargs.pop('name', None)
+        callback = kwargs.pop('callback', None)
+        log = kwargs.pop('log', None)
+        return Task(fn, args, kwargs, abort=abort, name=name, callback=callback,
+                priority=priority, log=log)
+
+    def start(self, task):
+        task.submitted_at = time.time()
+        with self._lock:
+            if self._idle > 0:
+                self._idle -= 1
+            elif len(self._threads) < self.max_workers:
+                self._spawn()
+        self._queue.put((task.priority, next(self._sequence), task))
+        return task
+
+    def resize(self, max_workers):
+        with self._lock:
+            self.max_workers = max(1, int(max_workers))
+
+    def _spawn(self):
+        t = Thread(target=self._loop, name='%s worker %d' % (self.name, len(self._threads)))
+        t.daemon = True
+        self._threads.append(t)
+        t.start()
+
+    def _loop(self):
+        while True:
+            task = self._queue.get()[2]
+            try:
+                task.run()
+            finally:
+                with self._lock:
+                    if len(self._threads) > self.max_workers:
+                        # The pool was shrunk from the config dialog
+                        self._threads.remove(current_thread())
+                        return
+                    self._idle += 1
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import copy
+from threading import Lock
+
+from calibre.utils.config import JSONConfig
+
+from calibre_plugins.shelfari.genres import GenreMapper
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+STORE_NAME = 'Options'
+KEY_GET_ALL_AUTHORS = 'getAllAuthors'
+KEY_GET_EDITIONS = 'getEditions'
+KEY_GENRE_MAPPINGS = 'genreMappings'
+KEY_MAX_WORKERS = 'maxWorkers'
+KEY_CACHE_HOURS = 'cacheHours'
+KEY_METADATA_CACHE_DAYS = 'metadataCacheDays'
+KEY_FETCH_ENGINE = 'useFetchEngine'
+KEY_REQUESTS_PER_SECOND = 'requestsPerSecond'
+KEY_ADAPT_RATE = 'adaptRequestRate'
+KEY_EARLY_RETURN = 'earlyReturn'
+KEY_METRICS_SINK = 'metricsSink'
+KEY_PROFILE = 'profileDownloads'
+
+# Where identify's timings can be sent, as (preference value, description)
+METRICS_SINKS = (
+    ('none', 'No'),
+    ('jsonl', 'Every step, as JSON lines'),
+    ('prometheus', 'Totals, in Prometheus text format'),
+)
+
+DEFAULT_GENRE_MAPPINGS = {
+                'Anthologies': ['Anthologies'],
+                'Adventure': ['Adventure'],
+                'Adult Fiction': ['Adult'],
+                'Adult': ['Adult'],
+                'Art': ['Art'],
+                'Biography': ['Biography'],
+                'Biography Memoir': ['Biography'],
+                'Business': ['Business'],
+                'Chick-lit': ['Chick-lit'],
+                'Childrens': ['Childrens'],
+                'Classics': ['Classics'],
+                'Comics': ['Comics'],
+                'Graphic Novels Comics': ['Comics'],
+                'Contemporary': ['Contemporary'],
+                'Cookbooks': ['Cookbooks'],
+                'Crime': ['Crime'],
+                'Fantasy': ['Fantasy'],
+                'Feminism': ['Feminism'],
+                'Gardening': ['Gardening'],
+                'Gay': ['Gay'],
+                'Glbt': ['Gay'],
+                'Health': ['Health'],
+                'History': ['History'],
+                'Historical Fiction': ['Historical'],
+                'Horror': ['Horror'],
+                'Comedy': ['Humour'],
+                'Humor': ['Humour'],
+                'Health': ['Health'],
+                'Inspirational': ['Inspirational'],
+                'Sequential Art > Manga': ['Manga'],
+                'Modern': ['Modern'],
+                'Music': ['Music'],
+                'Mystery': ['Mystery'],
+                'Non Fiction': ['Non-Fiction'],
+                'Paranormal': ['Paranormal'],
+                'Religion': ['Religion'],
+                'Philosophy': ['Philosophy'],
+                'Politics': ['Politics'],
+                'Poetry': ['Poetry'],
+                'Psychology': ['Psychology'],
+                'Reference': ['Reference'],
+                'Romance': ['Romance'],
+                'Science': ['Science'],
+                'Science Fiction': ['Science Fiction'],
+                'Science Fiction Fantasy': ['Science Fiction', 'Fantasy'],
+                'Self Help': ['Self Help'],
+                'Sociology': ['Sociology'],
+                'Spirituality': ['Spirituality'],
+                'Suspense': ['Suspense'],
+                'Thriller': ['Thriller'],
+                'Travel': ['Travel'],
+                'Paranormal > Vampires': ['Vampires'],
+                'War': ['War'],
+                'Western': ['Western'],
+                'Language > Writing': ['Writing'],
+                'Writing > Essays': ['Writing'],
+                'Young Adult': ['Young Adult'],
+                }
+
+DEFAULT_STORE_VALUES = {
+    KEY_GET_EDITIONS: False,
+    KEY_GET_ALL_AUTHORS: False,
+    KEY_GENRE_MAPPINGS: copy.deepcopy(DEFAULT_GENRE_MAPPINGS),
+    KEY_MAX_WORKERS: 4,
+    KEY_CACHE_HOURS: 24,
+    KEY_METADATA_CACHE_DAYS: 30,
+    KEY_FETCH_ENGINE: False,
+    KEY_REQUESTS_PER_SECOND: 10,
+    KEY_ADAPT_RATE: True,
+    KEY_EARLY_RETURN: False,
+    KEY_METRICS_SINK: 'none',
+    KEY_PROFILE: False
+}
+
+# This is where all preferences for this plugin will be stored
+plugin_prefs = JSONConfig('plugins/Shelfari')
+
+# Set defaults
+plugin_prefs.defaults[STORE_NAME] = DEFAULT_STORE_VALUES
+
+
+class PrefsSnapshot(object):
+
+    '''
+    A read only copy of the plugin preferences, so lookups never go back to
+    the JSONConfig while they run. The genre mappings are precompiled into a
+    GenreMapper.
+    '''
+
+    def __init__(self, version, values):
+        self.version = version
+        self._values = copy.deepcopy(DEFAULT_STORE_VALUES)
+        self._values.update(copy.deepcopy(values))
+        self.genre_mapper = GenreMapper(self._values[KEY_GENRE_MAPPINGS])
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+
+_snapshot = None
+_snapshot_version = 0
+_snapshot_lock = Lock()
+
+
+def prefs_snapshot():
+    '''
+    The current PrefsSnapshot. It is only rebuilt after the preferences have
+    been saved, so take one at the start of a lookup and use it throughout.
+    '''
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == _snapshot_version:
+        return snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.version != _snapshot_version:
+            _snapshot = PrefsSnapshot(_snapshot_version, plugin_prefs[STORE_NAME])
+        return _snapshot
+
+
+def invalidate_prefs():
+    global _snapshot_version
+    with _snapshot_lock:
+        _snapshot_version += 1
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import time, cProfile, pstats
+from collections import Counter
+from cStringIO import StringIO
+from threading import Lock, local
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class Profiler(object):
+
+    '''
+    Runs the plugin's entry points under cProfile when enabled, merging the
+    profiles taken on every thread into one set of stats per session. A
+    session starts each time profiling is switched on, and its stats are
+    rewritten to a .pstats file in profile_dir whenever they are reported.
+    Disabled, call() costs one attribute check.
+    '''
+
+    # Functions listed in the summary written to the log
+    TOP_N = 25
+
+    def __init__(self, profile_dir):
+        self.profile_dir = profile_dir
+        self.enabled = False
+        self._lock = Lock()
+        self._local = local()
+        self._reset()
+
+    def _reset(self):
+        self.path = os.path.join(self.profile_dir,
+                'shelfari-%s.pstats' % time.strftime('%Y%m%d-%H%M%S'))
+        self.stats = None
+        self.calls = Counter()
+
+    def configure(self, enabled):
+        if enabled == self.enabled:
+            return
+        with self._lock:
+            if enabled and not self.enabled:
+                self._reset()
+            self.enabled = enabled
+
+    def call(self, name, fn, *args, **kwargs):
+        '''
+        Return fn(*args, **kwargs), profiled if profiling is on. Calls made
+        from inside an already profiled call are part of its profile, so
+        they are not profiled again.
+        '''
+        if not self.enabled or getattr(self._local, 'active', False):
+            return fn(*args, **kwargs)
+        profile = cProfile.Profile()
+        self._local.active = True
+        try:
+            return profile.runcall(fn, *args, **kwargs)
+        finally:
+            self._local.active = False
+            self._add(name, profile)
+
+    def _add(self, name, profile):
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.calls[name] += 1
+
+    def report(self, log):
+        '''
+        Write the session's stats so far and log the functions with the
+        highest cumulative time. Does nothing from inside a profiled call,
+        so that only the outermost one reports.
+        '''
+        if not self.enabled or getattr(self._local, 'active', False):
+            return
+        with self._lock:
+            if self.stats is None:
+                return
+            if not os.path.exists(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            self.stats.dump_stats(self.path)
+            calls = ', '.join('%s: %d' % item for item in sorted(self.calls.items()))
+            out = StringIO()
+            pstats.Stats(self.path, stream=out).strip_dirs().sort_stats(
+                    'cumulative').print_stats(self.TOP_N)
+        log.info('Profile written to %s (%s)\n%s' % (self.path, calls,
+            out.getvalue().decode('utf-8', 'replace')))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import time, socket
+from threading import Lock
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+#: Responses that mean shelfari wants us to slow down
+BACKOFF_CODES = frozenset((429, 503))
+
+
+def is_backoff_error(error):
+    '''
+    True for a failed request that should slow every request down: a 429 or
+    503 response, or a timeout.
+    '''
+    getcode = getattr(error, 'getcode', None)
+    if callable(getcode):
+        return getcode() in BACKOFF_CODES
+    reason = getattr(error, 'reason', error)
+    return isinstance(reason, socket.timeout)
+
+
+def retry_after(error):
+    '''
+    The number of seconds a 429/503 response asked us to wait for, or None.
+    '''
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return max(0.0, float(response.info().get('retry-after')))
+    except (TypeError, ValueError):
+        # Missing, or given as an http date which we don't bother with
+        return None
+
+
+class RateLimiter(object):
+
+    '''
+    A process-wide token bucket that every request to shelfari takes a token
+    from, so concurrent lookups share one request rate.
+
+    When adaptive the rate follows AIMD: each successful request raises it
+    by about increase requests per second every second, up to max_rate, and
+    each slow down signal from shelfari halves it, down to min_rate. Several
+    failures arriving together only count once.
+    '''
+
+    def __init__(self, max_rate=10.0, adaptive=True, min_rate=0.5, increase=0.5,
+            decrease=0.5):
+        self.min_rate, self.increase, self.decrease = min_rate, increase, decrease
+        self.max_rate, self.adaptive = float(max_rate), adaptive
+        self.rate = self.max_rate
+        self.tokens = self.capacity
+        self.backoffs = 0
+        self.waited = 0.0
+        self._updated = time.time()
+        self._paused_until = self._last_backoff = 0.0
+        self._lock = Lock()
+
+    @property
+    def capacity(self):
+        return max(1.0, self.rate)
+
+    def configure(self, max_rate, adaptive):
+        with self._lock:
+            max_rate = float(max_rate)
+            if max_rate != self.max_rate or adaptive != self.adaptive:
+                self.max_rate, self.adaptive = max_rate, adaptive
+                self.rate = max_rate if not adaptive else min(self.rate, max_rate)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, abort=None):
+        '''
+        Block until a request may be sent. Returns False without taking a
+        token if abort is set while waiting.
+        '''
+        started = time.time()
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.waited += now - started
+                        return True
+                    wait = (1 - self.tokens) / self.rate
+            if abort is not None and abort.is_set():
+                return False
+            time.sleep(min(wait, 0.25))
+
+    def success(self):
+        if not self.adaptive or self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def backoff(self, delay=None):
+        '''
+        Shelfari is struggling or throttling us: cut the rate and, if it told
+        us how long to wait, stop sending requests for that long.
+        '''
+        with self._lock:
+            now = time.time()
+            self.backoffs += 1
+            if delay:
+                self._paused_until = max(self._paused_until, now + delay)
+            if not self.adaptive or now - self._last_backoff < 1.0 / self.rate:
+                return
+            self._last_backoff = now
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def report(self, error=None):
+        '''
+        Adapt the rate to the outcome of a request, error being the exception
+        it failed with if any.
+        '''
+        if error is None:
+            self.success()
+        elif is_backoff_error(error):
+            self.backoff(retry_after(error))
+
+    def stats_text(self):
+        return 'Rate limiter: %.1f requests/s (max %.1f), %d slow downs, %.1fs spent waiting' % (
+                self.rate, self.max_rate, self.backoffs, self.waited)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import re, time
+from collections import namedtuple, OrderedDict
+from urlparse import urljoin
+
+from lxml import etree
+
+from calibre_plugins.shelfari.worker import CONTROL_BYTES, RE_SHELFARI_ID, Utf8Sanitizer
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+# One row of a search results page. authors is the text of the author link,
+# editions_url and editions_text come from the "N editions" link, if any
+SearchResult = namedtuple('SearchResult',
+        'shelfari_id title authors url editions_url editions_text')
+
+# The links read from each result, by the path to their parent from the
+# row's <li>, with divs and spans named by their class
+RESULT_LINKS = {
+    ('div.text', 'h3'): 'title',
+    ('div.text',): 'authors',
+    ('div.text', 'span.editions'): 'editions',
+}
+
+
+# Older result pages have no link in each row, but one "N editions" link for
+# the top result in the second column of a table.tableList. It is only used
+# when it points at a work's editions.
+PAGE_EDITIONS_PATH = ('tr', 'td2', 'span')
+WORK_EDITIONS_URL = '/work/editions/'
+
+# The title link of each edition on an editions page, Shelfari's own markup
+# first. The first of these to match anything is used.
+EDITION_LINKS = (
+    etree.XPath('//div[@class="editionData"]/div[1]/a[@class="bookTitle"][@href]'),
+    etree.XPath('//ul[@class="editions"]/li/a[@class="title"][@href]'),
+)
+# Only the newer markup gives the format separately, the older one has it in
+# the title, e.g. "Dune (Audio CD)"
+EDITION_FORMAT = etree.XPath('../span[@class="format"]')
+RE_WORK_ID = re.compile(r'workId:\s*(\d+)')
+RE_WORK_EDITIONS_ID = re.compile(re.escape(WORK_EDITIONS_URL) + r'(\d+)')
+
+
+def parse_editions(root, raw, editions_url, base_url):
+    '''
+    Read the editions listed on an editions page. Returns a list of dicts of
+    id, url, title and format, as stored by the identifier store, and the
+    work id from the page's script data or else from editions_url, or None.
+    '''
+    links = []
+    for xpath in EDITION_LINKS:
+        links = xpath(root)
+        if links:
+            break
+    editions = []
+    for link in links:
+        url = urljoin(base_url, link.get('href'))
+        match = RE_SHELFARI_ID.search(url)
+        fmt = EDITION_FORMAT(link)
+        editions.append({
+            'id': match.group(1) if match else None,
+            'url': url,
+            'title': link.text_content().strip(),
+            'format': fmt[0].text_content().strip() if fmt else '',
+        })
+    match = RE_WORK_ID.search(raw) or RE_WORK_EDITIONS_ID.search(editions_url)
+    return editions, match.group(1) if match else None
+
+
+def _path_name(tag, attrib):
+    cls = attrib.get('class')
+    if cls and tag in ('div', 'span'):
+        return '%s.%s' % (tag, cls)
+    return tag
+
+
+class ResultsTarget(object):
+
+    '''
+    The lxml parser target collecting search results. It only sees the start
+    and end of each tag, and keeps the text of the few links a row needs.
+    Pass editions=False when the editions links will not be followed.
+    '''
+
+    def __init__(self, editions=True):
+        self.editions = editions
+        self.results = []
+        # (url, text) of the page wide editions link of older pages
+        self.page_editions = None
+        self._in_results = self._closed = False
+        # Tags open inside table.tableList, <td>s seen in its current row, and
+        # the href of the editions link being read
+        self._table, self._columns, self._table_link = None, 0, None
+        # Tags open inside the current row, None outside of a row
+        self._path = None
+        self._row = None
+        self._link, self._link_depth, self._text = None, 0, []
+
+    @property
+    def done(self):
+        '''
+        True once the results list has been read. When editions are wanted
+        and no row had a link the rest of the page is read too, in case it has
+        the editions table.
+        '''
+        return self._closed and (not self.editions or self.page_editions is not None or
+                any(result.editions_url for result in self.results))
+
+    def start(self, tag, attrib):
+        if self._table is not None:
+            self._table_start(tag, attrib)
+            return
+        if self._path is None:
+            if tag == 'table' and attrib.get('class') == 'tableList':
+                self._table, self._columns = [], 0
+            elif tag == 'ol' and attrib.get('class') == 'book_results' and not self._closed:
+                # Only the first list is read, however the page was chunked
+                self._in_results = True
+            elif tag == 'li' and self._in_results:
+                self._path = []
+                self._row = {'id': attrib.get('id'), 'title': None, 'url': None,
+                        'authors': None, 'editions': None, 'editions_url': None}
+            return
+        if tag == 'a' and self._link is None:
+            link = RESULT_LINKS.get(tuple(self._path))
+            if link is not None and self._row[link] is None:
+                href = attrib.get('href')
+                if link == 'title':
+                    self._row['url'] = href
+                elif link == 'editions':
+                    if href is None:
+                        link = None
+                    self._row['editions_url'] = href
+                self._link, self._link_depth, self._text = link, len(self._path), []
+        self._path.append(_path_name(tag, attrib))
+
+    def data(self, data):
+        if self._link is not None or self._table_link is not None:
+            self._text.append(data)
+
+    def end(self, tag):
+        if self._table is not None:
+            self._table_end(tag)
+            return
+        if self._path is None:
+            if tag == 'ol' and self._in_results:
+                self._in_results = False
+                self._closed = True
+            return
+        if not self._path:
+            self._end_row()
+            return
+        self._path.pop()
+        if self._link is not None and len(self._path) == self._link_depth:
+            self._row[self._link] = ''.join(self._text).strip()
+            self._link, self._text = None, []
+
+    def close(self):
+        return self.results
+
+    def _table_start(self, tag, attrib):
+        path = self._table
+        if tag == 'tr' and not path:
+            self._columns = 0
+        elif tag == 'td' and path == ['tr']:
+            self._columns += 1
+            tag = 'td%d' % self._columns
+        elif tag == 'a' and tuple(path) == PAGE_EDITIONS_PATH and \
+                self.page_editions is None and self._table_link is None:
+            self._table_link, self._text = attrib.get('href'), []
+        path.append(tag)
+
+    def _table_end(self, tag):
+        path = self._table
+        if not path:
+            self._table = None
+            return
+        path.pop()
+        if self._table_link is not None and tuple(path) == PAGE_EDITIONS_PATH:
+            if WORK_EDITIONS_URL in self._table_link:
+                self.page_editions = (self._table_link, ''.join(self._text).strip())
+            self._table_link, self._text = None, []
+
+    def _end_row(self):
+        row = self._row
+        self._path = self._row = None
+        self._link, self._text = None, []
+        if row['title'] is None:
+            return
+        shelfari_id = row['id']
+        if shelfari_id:
+            shelfari_id = shelfari_id.replace('SR', '')
+        self.results.append(SearchResult(shelfari_id, row['title'], row['authors'] or '',
+            row['url'], row['editions_url'], row['editions'] or ''))
+
+
+class SearchResultsParser(object):
+
+    '''
+    Reads the rows of a search results page as it is downloaded, without
+    building a tree. feed() returns True once the results list has been
+    closed, as the rest of the page is not needed. With editions=False the
+    editions table older pages have after the list is not looked for.
+    '''
+
+    # Names the truncated pages this parser stops at, so the response cache
+    # keeps them apart from full pages. Pages read for their editions may go
+    # on further, and are kept apart from those that stop at the list.
+    PARTIAL_KEY = 'search'
+
+    def __init__(self, editions=True):
+        if editions:
+            self.PARTIAL_KEY = SearchResultsParser.PARTIAL_KEY + '+editions'
+        self._target = ResultsTarget(editions)
+        self._parser = etree.HTMLParser(target=self._target, encoding='utf-8')
+        self._utf8 = Utf8Sanitizer()
+        self._fed = False
+        # Seconds spent in each step of parsing, over all the chunks
+        self.timings = OrderedDict((name, 0.0) for name in ('clean_ascii_chars', 'fromstring'))
+
+    def feed(self, chunk):
+        t0 = time.time()
+        chunk = self._utf8.feed(chunk).translate(None, CONTROL_BYTES)
+        t1 = time.time()
+        if chunk and not self._target.done:
+            self._parser.feed(chunk)
+            self._fed = True
+        self.timings['clean_ascii_chars'] += t1 - t0
+        self.timings['fromstring'] += time.time() - t1
+        return self._target.done
+
+    def close(self):
+        '''
+        The SearchResult for every row, in the page's order. On older pages
+        the top result gets the page wide editions link.
+        '''
+        if self._fed:
+            start = time.time()
+            tail = self._utf8.feed(b'', final=True)
+            if tail and not self._target.done:
+                self._parser.feed(tail)
+            self._parser.close()
+            self.timings['fromstring'] += time.time() - start
+        results = self._target.results
+        page_editions = self._target.page_editions
+        if results and page_editions is not None and results[0].editions_url is None:
+            url, text = page_editions
+            results[0] = results[0]._replace(editions_url=url, editions_text=text)
+        return results
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+# Add the calibre submodule to the path
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
+
+import time, json, sqlite3
+from threading import Lock
+
+from calibre.ebooks.metadata.book.base import Metadata
+from calibre.utils.date import parse_date
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+# The Metadata fields we keep for each book, in addition to the cover url
+RECORD_FIELDS = ('title', 'authors', 'series', 'series_index', 'isbn', 'rating',
+                 'comments', 'tags', 'publisher', 'pubdate', 'language')
+
+# Bump this whenever the parsing of book pages or RECORD_FIELDS changes, so
+# that records stored by the old code are fetched again
+SCHEMA_VERSION = '1'
+
+
+def record_from_metadata(mi, cover_url=None):
+    '''
+    Flatten the fields parsed from a book page into a json friendly dict
+    '''
+    record = {}
+    for field in RECORD_FIELDS:
+        value = getattr(mi, field, None)
+        if field == 'pubdate' and value is not None:
+            value = value.isoformat()
+        record[field] = value
+    record['cover_url'] = cover_url
+    return record
+
+
+def metadata_from_record(shelfari_id, record):
+    mi = Metadata(record['title'], record['authors'])
+    for field in RECORD_FIELDS[2:]:
+        value = record.get(field)
+        if value is None:
+            continue
+        if field == 'pubdate':
+            value = parse_date(value)
+        setattr(mi, field, value)
+    mi.set_identifier('shelfari', shelfari_id)
+    mi.has_cover = bool(record.get('cover_url'))
+    return mi
+
+
+class MetadataStore(object):
+
+    '''
+    SQLite store of the fields parsed from each Shelfari book page, keyed by
+    shelfari id. A stored record is only used while it is younger than max_age
+    seconds and was written with the same schema version, so parser fixes
+    take effect as soon as the plugin with them is installed.
+    '''
+
+    def __init__(self, path, version=SCHEMA_VERSION, max_age=30*24*60*60):
+        self.path, self.version, self.max_age = path, version, max_age
+        self._lock = Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Called with the lock held
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS books ('
+                               'shelfari_id TEXT PRIMARY KEY, '
+                               'version TEXT NOT NULL, '
+                               'stored_at REAL NOT NULL, '
+                               'record TEXT NOT NULL)')
+            self._conn.commit()
+        return self._conn
+
+    def get(self, shelfari_id):
+        '''
+        Return the stored record for shelfari_id, or None if we have nothing
+        current for it
+        '''
+        with self._lock:
+            row = self.conn.execute('SELECT version, stored_at, record FROM books '
+                                    'WHERE shelfari_id = ?', (shelfari_id,)).fetchone()
+        if row is None:
+            return None
+        version, stored_at, record = row
+        if version != self.version or time.time() - stored_at > self.max_age:
+            return None
+        try:
+            return json.loads(record)
+        except ValueError:
+            return None
+
+    def put(self, shelfari_id, record):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?)',
+                    (shelfari_id, self.version, time.time(), json.dumps(record)))
+            self.conn.commit()
+
+    def purge(self):
+        '''
+        Drop records from other schema versions or older than max_age
+        '''
+        with self._lock:
+            self.conn.execute('DELETE FROM books WHERE version != ? OR stored_at < ?',
+                    (self.version, time.time() - self.max_age))
+            self.conn.commit()
+
+
+class IdentifierStore(object):
+
+    '''
+    Persistent isbn -> shelfari id and shelfari id -> cover url mappings, so
+    the caches calibre keeps in memory on the plugin survive a restart. Also
+    remembers which work each shelfari id is an edition of and the editions
+    of each work, so the editions page is only crawled once per work.
+
+    Lookups go to indexed SQLite tables on first use of each key and are then
+    remembered. Writes are queued and committed batch_size at a time, or when
+    flush() is called at the end of a lookup.
+    '''
+
+    #: table -> (key column, value column)
+    TABLES = {
+        'isbns': ('isbn', 'shelfari_id'),
+        'covers': ('shelfari_id', 'cover_url'),
+        'works': ('shelfari_id', 'work_id'),
+        'editions': ('work_id', 'editions'),
+    }
+
+    def __init__(self, path, batch_size=50):
+        self.path, self.batch_size = path, batch_size
+        self._lock = Lock()
+        self._conn = None
+        self._memo = dict((table, {}) for table in self.TABLES)
+        self._pending = dict((table, []) for table in self.TABLES)
+
+    @property
+    def conn(self):
+        # Called with the lock held
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            for table, (key, value) in self.TABLES.items():
+                self._conn.execute('CREATE TABLE IF NOT EXISTS %s ('
+                                   '%s TEXT PRIMARY KEY, %s TEXT NOT NULL)' % (table, key, value))
+            self._conn.commit()
+        return self._conn
+
+    def _lookup(self, table, key):
+        with self._lock:
+            memo = self._memo[table]
+            if key not in memo:
+                row = self.conn.execute('SELECT %s FROM %s WHERE %s = ?' % (
+                    self.TABLES[table][1], table, self.TABLES[table][0]), (key,)).fetchone()
+                memo[key] = row[0] if row else None
+            return memo[key]
+
+    def isbn_to_identifier(self, isbn):
+        return self._lookup('isbns', isbn)
+
+    def identifier_to_cover_url(self, shelfari_id):
+        return self._lookup('covers', shelfari_id)
+
+    def identifier_to_work(self, shelfari_id):
+        return self._lookup('works', shelfari_id)
+
+    def work_to_editions(self, work_id):
+        '''
+        The editions of work_id as a list of dicts with the id, url, title and
+        format of each, or None if its editions page has not been crawled.
+        '''
+        editions = self._lookup('editions', work_id)
+        return json.loads(editions) if editions is not None else None
+
+    def _add(self, table, key, value):
+        with self._lock:
+            memo = self._memo[table]
+            if memo.get(key) == value:
+                return
+            memo[key] = value
+            self._pending[table].append((key, value))
+            if sum(len(p) for p in self._pending.values()) >= self.batch_size:
+                self._flush()
+
+    def add_isbn(self, isbn, shelfari_id):
+        self._add('isbns', isbn, shelfari_id)
+
+    def add_cover_url(self, shelfari_id, cover_url):
+        self._add('covers', shelfari_id, cover_url)
+
+    def add_editions(self, work_id, editions, shelfari_ids=()):
+        '''
+        Remember the editions of work_id, and that each of them, as well as
+        any other shelfari_ids, belongs to that work.
+        '''
+        self._add('editions', work_id, json.dumps(editions))
+        for shelfari_id in list(shelfari_ids) + [e['id'] for e in editions if e.get('id')]:
+            self._add('works', shelfari_id, work_id)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # Called with the lock held
+        if not any(self._pending.values()):
+            return
+        for table, pending in self._pending.items():
+            if pending:
+                self.conn.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?)' % table,
+                        pending)
+        self.conn.commit()
+        self._pending = dict((table, []) for table in self.TABLES)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import shutil, tempfile, unittest
+
+from calibre_plugins.shelfari.cache import ResponseCache
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class PartialEntryTest(unittest.TestCase):
+
+    URL = 'http://www.shelfari.com/books/1/Book'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_partial_body_is_not_served_as_the_page(self):
+        self.cache.put(self.URL, self.URL, b'<html><head>', partial_key='book:a')
+        self.assertEqual(self.cache.get(self.URL), None)
+        self.assertEqual(self.cache.get(self.URL, 'book:b'), None)
+        entry = self.cache.get(self.URL, 'book:a')
+        self.assertEqual(entry.raw, b'<html><head>')
+        self.assertEqual(entry.partial_key, 'book:a')
+
+    def test_full_and_partial_bodies_are_kept_apart(self):
+        self.cache.put(self.URL, self.URL, b'<html></html>')
+        self.cache.put(self.URL, self.URL, b'<html>', partial_key='book:a')
+        self.assertEqual(self.cache.get(self.URL).raw, b'<html></html>')
+        self.assertEqual(self.cache.get(self.URL).partial_key, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
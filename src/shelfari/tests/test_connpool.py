@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, socket, threading, gzip, io
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urllib2 import URLError
+
+from calibre_plugins.shelfari.connpool import ConnectionPool
+from calibre_plugins.shelfari.flight import Aborted
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class RecordingProxy(object):
+
+    '''
+    Accepts one connection, records the request line sent to it and answers
+    with an empty 200 before hanging up.
+    '''
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.address = '127.0.0.1:%d' % self.sock.getsockname()[1]
+        self.request_line = None
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        conn = self.sock.accept()[0]
+        data = b''
+        while b'\r\n\r\n' not in data:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        self.request_line = data.split(b'\r\n')[0].decode('ascii')
+        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        conn.close()
+        self.sock.close()
+
+
+class PageServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class GzipHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    page = b'<html>' + b'page ' * 2000 + b'</html>'
+
+    def do_GET(self):
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(self.page)
+        body = buf.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PageServer(('127.0.0.1', 0), GzipHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/books/1' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_small_gzip_reads_only_end_with_the_body(self):
+        pool = ConnectionPool()
+        response = pool.open(self.url, timeout=5)
+        chunks = []
+        while True:
+            # Four bytes never get past the gzip header on their own
+            chunk = response.read(4)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(b''.join(chunks), GzipHandler.page)
+
+    def test_waiting_for_a_busy_host_times_out(self):
+        pool = ConnectionPool(max_per_host=1)
+        busy = pool.open(self.url, timeout=5)
+        self.assertRaises(URLError, pool.open, self.url, timeout=0.2)
+        busy.read()
+        self.assertEqual(pool.open(self.url, timeout=0.2).read(), GzipHandler.page)
+
+    def test_waiting_for_a_busy_host_stops_on_abort(self):
+        pool = ConnectionPool(max_per_host=1)
+        pool.open(self.url, timeout=5)
+        abort = threading.Event()
+        abort.set()
+        self.assertRaises(Aborted, pool.open, self.url, timeout=5, abort=abort)
+
+
+class ProxyTest(unittest.TestCase):
+
+    def test_http_goes_to_the_proxy_as_an_absolute_url(self):
+        proxy = RecordingProxy()
+        pool = ConnectionPool(proxies={'http': proxy.address})
+        response = pool.open('http://www.shelfari.com/books/1', timeout=5)
+        self.assertEqual(response.read(), b'')
+        self.assertEqual(proxy.request_line, 'GET http://www.shelfari.com/books/1 HTTP/1.1')
+
+    def test_https_is_tunnelled_through_the_proxy(self):
+        proxy = RecordingProxy()
+        pool = ConnectionPool(proxies={'https': 'http://' + proxy.address})
+        # The fake proxy hangs up after the CONNECT, so the TLS handshake fails
+        self.assertRaises(URLError, pool.open, 'https://www.shelfari.com/books/1', timeout=5)
+        proxy.thread.join(5)
+        self.assertEqual(proxy.request_line, 'CONNECT www.shelfari.com:443 HTTP/1.0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, os, shutil, tempfile
+
+from calibre_plugins.shelfari.covers import renditions, probe_size, CoverCache
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+COVER = 'http://ecx.images-amazon.com/images/I/51Kq0abcdeL._SX150_.jpg'
+
+
+class FakeResponse(object):
+
+    def __init__(self, code=200, headers=None, body=b''):
+        self.code, self.headers, self.body = code, headers or {}, body
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def read(self):
+        return self.body
+
+
+class FakeOpener(object):
+
+    '''
+    Answers each request with the next of responses, recording the method
+    and headers it was made with
+    '''
+
+    def __init__(self, *responses):
+        self.responses, self.requests = list(responses), []
+
+    def __call__(self, url, headers, timeout, method):
+        self.requests.append((method, headers))
+        return self.responses.pop(0)
+
+
+class RenditionsTest(unittest.TestCase):
+
+    def test_full_size_is_tried_first(self):
+        self.assertEqual(renditions(COVER), [
+            'http://ecx.images-amazon.com/images/I/51Kq0abcdeL.jpg', COVER])
+        self.assertEqual(renditions(
+            'http://ecx.images-amazon.com/images/I/51Kq0abcdeL._SY300_CR0,0,200,300_.jpg')[0],
+            'http://ecx.images-amazon.com/images/I/51Kq0abcdeL.jpg')
+
+    def test_urls_without_a_size_are_kept(self):
+        url = 'http://www.shelfari.com/images/nocover.png'
+        self.assertEqual(renditions(url), [url])
+
+
+class ProbeSizeTest(unittest.TestCase):
+
+    def test_head_gives_the_size(self):
+        opener = FakeOpener(FakeResponse(headers={'content-type': 'image/jpeg',
+            'content-length': '34567'}))
+        self.assertEqual(probe_size(opener, COVER, 5), (34567, None))
+        self.assertEqual(opener.requests, [('HEAD', {})])
+
+    def test_falls_back_to_a_range_request(self):
+        opener = FakeOpener(FakeResponse(headers={'content-type': 'image/jpeg'}),
+                FakeResponse(206, {'content-range': 'bytes 0-0/34567'}, b'\xff'))
+        self.assertEqual(probe_size(opener, COVER, 5), (34567, None))
+        self.assertEqual(opener.requests, [('HEAD', {}), ('GET', {'Range': 'bytes=0-0'})])
+
+    def test_ignored_range_returns_the_image(self):
+        opener = FakeOpener(FakeResponse(headers={'content-type': 'image/jpeg'}),
+                FakeResponse(200, {}, b'image bytes'))
+        self.assertEqual(probe_size(opener, COVER, 5), (11, b'image bytes'))
+
+    def test_unknown_size(self):
+        opener = FakeOpener(FakeResponse(), FakeResponse(206, {'content-range': 'bytes 0-0/*'}))
+        self.assertEqual(probe_size(opener, COVER, 5), (None, None))
+
+    def test_rejects_pages_that_are_not_images(self):
+        opener = FakeOpener(FakeResponse(headers={'content-type': 'text/html'}))
+        self.assertRaises(ValueError, probe_size, opener, COVER, 5)
+
+
+class CoverCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def blobs(self):
+        return os.listdir(os.path.join(self.tdir, 'blobs'))
+
+    def test_same_image_is_stored_once(self):
+        cache = CoverCache(self.tdir)
+        full_size = renditions(COVER)[0]
+        cache.put(COVER, b'image bytes')
+        cache.put(full_size, b'image bytes')
+        self.assertEqual(len(self.blobs()), 1)
+        # A new cache finds both urls from what is on disk
+        cache = CoverCache(self.tdir)
+        self.assertEqual(cache.get(COVER), b'image bytes')
+        self.assertEqual(cache.get(full_size), b'image bytes')
+        self.assertEqual(cache.get('http://www.shelfari.com/images/other.jpg'), None)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_least_recently_used_images_are_evicted(self):
+        cache = CoverCache(self.tdir, max_size=20)
+        cache.put('http://example.com/a.jpg', b'a' * 8)
+        cache.put('http://example.com/b.jpg', b'b' * 8)
+        self.assertEqual(cache.get('http://example.com/a.jpg'), b'a' * 8)
+        cache.put('http://example.com/c.jpg', b'c' * 8)
+        self.assertEqual(cache.get('http://example.com/b.jpg'), None)
+        self.assertEqual(cache.get('http://example.com/a.jpg'), b'a' * 8)
+        self.assertEqual(len(self.blobs()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
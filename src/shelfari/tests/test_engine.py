@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, threading, time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urllib2 import URLError
+
+from calibre_plugins.shelfari.engine import AsyncFetchEngine
+from calibre_plugins.shelfari.flight import Aborted
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class PageServer(ThreadingMixIn, HTTPServer):
+
+    # The engine keeps connections alive, so each one needs its own thread
+    daemon_threads = True
+
+
+class PageHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.endswith('/slow'):
+            time.sleep(2)
+        body = b'<html>page</html>'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RecordingLog(object):
+
+    def __init__(self):
+        self.errors = []
+
+    def exception(self, msg):
+        self.errors.append(msg)
+
+
+class AsyncFetchEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PageServer(('127.0.0.1', 0), PageHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/books/1' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetches_plain_http(self):
+        engine = AsyncFetchEngine()
+        response = engine.fetch_sync(self.url, timeout=5)
+        self.assertEqual(response.getcode(), 200)
+        self.assertEqual(response.read(), b'<html>page</html>')
+
+    def test_refuses_https_and_proxied_urls(self):
+        engine = AsyncFetchEngine()
+        self.assertTrue(engine.can_fetch(self.url))
+        self.assertFalse(engine.can_fetch('https://www.shelfari.com/books/1'))
+        self.assertRaises(URLError, engine.fetch_sync, 'https://127.0.0.1:1/', timeout=5)
+        proxied = AsyncFetchEngine(proxies={'http': 'proxy:3128'})
+        self.assertFalse(proxied.can_fetch(self.url))
+
+    def test_callback_errors_go_to_the_log(self):
+        engine = AsyncFetchEngine()
+        log, done = RecordingLog(), threading.Event()
+
+        def callback(response, error):
+            done.set()
+            raise ValueError('callback failed')
+
+        engine.fetch(self.url, callback, timeout=5, log=log)
+        self.assertTrue(done.wait(5))
+        engine.fetch_sync(self.url, timeout=5)
+        self.assertEqual(log.errors, ['Fetch engine callback failed for: %r' % self.url])
+        self.assertEqual(engine.callback_errors, 1)
+
+    def test_cancelled_request_fails_without_waiting(self):
+        engine = AsyncFetchEngine()
+        cancel, done, result = threading.Event(), threading.Event(), []
+
+        def callback(response, error):
+            result.append(error)
+            done.set()
+
+        engine.fetch(self.url + '/slow', callback, timeout=10, cancelled=cancel.is_set)
+        started = time.time()
+        cancel.set()
+        self.assertTrue(done.wait(5))
+        self.assertLess(time.time() - started, 1.5)
+        self.assertTrue(isinstance(result[0], URLError))
+        self.assertEqual(engine.cancelled, 1)
+
+    def test_sync_fetch_gives_up_on_abort(self):
+        engine = AsyncFetchEngine()
+        abort = threading.Event()
+        threading.Timer(0.1, abort.set).start()
+        started = time.time()
+        self.assertRaises(Aborted, engine.fetch_sync, self.url + '/slow', timeout=10,
+                abort=abort)
+        self.assertLess(time.time() - started, 1.5)
+        # The request itself is dropped on the loop's next tick
+        for i in range(20):
+            if engine.cancelled:
+                break
+            time.sleep(0.1)
+        self.assertEqual(engine.cancelled, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, time
+from threading import Thread, Event
+
+from calibre_plugins.shelfari.flight import SingleFlight, Aborted
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+def started_by(started):
+    return lambda done, flight: started.append(done)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_concurrent_callers_share_one_call(self):
+        flight, entered, release, calls = SingleFlight(), Event(), Event(), []
+
+        def work():
+            calls.append(1)
+            entered.set()
+            release.wait(5)
+            return 42
+
+        results = []
+        leader = Thread(target=lambda: results.append(flight.do(('page', 1), work)))
+        leader.start()
+        self.assertTrue(entered.wait(5))
+        follower = Thread(target=lambda: results.append(flight.do(('page', 1), work)))
+        follower.start()
+        for i in range(500):
+            if flight.shared.get('page'):
+                break
+            time.sleep(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(sorted(results), [(42, False), (42, True)])
+        self.assertEqual(len(calls), 1)
+
+    def test_error_reaches_the_caller_and_frees_the_key(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('failed')
+
+        self.assertRaises(ValueError, flight.do, ('page', 1), fail)
+        self.assertEqual(flight.do(('page', 1), lambda: 1), (1, False))
+
+    def test_followers_redo_work_the_leader_aborted(self):
+        flight, entered, release = SingleFlight(), Event(), Event()
+
+        def aborted():
+            entered.set()
+            release.wait(5)
+            raise Aborted('Aborted')
+
+        errors, results = [], []
+
+        def lead():
+            try:
+                flight.do(('page', 1), aborted)
+            except Aborted as e:
+                errors.append(e)
+
+        leader = Thread(target=lead)
+        leader.start()
+        self.assertTrue(entered.wait(5))
+        follower = Thread(target=lambda: results.append(flight.do(('page', 1), lambda: 42)))
+        follower.start()
+        for i in range(500):
+            if flight.shared.get('page'):
+                break
+            time.sleep(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(len(errors), 1)
+        # The follower did the work itself rather than see the leader's abort
+        self.assertEqual(results, [(42, False)])
+
+    def test_async_result_goes_to_every_waiter(self):
+        flight, started, results = SingleFlight(), [], []
+        flight.do_async(('page', 1), lambda *r: results.append(r), started_by(started))
+        flight.do_async(('page', 1), lambda *r: results.append(r), started_by(started))
+        self.assertEqual(len(started), 1)
+        started[0]('raw', None)
+        self.assertEqual(results, [('raw', None), ('raw', None)])
+        # Done is only honoured once
+        started[0]('again', None)
+        self.assertEqual(len(results), 2)
+
+    def test_async_start_error_goes_to_every_waiter(self):
+        flight, results, pending = SingleFlight(), [], []
+        error = IOError('disk full')
+
+        def start(done, work):
+            # A second caller joins before the first one's work fails
+            flight.do_async(('page', 1), lambda *r: results.append(r), started_by(pending))
+            raise error
+
+        flight.do_async(('page', 1), lambda *r: results.append(r), start,
+                failed=lambda e: (None, None, e))
+        self.assertEqual(results, [(None, None, error), (None, None, error)])
+        self.assertEqual(pending, [])
+        # The key is free again
+        flight.do_async(('page', 1), lambda *r: results.append(r), started_by(pending))
+        self.assertEqual(len(pending), 1)
+
+    def test_work_is_only_dropped_once_every_waiter_is_cancelled(self):
+        flight, flights, results = SingleFlight(), [], []
+        first, second = [False], [False]
+
+        def start(done, work):
+            flights.append((done, work))
+
+        flight.do_async(('page', 1), lambda *r: results.append(('first', r)), start,
+                cancelled=lambda: first[0])
+        flight.do_async(('page', 1), lambda *r: results.append(('second', r)), start,
+                cancelled=lambda: second[0])
+        work = flights[0][1]
+        self.assertFalse(work.is_set())
+        first[0] = True
+        self.assertFalse(work.is_set())
+        # The cancelled caller is called back straight away, and only it
+        self.assertEqual([name for name, r in results], ['first'])
+        self.assertTrue(isinstance(results[0][1][1], Aborted))
+        second[0] = True
+        self.assertTrue(work.is_set())
+        self.assertEqual([name for name, r in results], ['first', 'second'])
+        # The key is free for new work, and the old work finishing is ignored
+        flight.do_async(('page', 1), lambda *r: results.append(('third', r)), start)
+        self.assertEqual(len(flights), 2)
+        flights[0][0]('late', None)
+        flights[1][0]('raw', None)
+        self.assertEqual(results[-1], ('third', ('raw', None)))
+
+    def test_raising_waiter_does_not_starve_the_others(self):
+        flight, started, results = SingleFlight(), [], []
+
+        def fail(*result):
+            raise ValueError('callback failed')
+
+        flight.do_async(('page', 1), fail, started_by(started))
+        flight.do_async(('page', 1), lambda *r: results.append(r), started_by(started))
+        self.assertRaises(ValueError, started[0], 'raw', None)
+        self.assertEqual(results, [('raw', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
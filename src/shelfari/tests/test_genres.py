@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest
+
+from calibre_plugins.shelfari.genres import GenreMapper
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class GenreMapperTest(unittest.TestCase):
+
+    def test_plain_paths_ignore_case_and_spacing(self):
+        mapper = GenreMapper({'Paranormal > Vampires': ['Vampires']})
+        self.assertEqual(mapper.lookup('paranormal>VAMPIRES'), ('Vampires',))
+        self.assertEqual(mapper.lookup('Paranormal'), ())
+        self.assertEqual(mapper.lookup('Paranormal > Vampires > Teen'), ())
+
+    def test_wildcard_matches_any_one_segment(self):
+        mapper = GenreMapper({'* > Vampires': ['Vampires']})
+        self.assertEqual(mapper.lookup('Paranormal > Vampires'), ('Vampires',))
+        self.assertEqual(mapper.lookup('Horror > Vampires'), ('Vampires',))
+        self.assertEqual(mapper.lookup('Vampires'), ())
+        self.assertEqual(mapper.lookup('Fiction > Horror > Vampires'), ())
+
+    def test_prefix_matches_the_path_and_everything_below(self):
+        mapper = GenreMapper({'Paranormal > **': ['Paranormal']})
+        self.assertEqual(mapper.lookup('Paranormal'), ('Paranormal',))
+        self.assertEqual(mapper.lookup('Paranormal > Vampires > Teen'), ('Paranormal',))
+        self.assertEqual(mapper.lookup('Fantasy > Paranormal'), ())
+
+    def test_most_specific_mapping_first(self):
+        mapper = GenreMapper({
+            'Fiction > **': ['Fiction'],
+            'Fiction > Fantasy > **': ['Fantasy'],
+            'Fiction > Fantasy > Epic': ['Epic Fantasy'],
+        })
+        self.assertEqual(mapper.lookup('Fiction > Fantasy > Epic'),
+                ('Epic Fantasy', 'Fantasy', 'Fiction'))
+
+    def test_tags_for_keeps_order_without_duplicates(self):
+        mapper = GenreMapper({
+            'Fiction > **': ['Fiction'],
+            'Fiction > Fantasy': ['Fantasy'],
+            'Fiction > Science Fiction': ['Science Fiction'],
+        })
+        self.assertEqual(mapper.tags_for(['Fiction > Fantasy', 'Fiction > Science Fiction',
+            'Cooking', 'Fiction']), ['Fantasy', 'Fiction', 'Science Fiction'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest
+
+try:
+    from calibre_plugins.shelfari.matcher import QueryMatcher
+except ImportError:
+    # The matcher lower cases with calibre's icu, run these with calibre-debug
+    QueryMatcher = None
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+@unittest.skipIf(QueryMatcher is None, 'needs calibre')
+class QueryMatcherTest(unittest.TestCase):
+
+    def test_tokens_match_the_start_of_a_word(self):
+        matcher = QueryMatcher(['The', 'Hobbit'], ['Tolkien'])
+        whole, plural, inside = matcher.score_rows([('The Hobbit', 'J. R. R. Tolkien'),
+            ('The Hobbits', 'J.R.R. Tolkiens Estate'), ('Hobbitry', 'Tolkien')])
+        self.assertTrue(whole > plural > 0)
+        self.assertNotEqual(inside, None)
+
+    def test_tokens_inside_a_word_do_not_match(self):
+        matcher = QueryMatcher(['Dune'], ['Herbert'])
+        scores = matcher.score_rows([('Dune', 'Frank Herbert'),
+            ('Sandunes', 'Frank Herbert'), ('Dune', 'Heberts Press')])
+        self.assertNotEqual(scores[0], None)
+        self.assertEqual(scores[1], None)
+        self.assertEqual(scores[2], None)
+
+    def test_query_tokens_are_normalized(self):
+        matcher = QueryMatcher(['Children of', 'DUNE'], ['Frank Herbert'])
+        score = matcher.score_rows([('Children of Dune', 'Frank Herbert')])[0]
+        self.assertAlmostEqual(score, 1.0)
+
+    def test_closer_titles_score_higher(self):
+        matcher = QueryMatcher(['dune', 'messiah'], ['herbert'])
+        exact, partial, other = matcher.score_rows([('Dune Messiah', 'Frank Herbert'),
+            ('Dune', 'Frank Herbert'), ('The Road to Dune', 'Brian Herbert')])
+        self.assertTrue(exact > partial > other)
+
+    def test_empty_query_field_matches_every_row(self):
+        matcher = QueryMatcher(['dune'], [])
+        self.assertEqual(len([s for s in matcher.score_rows([('Dune', 'Anyone'),
+            ('Dune', '')]) if s is not None]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
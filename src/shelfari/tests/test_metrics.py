@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, os, json, time, shutil, tempfile
+
+from calibre_plugins.shelfari.metrics import (Metrics, MemorySink, JsonLinesSink,
+        PrometheusSink)
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def test_spans_time_their_block_even_when_it_raises(self):
+        metrics = Metrics()
+        with metrics.span('search.fetch'):
+            time.sleep(0.05)
+        try:
+            with metrics.span('search.fetch'):
+                raise ValueError('failed')
+        except ValueError:
+            pass
+        count, total, low, high = metrics.aggregate.snapshot()['search.fetch']
+        self.assertEqual(count, 2)
+        self.assertTrue(0.04 < high < 1)
+        self.assertTrue(low < 0.04)
+        self.assertAlmostEqual(total, low + high)
+
+    def test_json_lines_sink_writes_a_line_per_span(self):
+        path = os.path.join(self.tdir, 'metrics.jsonl')
+        metrics = Metrics([JsonLinesSink(path)])
+        metrics.record('identify', 1.25, url='http://www.shelfari.com/books/1')
+        metrics.record_all('detail.', {'fromstring': 0.5})
+        with open(path, 'rb') as f:
+            lines = [json.loads(line.decode('utf-8')) for line in f]
+        self.assertEqual([(l['stage'], l['seconds']) for l in lines],
+                [('identify', 1.25), ('detail.fromstring', 0.5)])
+        self.assertEqual(lines[0]['url'], 'http://www.shelfari.com/books/1')
+        self.assertTrue(abs(lines[0]['at'] - time.time()) < 60)
+
+    def test_prometheus_sink_writes_the_text_format(self):
+        path = os.path.join(self.tdir, 'shelfari.prom')
+        sink = PrometheusSink(path, interval=3600)
+        metrics = Metrics([sink])
+        metrics.record('identify', 1.5)
+        metrics.record('identify', 0.5)
+        metrics.record('say "hi"', 0.25)
+        # The first span writes the file, the rest wait for the interval
+        with open(path, 'rb') as f:
+            self.assertIn(b'shelfari_stage_seconds_count{stage="identify"} 1\n', f.read())
+        metrics.flush()
+        with open(path, 'rb') as f:
+            text = f.read().decode('utf-8')
+        self.assertIn('# TYPE shelfari_stage_seconds summary\n', text)
+        self.assertIn('shelfari_stage_seconds_count{stage="identify"} 2\n', text)
+        self.assertIn('shelfari_stage_seconds_sum{stage="identify"} 2.000000\n', text)
+        self.assertIn('# TYPE shelfari_stage_seconds_max gauge\n', text)
+        self.assertIn('shelfari_stage_seconds_max{stage="identify"} 1.500000\n', text)
+        self.assertIn('shelfari_stage_seconds_count{stage="say \\"hi\\""} 1\n', text)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_summary_lists_the_slowest_stages_first(self):
+        sink = MemorySink()
+        sink.emit('fast', 0.1, {})
+        sink.emit('slow', 2.0, {})
+        lines = sink.summary_text().splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['stage', 'slow', 'fast'])
+
+
+if __name__ == '__main__':
+    unittest.main()
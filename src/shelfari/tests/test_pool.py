@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, time
+from threading import Event, Timer
+from Queue import Queue
+
+from calibre_plugins.shelfari.pool import WorkerPool, Latch, ResultGate
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class RecordingLog(object):
+
+    def __init__(self):
+        self.errors = []
+
+    def exception(self, msg):
+        self.errors.append(msg)
+
+
+class TaskCallbackTest(unittest.TestCase):
+
+    def test_callback_runs_for_aborted_task(self):
+        pool = WorkerPool(1)
+        abort, called = Event(), Event()
+        abort.set()
+        task = pool.submit(lambda: 1, abort=abort, callback=lambda t: called.set())
+        self.assertTrue(called.wait(1))
+        self.assertTrue(task.cancelled)
+        self.assertEqual(task.result, None)
+
+    def test_raising_callback_keeps_pool_running(self):
+        pool = WorkerPool(1)
+        log = RecordingLog()
+
+        def fail(task):
+            raise ValueError('callback failed')
+
+        first = pool.submit(lambda: 1, callback=fail, log=log, name='first')
+        self.assertTrue(first.wait(1))
+        second = pool.submit(lambda: 2)
+        self.assertTrue(second.wait(1))
+        self.assertEqual(second.result, 2)
+        self.assertTrue(isinstance(first.callback_exception, ValueError))
+        self.assertEqual(log.errors, ['Callback failed for task: first'])
+        self.assertEqual(len(pool._threads), 1)
+
+
+class LatchTest(unittest.TestCase):
+
+    def test_wait_returns_once_every_task_is_done(self):
+        pool = WorkerPool(2)
+        latch = Latch(3)
+        for i in range(3):
+            pool.submit(time.sleep, 0.05, callback=latch.count_down)
+        self.assertTrue(latch.wait(timeout=5))
+        self.assertEqual(latch.count, 0)
+        self.assertNotEqual(latch.released_at, None)
+
+    def test_empty_latch_is_already_released(self):
+        self.assertTrue(Latch(0).wait(timeout=0))
+
+    def test_wait_stops_on_abort(self):
+        latch, abort = Latch(1), Event()
+        Timer(0.05, abort.set).start()
+        started = time.time()
+        self.assertFalse(latch.wait(abort))
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(latch.count, 1)
+
+    def test_wait_times_out(self):
+        latch = Latch(2)
+        latch.count_down()
+        self.assertFalse(latch.wait(timeout=0.05))
+        self.assertEqual(latch.count, 1)
+
+    def test_release_wakes_the_waiter_early(self):
+        latch = Latch(5)
+        Timer(0.05, latch.release).start()
+        self.assertTrue(latch.wait(timeout=5))
+        self.assertEqual(latch.count, 0)
+
+
+class ResultGateTest(unittest.TestCase):
+
+    def test_results_are_dropped_once_closed(self):
+        queue = Queue()
+        gate = ResultGate(queue)
+        self.assertTrue(gate.put(1))
+        gate.close()
+        self.assertFalse(gate.put(2))
+        self.assertEqual(queue.get_nowait(), 1)
+        self.assertTrue(queue.empty())
+        self.assertEqual(gate.dropped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
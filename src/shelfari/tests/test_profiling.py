@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, os, shutil, tempfile, threading, pstats
+
+from calibre_plugins.shelfari.profiling import Profiler
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+def parse_page(n):
+    return sum(range(1000 * n))
+
+
+def download_cover(n):
+    return [parse_page(n) for i in range(3)]
+
+
+class RecordingLog(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def info(self, msg):
+        self.lines.append(msg)
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.profiler = Profiler(os.path.join(self.tdir, 'profiles'))
+        self.profiler.configure(True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def function_calls(self):
+        stats = pstats.Stats(self.profiler.path)
+        return dict((name, calls[0]) for (filename, line, name), calls in
+                stats.stats.items())
+
+    def test_threads_merge_into_one_profile(self):
+        threads = [threading.Thread(target=self.profiler.call,
+            args=('worker', parse_page, n)) for n in range(4)]
+        threads.append(threading.Thread(target=self.profiler.call,
+            args=('download_cover', download_cover, 1)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        log = RecordingLog()
+        self.profiler.report(log)
+        self.assertTrue(os.path.exists(self.profiler.path))
+        calls = self.function_calls()
+        # The nested calls are part of the download_cover profile
+        self.assertEqual(calls['parse_page'], 4 + 3)
+        self.assertEqual(calls['download_cover'], 1)
+        self.assertEqual(self.profiler.calls, {'worker': 4, 'download_cover': 1})
+        self.assertIn('download_cover: 1, worker: 4', log.lines[0])
+
+    def test_disabled_profiler_only_calls_through(self):
+        self.profiler.configure(False)
+        self.assertEqual(self.profiler.call('worker', parse_page, 1), sum(range(1000)))
+        self.profiler.report(RecordingLog())
+        self.assertEqual(self.profiler.stats, None)
+        self.assertFalse(os.path.exists(self.profiler.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
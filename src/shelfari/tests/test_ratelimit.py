@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, socket, time
+from threading import Event
+
+from calibre_plugins.shelfari.ratelimit import RateLimiter, is_backoff_error
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+
+class FakeHTTPError(Exception):
+
+    def __init__(self, code):
+        self.code = code
+
+    def getcode(self):
+        return self.code
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_backoff_halves_the_rate_down_to_the_minimum(self):
+        limiter = RateLimiter(max_rate=8, min_rate=1)
+        limiter.backoff()
+        self.assertEqual(limiter.rate, 4)
+        for i in range(5):
+            # Back offs within one request interval of each other count once
+            limiter._last_backoff = 0.0
+            limiter.backoff()
+        self.assertEqual(limiter.rate, 1)
+        self.assertEqual(limiter.backoffs, 6)
+
+    def test_simultaneous_failures_only_back_off_once(self):
+        limiter = RateLimiter(max_rate=8)
+        limiter.backoff()
+        limiter.backoff()
+        self.assertEqual(limiter.rate, 4)
+
+    def test_success_recovers_up_to_the_maximum(self):
+        limiter = RateLimiter(max_rate=4, increase=1)
+        limiter.backoff()
+        self.assertEqual(limiter.rate, 2)
+        limiter.success()
+        self.assertEqual(limiter.rate, 2.5)
+        for i in range(20):
+            limiter.success()
+        self.assertEqual(limiter.rate, 4)
+
+    def test_fixed_rate_ignores_backoff(self):
+        limiter = RateLimiter(max_rate=8, adaptive=False)
+        limiter.report(FakeHTTPError(503))
+        self.assertEqual(limiter.rate, 8)
+        self.assertEqual(limiter.backoffs, 1)
+
+    def test_only_throttling_errors_back_off(self):
+        self.assertTrue(is_backoff_error(FakeHTTPError(429)))
+        self.assertTrue(is_backoff_error(FakeHTTPError(503)))
+        self.assertTrue(is_backoff_error(socket.timeout()))
+        self.assertFalse(is_backoff_error(FakeHTTPError(404)))
+        limiter = RateLimiter(max_rate=8)
+        limiter.report(FakeHTTPError(404))
+        self.assertEqual(limiter.rate, 8)
+
+    def test_acquire_returns_early_on_abort(self):
+        limiter = RateLimiter(max_rate=1)
+        abort = Event()
+        self.assertTrue(limiter.acquire(abort))
+        limiter.backoff(delay=60)
+        abort.set()
+        started = time.time()
+        self.assertFalse(limiter.acquire(abort))
+        self.assertLess(time.time() - started, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, os
+
+try:
+    from calibre_plugins.shelfari.worker import parse_page_bytes
+    from calibre_plugins.shelfari.search import SearchResultsParser, parse_editions
+except ImportError:
+    # The parsers need calibre and lxml, run these with calibre-debug
+    SearchResultsParser = None
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASE_URL = 'http://www.shelfari.com'
+
+# A search result row and editions page in the markup of the benchmark pages
+NEW_SEARCH_PAGE = b'''<html><body><ol class="book_results">
+<li id="SR12"><div class="text">
+<h3><a href="/books/12/Dune">Dune</a></h3>
+<a href="/authors/a1/Frank-Herbert">Frank Herbert</a>
+<span class="editions"><a href="/books/12/Dune/editions">3 editions</a></span>
+</div></li>
+</ol></body></html>'''
+
+NEW_EDITIONS_PAGE = b'''<html><head><script>
+Shelfari.pageData = { bookId: 12, workId: 77 };
+</script></head><body><ul class="editions">
+<li><a class="title" href="/books/12/Dune">Dune</a><span class="format">Paperback</span></li>
+<li><a class="title" href="/books/13/Dune">Dune</a><span class="format">Audio CD</span></li>
+</ul></body></html>'''
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+@unittest.skipIf(SearchResultsParser is None, 'needs calibre and lxml')
+class EditionsMarkupTest(unittest.TestCase):
+
+    def test_search_page_editions_table(self):
+        parser = SearchResultsParser()
+        parser.feed(fixture('search_tablelist.html'))
+        results = parser.close()
+        self.assertEqual([r.shelfari_id for r in results], ['39845', '2806'])
+        self.assertEqual(results[0].url, '/books/39845/Dune')
+        self.assertEqual(results[0].authors, 'Frank Herbert')
+        # The page wide link belongs to the top result only
+        self.assertEqual(results[0].editions_url, '/work/editions/1001')
+        self.assertEqual(results[0].editions_text, '57 editions')
+        self.assertEqual(results[1].editions_url, None)
+
+    def test_keeps_reading_for_the_editions_table(self):
+        raw = fixture('search_tablelist.html')
+        parser = SearchResultsParser()
+        read = b''
+        for start in range(0, len(raw), 64):
+            read += raw[start:start + 64]
+            if parser.feed(raw[start:start + 64]):
+                break
+        self.assertIn(b'/work/editions/1001', read)
+        self.assertEqual(parser.close()[0].editions_text, '57 editions')
+
+    def test_stops_at_the_list_when_editions_are_not_wanted(self):
+        raw = fixture('search_tablelist.html')
+        parser = SearchResultsParser(editions=False)
+        read = b''
+        for start in range(0, len(raw), 16):
+            read += raw[start:start + 16]
+            if parser.feed(raw[start:start + 16]):
+                break
+        self.assertNotIn(b'/work/editions/1001', read)
+        self.assertNotEqual(parser.PARTIAL_KEY, SearchResultsParser().PARTIAL_KEY)
+        self.assertEqual([r.shelfari_id for r in parser.close()], ['39845', '2806'])
+
+    def test_search_row_editions_link(self):
+        parser = SearchResultsParser()
+        parser.feed(NEW_SEARCH_PAGE)
+        results = parser.close()
+        self.assertEqual(results[0].editions_url, '/books/12/Dune/editions')
+        self.assertEqual(results[0].editions_text, '3 editions')
+
+    def test_edition_data_page(self):
+        raw = fixture('editions_editiondata.html')
+        editions, work_id = parse_editions(parse_page_bytes(raw), raw,
+                BASE_URL + '/work/editions/1001', BASE_URL)
+        self.assertEqual(work_id, '1001')
+        self.assertEqual([e['id'] for e in editions], ['39845', '2011', '5712'])
+        self.assertEqual(editions[1]['title'], 'Dune (Audio CD)')
+        self.assertEqual(editions[0]['url'], BASE_URL + '/books/39845/Dune')
+        self.assertEqual(editions[0]['format'], '')
+
+    def test_editions_list_page(self):
+        editions, work_id = parse_editions(parse_page_bytes(NEW_EDITIONS_PAGE),
+                NEW_EDITIONS_PAGE, BASE_URL + '/books/12/Dune/editions', BASE_URL)
+        self.assertEqual(work_id, '77')
+        self.assertEqual([(e['id'], e['format']) for e in editions],
+                [('12', 'Paperback'), ('13', 'Audio CD')])
+
+
+@unittest.skipIf(SearchResultsParser is None, 'needs calibre and lxml')
+class SearchResultsParserTest(unittest.TestCase):
+
+    PAGE = b'''<html><body>
+<ol class="book_results">
+<li id="SR1"><div class="cover"><a href="/books/1/Cover">cover</a></div>
+<div class="text"><h3><a href="/books/1/Dune">Dune <em>Deluxe</em></a></h3>
+<a href="/authors/a1">Frank Herbert</a>
+<span class="editions"><a href="/books/1/Dune/editions">2 editions</a></span></div></li>
+<li id="SR2"><div class="text"><p>No title here</p></div></li>
+<li id="SR3"><div class="text"><h3><a href="/books/3/Emma">Emma</a></h3></div></li>
+</ol>
+<ol class="book_results"><li id="SR4"><div class="text"><h3><a href="/books/4/Late">Late</a></h3></div></li></ol>
+</body></html>'''
+
+    def test_reads_each_row(self):
+        parser = SearchResultsParser()
+        parser.feed(self.PAGE)
+        results = parser.close()
+        self.assertEqual([(r.shelfari_id, r.title, r.url) for r in results],
+                [('1', 'Dune Deluxe', '/books/1/Dune'), ('3', 'Emma', '/books/3/Emma')])
+        self.assertEqual(results[0].authors, 'Frank Herbert')
+        self.assertEqual(results[1].authors, '')
+        self.assertEqual(results[1].editions_url, None)
+
+    def test_stops_after_the_results_list(self):
+        parser = SearchResultsParser()
+        end = self.PAGE.index(b'</ol>') + len(b'</ol>')
+        fed = 0
+        while not parser.feed(self.PAGE[fed:fed + 16]):
+            fed += 16
+            self.assertLess(fed, len(self.PAGE))
+        self.assertLess(fed, end + 16 * 4)
+        # Anything fed after stopping is ignored
+        self.assertTrue(parser.feed(self.PAGE[fed + 16:]))
+        self.assertEqual([r.shelfari_id for r in parser.close()], ['1', '3'])
+
+    def test_empty_page(self):
+        parser = SearchResultsParser()
+        self.assertFalse(parser.feed(b''))
+        self.assertEqual(parser.close(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
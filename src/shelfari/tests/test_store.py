@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest, os, shutil, tempfile
+
+try:
+    from calibre_plugins.shelfari.store import MetadataStore, IdentifierStore
+except ImportError:
+    # The stores convert records with calibre, run these with calibre-debug
+    MetadataStore = None
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+RECORD = {'title': 'Dune', 'authors': ['Frank Herbert'], 'isbn': '9780441013593',
+        'cover_url': 'http://images.example.com/dune.jpg'}
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def path(self, name):
+        # The stores create the directory they live in themselves
+        return os.path.join(self.tdir, 'cache', name)
+
+
+@unittest.skipIf(MetadataStore is None, 'needs calibre')
+class MetadataStoreTest(StoreTestCase):
+
+    def stored_ids(self, store):
+        with store._lock:
+            return [row[0] for row in store.conn.execute('SELECT shelfari_id FROM books')]
+
+    def test_round_trip(self):
+        MetadataStore(self.path('metadata.db')).put('1', RECORD)
+        self.assertEqual(MetadataStore(self.path('metadata.db')).get('1'), RECORD)
+        self.assertEqual(MetadataStore(self.path('metadata.db')).get('2'), None)
+
+    def test_old_records_expire(self):
+        store = MetadataStore(self.path('metadata.db'), max_age=60)
+        store.put('1', RECORD)
+        store.put('2', RECORD)
+        with store._lock:
+            store.conn.execute('UPDATE books SET stored_at = stored_at - 120 '
+                    'WHERE shelfari_id = ?', ('1',))
+        self.assertEqual(store.get('1'), None)
+        self.assertEqual(store.get('2'), RECORD)
+        store.purge()
+        self.assertEqual(self.stored_ids(store), ['2'])
+
+    def test_records_of_another_schema_version_expire(self):
+        MetadataStore(self.path('metadata.db'), version='1').put('1', RECORD)
+        store = MetadataStore(self.path('metadata.db'), version='2')
+        self.assertEqual(store.get('1'), None)
+        store.put('2', RECORD)
+        store.purge()
+        self.assertEqual(self.stored_ids(store), ['2'])
+
+
+@unittest.skipIf(MetadataStore is None, 'needs calibre')
+class IdentifierStoreTest(StoreTestCase):
+
+    def test_round_trip(self):
+        store = IdentifierStore(self.path('identifiers.db'))
+        editions = [{'id': '39845', 'url': '/books/39845', 'title': 'Dune', 'format': ''},
+                {'id': '2011', 'url': '/books/2011', 'title': 'Dune', 'format': 'Audio CD'}]
+        store.add_isbn('9780441013593', '39845')
+        store.add_cover_url('39845', RECORD['cover_url'])
+        store.add_editions('1001', editions, shelfari_ids=['7'])
+        store.flush()
+        store = IdentifierStore(self.path('identifiers.db'))
+        self.assertEqual(store.isbn_to_identifier('9780441013593'), '39845')
+        self.assertEqual(store.identifier_to_cover_url('39845'), RECORD['cover_url'])
+        self.assertEqual(store.work_to_editions('1001'), editions)
+        self.assertEqual([store.identifier_to_work(i) for i in ('7', '39845', '2011', '3')],
+                ['1001', '1001', '1001', None])
+
+    def test_writes_are_committed_in_batches(self):
+        store = IdentifierStore(self.path('identifiers.db'), batch_size=3)
+        store.add_isbn('1', 'a')
+        store.add_isbn('2', 'b')
+        self.assertEqual(IdentifierStore(self.path('identifiers.db')).isbn_to_identifier('1'),
+                None)
+        # The third write fills the batch
+        store.add_isbn('3', 'c')
+        reader = IdentifierStore(self.path('identifiers.db'))
+        self.assertEqual([reader.isbn_to_identifier(i) for i in '123'], ['a', 'b', 'c'])
+        store.add_isbn('4', 'd')
+        store.flush()
+        self.assertEqual(IdentifierStore(self.path('identifiers.db')).isbn_to_identifier('4'),
+                'd')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+
+# The MIT License (MIT)
+
+# Copyright (c) 2013 Casey Duquette
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""  """
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+import unittest
+
+try:
+    from calibre_plugins.shelfari.worker import (Utf8Sanitizer, StreamingPageParser,
+            parse_page_bytes)
+except ImportError:
+    # The worker needs calibre and lxml, run these with calibre-debug
+    Utf8Sanitizer = None
+
+__author__ = "Casey Duquette"
+__copyright__ = "Copyright 2013"
+__credits__ = ["Grant Drake <grant.drake@gmail.com>"]
+
+__license__ = "MIT"
+__version__ = ""
+__maintainer__ = "Casey Duquette"
+__email__ = ""
+__url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
+
+# e acute split across two chunks, then a stray Latin-1 byte
+VALID = 'caf\xe9 na\xefve'.encode('utf-8')
+INVALID = b'caf\xc3\xa9 \xff na\xc3\xafve'
+
+
+def feed_in_chunks(sanitizer, raw, size):
+    out = [sanitizer.feed(raw[i:i + size]) for i in range(0, len(raw), size)]
+    return b''.join(out) + sanitizer.feed(b'', final=True)
+
+
+@unittest.skipIf(Utf8Sanitizer is None, 'needs calibre and lxml')
+class Utf8SanitizerTest(unittest.TestCase):
+
+    def test_valid_bytes_pass_through(self):
+        for size in (1, 2, 4, len(VALID)):
+            sanitizer = Utf8Sanitizer()
+            self.assertEqual(feed_in_chunks(sanitizer, VALID, size), VALID)
+            self.assertFalse(sanitizer.repaired)
+
+    def test_invalid_bytes_are_replaced(self):
+        expected = 'caf\xe9 \ufffd na\xefve'.encode('utf-8')
+        for size in (1, 3, 4, len(INVALID)):
+            sanitizer = Utf8Sanitizer()
+            self.assertEqual(feed_in_chunks(sanitizer, INVALID, size), expected)
+            self.assertTrue(sanitizer.repaired)
+
+    def test_truncated_character_is_replaced_at_the_end(self):
+        sanitizer = Utf8Sanitizer()
+        self.assertEqual(sanitizer.feed(b'caf\xc3'), b'caf')
+        self.assertEqual(sanitizer.feed(b'', final=True), '\ufffd'.encode('utf-8'))
+
+    def test_pages_keep_their_text_around_a_bad_byte(self):
+        page = b'<html><body><p>' + INVALID + b' \xc3\xbcber</p></body></html>'
+        expected = 'caf\xe9 \ufffd na\xefve \xfcber'
+        self.assertEqual(parse_page_bytes(page).xpath('//p')[0].text, expected)
+        parser = StreamingPageParser()
+        for i in range(0, len(page), 5):
+            parser.feed(page[i:i + 5])
+        self.assertEqual(parser.close().xpath('//p')[0].text, expected)
+
+
+
+BOOK_PAGE = b'''<html><head><title>Dune by Frank Herbert | Shelfari</title></head><body>
+<div id="header"><a href="/">Shelfari</a></div>
+<div id="content">
+<h1 class="hover_title">Dune</h1>
+<div id="WikiModule_Contributors"><ol><li><a href="/authors/1">Frank Herbert</a></li></ol></div>
+<div id="metacol"><div id="details">Publisher: Ace</div></div>
+<div id="reviews">%s</div>
+</div>
+<div id="footer">About</div>
+</body></html>''' % (b'<p>A review</p>' * 200)
+
+
+@unittest.skipIf(Utf8Sanitizer is None, 'needs calibre and lxml')
+class StreamingPageParserTest(unittest.TestCase):
+
+    def feed_until_done(self, page, size=64):
+        parser = StreamingPageParser()
+        for start in range(0, len(page), size):
+            if parser.feed(page[start:start + size]):
+                return parser, start + size
+        return parser, None
+
+    def test_stops_where_the_reviews_start(self):
+        # The page has no rating, series or isbn, which used to mean reading
+        # it to the end
+        parser, read = self.feed_until_done(BOOK_PAGE)
+        self.assertNotEqual(read, None)
+        self.assertLess(read, BOOK_PAGE.index(b'<div id="reviews">') + 64 * 4)
+        root = parser.close()
+        self.assertEqual(root.xpath('//div[@id="details"]')[0].text, 'Publisher: Ace')
+
+    def test_stops_at_the_end_of_the_main_content(self):
+        page = BOOK_PAGE.replace(b'reviews', b'comments').replace(b'footer', b'bottom')
+        read = self.feed_until_done(page)[1]
+        self.assertNotEqual(read, None)
+        self.assertLess(read, page.index(b'<div id="bottom">') + 64 * 4)
+        self.assertGreater(read, page.index(b'<div id="bottom">'))
+
+    def test_page_without_its_required_containers_is_read_to_the_end(self):
+        page = BOOK_PAGE.replace(b'WikiModule_Contributors', b'Other')
+        self.assertEqual(self.feed_until_done(page)[1], None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,18 +32,18 @@ from __future__ import (unicode_literals, division, absolute_import,
 import sys, os
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibre', 'src'))
 
-import socket, re, datetime
+import socket, re, datetime, time, codecs
 from collections import OrderedDict
-from threading import Thread
 
-from lxml.html import fromstring, tostring
+from lxml import etree
+from lxml.html import fromstring, tostring, HTMLParser, HtmlElementClassLookup
 
 from calibre.ebooks.metadata.book.base import Metadata
-from calibre.library.comments import sanitize_comments_html
-from calibre.utils.cleantext import clean_ascii_chars
 from calibre.utils.localization import canonicalize_lang
 
-import calibre_plugins.shelfari.config as cfg
+import calibre_plugins.shelfari.prefs as cfg
+from calibre_plugins.shelfari.store import record_from_metadata
+from calibre_plugins.shelfari.cache import normalize_url
 
 __author__ = "Casey Duquette"
 __copyright__ = "Copyright 2013"
@@ -56,70 +56,368 @@ __email__ = ""
 __url__ = "https://github.com/beeftornado/calibre-shelfari-metadata"
 
 
-class Worker(Thread): # Get details
+# Everything used to pull fields out of a book page is compiled once here
+# rather than on every book
+# The nodes of a book page that every field lives under, found together in a
+# single pass over the document: (tag, attribute, value) -> container name,
+# where a tag of None matches any element
+CONTAINERS = {
+    ('title', None, None): 'page title',
+    (None, 'id', 'errorMessage'): 'error message',
+    ('h1', 'class', 'hover_title'): 'title',
+    ('span', 'class', 'series'): 'series',
+    ('div', 'id', 'WikiModule_Contributors'): 'contributors',
+    ('ul', 'class', 'rating'): 'rating',
+    ('div', 'class', 'ugc nonTruncatedSum'): 'description',
+    ('div', 'id', 'BookMasterImage'): 'master image',
+    ('acronym', 'title', 'International Standard Book Number'): 'isbn',
+    ('div', 'id', 'WikiModule_FirstEdition'): 'first edition',
+    ('div', 'class', 'stacked'): 'genres',
+    ('div', 'id', 'metacol'): 'metacol',
+}
+XPATH_CONTAINERS = etree.XPath('//*[self::title or @id="errorMessage" or @id="WikiModule_Contributors" '
+                               'or @id="BookMasterImage" or @id="WikiModule_FirstEdition" or @id="metacol" '
+                               'or @class="hover_title" or @class="series" or @class="rating" '
+                               'or @class="ugc nonTruncatedSum" or @class="stacked" '
+                               'or @title="International Standard Book Number"]')
+
+# The containers a book page is no use without. Once they have been read,
+# streaming stops at a landmark closing off the book's details: the start of
+# one of the sections after them, or the end of the page's main content, the
+# element directly under <body> holding STREAM_MAIN. The optional containers
+# (series, rating, isbn...) come before either, so a page without one of them
+# is not read to the end
+STREAM_UNTIL = frozenset(('page title', 'title', 'contributors'))
+STREAM_MAIN = 'title'
+# The ids of the divs following the details: reviews, shelves and footer
+STREAM_AFTER = frozenset(('reviews', 'shelves', 'footer'))
+
+# The control characters calibre's clean_ascii_chars removes: everything
+# below space except tab, newline and carriage return, and DEL. None of these
+# bytes can occur inside a multi-byte UTF-8 sequence, so they are stripped
+# from the raw page before lxml decodes it
+CONTROL_BYTES = bytes(bytearray([c for c in range(32) if c not in (9, 10, 13)] + [127]))
+
+
+class Utf8Sanitizer(object):
 
     '''
-    Get book details from Shelfari book page in a separate thread
+    Passes the bytes of a page on unchanged while they are valid UTF-8. From
+    the first invalid byte on the rest is decoded with errors='replace' and
+    encoded again, so a bad byte becomes U+FFFD as it did when pages were
+    decoded before parsing. Some libxml2 builds would otherwise switch the
+    rest of the page to Latin-1 when they meet it.
+
+    Checking a chunk decodes it and throws the text away, which is cheap
+    next to parsing it. A multi-byte character split across two chunks is
+    held back until it is complete.
     '''
 
-    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20):
-        Thread.__init__(self)
-        self.daemon = True
+    def __init__(self):
+        self._strict = codecs.getincrementaldecoder('utf-8')()
+        self._replace = None
+        self._held = b''
+
+    @property
+    def repaired(self):
+        return self._replace is not None
+
+    def feed(self, chunk, final=False):
+        '''
+        Returns the valid UTF-8 bytes for chunk. Pass final=True with the
+        last chunk, or an empty one, to flush any incomplete character.
+        '''
+        data = self._held + chunk
+        if self._replace is None:
+            try:
+                self._strict.decode(chunk, final)
+            except UnicodeDecodeError:
+                self._replace = codecs.getincrementaldecoder('utf-8')('replace')
+            else:
+                self._held = self._strict.getstate()[0]
+                return data[:len(data) - len(self._held)]
+        self._held = b''
+        return self._replace.decode(data, final).encode('utf-8')
+
+# Field lookups, relative to their container
+XPATH_AUTHORS = etree.XPath('.//ol/li')
+XPATH_RATING = etree.XPath('./li[@class="current"]')
+XPATH_COMMENTS = etree.XPath('./p')
+XPATH_COVER = etree.XPath('.//img/@src')
+XPATH_FIRST_EDITION = etree.XPath('.//div')
+XPATH_GENRES = etree.XPath('./div/div/div[contains(@class, "bigBoxContent")]/div/div[@class="left"]')
+XPATH_GENRE_LINKS = etree.XPath('a')
+XPATH_LANGUAGE = etree.XPath('./div[@id="details"]/div[@class="buttons"]/div[@id="bookDataBox"]/div/div[@itemprop="inLanguage"]')
+
+ERR_INVALID_ENCODING = etree.ErrorTypes.ERR_INVALID_ENCODING
+
+RE_SHELFARI_ID = re.compile('/books/(\d+)')
+RE_TITLE_YEAR = re.compile('\((\d{4})\)$')
+RE_SERIES_BOOK = re.compile(': Book (\d+)')
+RE_CONTRIBUTION = re.compile('\s*\([\w\s]*\)')
+RE_NON_DIGITS = re.compile('[^0-9]')
+RE_PUBLISHER = re.compile('Publisher: ([\w\s]+)')
+RE_LEADING_DIGITS = re.compile('([0-9]+)')
+
+LANGUAGE_MAP = {}
+for code, names in {
+        'eng': ('English', 'Englisch'),
+        'fra': ('French', 'Français'),
+        'ita': ('Italian', 'Italiano'),
+        'dut': ('Dutch',),
+        'deu': ('German', 'Deutsch'),
+        'spa': ('Spanish', 'Espa\xf1ol', 'Espaniol'),
+        'jpn': ('Japanese', u'日本語'),
+        'por': ('Portuguese', 'Português'),
+        }.iteritems():
+    for name in names:
+        LANGUAGE_MAP[name] = code
+del code, names
+
+MONTHS = {"January":1, "February":2, "March":3, "April":4, "May":5, "June":6,
+    "July":7, "August":8, "September":9, "October":10, "November":11, "December":12}
+
+# The optional fields of a book page, in the order they are parsed. Each entry
+# is (name used in errors and timings, Worker method, Metadata attributes the
+# parsed value is assigned to). Empty values are left unset on the Metadata.
+FIELD_EXTRACTORS = (
+    ('ISBN', 'parse_isbn', ('isbn',)),
+    ('ratings', 'parse_rating', ('rating',)),
+    ('comments', 'parse_comments', ('comments',)),
+    ('cover', 'parse_cover', ()),
+    ('tags', 'parse_tags', ('tags',)),
+    ('publisher and date', 'parse_publisher_and_date', ('publisher', 'pubdate')),
+    ('language', '_parse_language', ('language',)),
+)
+
+
+def container_name(node):
+    '''
+    The name of the container node is, or None if no field lives under it
+    '''
+    tag = node.tag
+    for attr, value in ((None, None), ('id', node.get('id')),
+            ('class', node.get('class')), ('title', node.get('title'))):
+        name = CONTAINERS.get((tag, attr, value)) or CONTAINERS.get((None, attr, value))
+        if name is not None:
+            return name
+
+
+class PageContainers(object):
+
+    '''
+    The container nodes of a book page, located with one scan of the document
+    so that each field extractor only has to search its own subtree
+    '''
+
+    def __init__(self, root):
+        self.nodes = {}
+        for node in XPATH_CONTAINERS(root):
+            self.nodes.setdefault(container_name(node), []).append(node)
+
+    def all(self, name):
+        return self.nodes.get(name, [])
+
+    def select(self, name, xpath):
+        '''
+        Run a compiled relative xpath against every container called name
+        '''
+        results = []
+        for node in self.nodes.get(name, ()):
+            results.extend(xpath(node))
+        return results
+
+
+def parse_page_bytes(raw):
+    '''
+    Parse a whole page straight from the downloaded UTF-8 bytes. Removing the
+    control characters is one C level pass making one copy, and lxml does
+    the decoding while it parses. Only if lxml reports invalid UTF-8 is the
+    page decoded with errors='replace' and parsed again.
+    '''
+    raw = raw.translate(None, CONTROL_BYTES)
+    parser = HTMLParser(encoding='utf-8')
+    root = fromstring(raw, parser=parser)
+    if any(e.type == ERR_INVALID_ENCODING for e in parser.error_log):
+        root = fromstring(Utf8Sanitizer().feed(raw, final=True),
+                parser=HTMLParser(encoding='utf-8'))
+    return root
+
+
+class StreamingPageParser(object):
+
+    '''
+    Parses a book page incrementally as it is downloaded. feed() returns True
+    once every container in STREAM_UNTIL has been closed and a landmark after
+    the book's details reached, so the download can stop without reading the
+    rest of the page.
+    '''
+
+    # Names the truncated pages this parser stops at, so the response cache
+    # keeps them apart from full pages and from any other STREAM_UNTIL
+    PARTIAL_KEY = 'book:%s:main:%s:after:%s' % (','.join(sorted(STREAM_UNTIL)),
+            STREAM_MAIN, ','.join(sorted(STREAM_AFTER)))
+
+    def __init__(self):
+        # lxml decodes the chunks itself, keeping multi-byte characters
+        # split across two chunks intact
+        self._parser = etree.HTMLPullParser(events=('start', 'end'), encoding='utf-8',
+                tag=('title', 'div', 'h1', 'span', 'ul', 'acronym'))
+        self._parser.set_element_class_lookup(HtmlElementClassLookup())
+        self._utf8 = Utf8Sanitizer()
+        self.missing = set(STREAM_UNTIL)
+        self._main, self._landmark = None, False
+        # Seconds spent in each step of parsing, over all the chunks
+        self.timings = OrderedDict((name, 0.0) for name in
+                ('clean_ascii_chars', 'fromstring'))
+
+    def feed(self, chunk):
+        t0 = time.time()
+        chunk = self._utf8.feed(chunk).translate(None, CONTROL_BYTES)
+        t1 = time.time()
+        self._parser.feed(chunk)
+        t2 = time.time()
+        self.timings['clean_ascii_chars'] += t1 - t0
+        self.timings['fromstring'] += t2 - t1
+        for event, node in self._parser.read_events():
+            if event == 'start':
+                if node.tag == 'div' and node.get('id') in STREAM_AFTER:
+                    self._landmark = True
+                continue
+            if node is self._main:
+                self._landmark = True
+                continue
+            name = container_name(node)
+            if name is not None:
+                self.missing.discard(name)
+                if name == STREAM_MAIN and self._main is None:
+                    self._main = self._body_child(node)
+        return self._landmark and not self.missing
+
+    def _body_child(self, node):
+        # The ancestor of node directly under <body>. Without one, or if it is
+        # not one of the tags the parser reports, the page is read to the end
+        parent = node.getparent()
+        while parent is not None and parent.tag != 'body':
+            node, parent = parent, parent.getparent()
+        return node if parent is not None else None
+
+    def close(self):
+        start = time.time()
+        tail = self._utf8.feed(b'', final=True)
+        if tail:
+            self._parser.feed(tail)
+        root = self._parser.close()
+        self.timings['fromstring'] += time.time() - start
+        return root
+
+
+class Worker(object): # Get details
+
+    '''
+    Get book details from Shelfari book page, run as a task on the plugin's
+    shared WorkerPool
+    '''
+
+    def __init__(self, url, result_queue, log, relevance, plugin, timeout=20, prefs=None,
+            abort=None):
         self.url, self.result_queue = url, result_queue
+        self.abort = abort
         self.log, self.timeout = log, timeout
         self.relevance, self.plugin = relevance, plugin
-        self.browser = browser.clone_browser()
+        # The preferences as they were when the lookup started
+        self.prefs = prefs or cfg.prefs_snapshot()
         self.cover_url = self.shelfari_id = self.isbn = None
-
-        lm = {
-                'eng': ('English', 'Englisch'),
-                'fra': ('French', 'Français'),
-                'ita': ('Italian', 'Italiano'),
-                'dut': ('Dutch',),
-                'deu': ('German', 'Deutsch'),
-                'spa': ('Spanish', 'Espa\xf1ol', 'Espaniol'),
-                'jpn': ('Japanese', u'日本語'),
-                'por': ('Portuguese', 'Português'),
-                }
-        self.lang_map = {}
-        for code, names in lm.iteritems():
-            for name in names:
-                self.lang_map[name] = code
+        self.lang_map = LANGUAGE_MAP
+        # Seconds spent on each field of the book page, by extractor name
+        self.timings = OrderedDict()
+        # (raw, location, error) when the page was downloaded by the fetch engine
+        self.fetched = None
+        # The Metadata put on result_queue, once the page has been parsed
+        self.mi = None
 
     def run(self):
+        self.plugin.profiler.call('Worker.run', self._run_once, self.get_details)
+
+    def run_fetched(self):
+        self.plugin.profiler.call('Worker.run', self._run_once, self.parse_fetched)
+
+    def _run_once(self, fn):
+        '''
+        Call fn, unless a Worker for the same page is already running, in
+        which case wait for it and share its result instead
+        '''
         try:
-            self.get_details()
+            leader, shared = self.plugin.single_flight.do(('details', normalize_url(self.url)),
+                    self._run_leader, fn)
+            if shared:
+                self.share(leader)
         except:
             self.log.exception('get_details failed for url: %r'%self.url)
 
+    def _run_leader(self, fn):
+        fn()
+        return self
+
+    def share(self, other):
+        '''
+        Queue a copy of the result another Worker parsed from the same page
+        '''
+        self.cover_url, self.shelfari_id, self.isbn = other.cover_url, other.shelfari_id, other.isbn
+        if other.mi is not None:
+            mi = other.mi.deepcopy()
+            mi.source_relevance = self.relevance
+            self.mi = mi
+            self.result_queue.put(mi)
+
+    def parse_fetched(self):
+        '''
+        Parse the page the fetch engine already downloaded into self.fetched
+        '''
+        raw, location, error = self.fetched
+        if error is not None:
+            # Raise it here so the failure is logged with its traceback
+            # just like a failed download in get_details
+            try:
+                raise error
+            except Exception as e:
+                return self._fetch_failed(e)
+        parser = StreamingPageParser()
+        parser.feed(raw)
+        self.parse_page(parser)
+
     def get_details(self):
+        parser = StreamingPageParser()
         try:
             self.log.info('Shelfari book url: %r'%self.url)
-            raw = self.browser.open_novisit(self.url, timeout=self.timeout).read().strip()
+            with self.plugin.metrics.span('detail.fetch'):
+                self.plugin.fetch_url(self.log, self.url, self.timeout,
+                        consumer=parser.feed, partial_key=parser.PARTIAL_KEY,
+                        abort=self.abort)
         except Exception as e:
-            if callable(getattr(e, 'getcode', None)) and \
-                    e.getcode() == 404:
-                self.log.error('URL malformed: %r'%self.url)
-                return
-            attr = getattr(e, 'args', [None])
-            attr = attr if attr else [None]
-            if isinstance(attr[0], socket.timeout):
-                msg = 'Shelfari timed out. Try again later.'
-                self.log.error(msg)
-            else:
-                msg = 'Failed to make details query: %r'%self.url
-                self.log.exception(msg)
-            return
+            return self._fetch_failed(e)
+        self.parse_page(parser)
 
-        raw = raw.decode('utf-8', errors='replace')
-        #open('c:\\shelfari.html', 'wb').write(raw)
-
-        if '<title>404 - ' in raw:
+    def _fetch_failed(self, e):
+        if callable(getattr(e, 'getcode', None)) and \
+                e.getcode() == 404:
             self.log.error('URL malformed: %r'%self.url)
             return
+        attr = getattr(e, 'args', [None])
+        attr = attr if attr else [None]
+        if isinstance(attr[0], socket.timeout):
+            msg = 'Shelfari timed out. Try again later.'
+            self.log.error(msg)
+        else:
+            msg = 'Failed to make details query: %r'%self.url
+            self.log.exception(msg)
 
+    def parse_page(self, parser):
+        metrics = self.plugin.metrics
         try:
-            root = fromstring(clean_ascii_chars(raw))
+            root = parser.close()
+            metrics.record_all('detail.', parser.timings)
+            containers = PageContainers(root)
         except:
             msg = 'Failed to parse shelfari details page: %r'%self.url
             self.log.exception(msg)
@@ -129,41 +427,56 @@ class Worker(Thread): # Get details
             # Look at the <title> attribute for page to make sure that we were actually returned
             # a details page for a book. If the user had specified an invalid ISBN, then the results
             # page will just do a textual search.
-            title_node = root.xpath('//title')
+            title_node = containers.all('page title')
             if title_node:
                 page_title = title_node[0].text_content().strip()
                 if page_title is None:
                     self.log.error('Failed to see search results in page title: %r'%self.url)
                     return
+                if page_title.startswith('404 - '):
+                    self.log.error('URL malformed: %r'%self.url)
+                    return
         except:
             msg = 'Failed to read shelfari page title: %r'%self.url
             self.log.exception(msg)
             return
 
-        errmsg = root.xpath('//*[@id="errorMessage"]')
+        errmsg = containers.all('error message')
         if errmsg:
             msg = 'Failed to parse shelfari details page: %r'%self.url
-            msg += tostring(errmsg, method='text', encoding=unicode).strip()
+            msg += tostring(errmsg[0], method='text', encoding=unicode).strip()
             self.log.error(msg)
             return
 
-        self.parse_details(root)
+        self.parse_details(root, containers)
+        metrics.record_all('detail.extract.', self.timings)
 
-    def parse_details(self, root):
+    def _timed(self, name, fn, *args):
+        start = time.time()
         try:
-            shelfari_id = self.parse_shelfari_id(self.url)
+            return fn(*args)
+        finally:
+            self.timings[name] = time.time() - start
+
+    def parse_details(self, root, containers=None):
+        if containers is None:
+            containers = self._timed('containers', PageContainers, root)
+
+        try:
+            shelfari_id = self._timed('shelfari id', self.parse_shelfari_id, self.url)
         except:
             self.log.exception('Error parsing shelfari id for url: %r'%self.url)
             shelfari_id = None
 
         try:
-            (title, series, series_index) = self.parse_title_series(root)
+            (title, series, series_index) = self._timed('title and series',
+                    self.parse_title_series, containers)
         except:
             self.log.exception('Error parsing title and series for url: %r'%self.url)
             title = series = series_index = None
 
         try:
-            authors = self.parse_authors(root)
+            authors = self._timed('authors', self.parse_authors, containers)
         except:
             self.log.exception('Error parsing authors for url: %r'%self.url)
             authors = []
@@ -181,147 +494,138 @@ class Worker(Thread): # Get details
         mi.set_identifier('shelfari', shelfari_id)
         self.shelfari_id = shelfari_id
 
-        try:
-            isbn = self.parse_isbn(root)
-            if isbn:
-                self.isbn = mi.isbn = isbn
-        except:
-            self.log.exception('Error parsing ISBN for url: %r'%self.url)
-
-        try:
-            mi.rating = self.parse_rating(root)
-        except:
-            self.log.exception('Error parsing ratings for url: %r'%self.url)
-
-        try:
-            mi.comments = self.parse_comments(root)
-        except:
-            self.log.exception('Error parsing comments for url: %r'%self.url)
-
-        try:
-            self.cover_url = self.parse_cover(root)
-        except:
-            self.log.exception('Error parsing cover for url: %r'%self.url)
+        values = {}
+        for name, method, attrs in FIELD_EXTRACTORS:
+            try:
+                value = self._timed(name, getattr(self, method), containers)
+            except:
+                self.log.exception('Error parsing %s for url: %r'%(name, self.url))
+                continue
+            values[name] = value
+            if len(attrs) == 1:
+                value = (value,)
+            for attr, v in zip(attrs, value or ()):
+                if v:
+                    setattr(mi, attr, v)
+
+        self.isbn = values.get('ISBN') or None
+        self.cover_url = values.get('cover')
         mi.has_cover = bool(self.cover_url)
 
-        try:
-            tags = self.parse_tags(root)
-            if tags:
-                mi.tags = tags
-        except:
-            self.log.exception('Error parsing tags for url: %r'%self.url)
-
-        try:
-            mi.publisher, mi.pubdate = self.parse_publisher_and_date(root)
-        except:
-            self.log.exception('Error parsing publisher and date for url: %r'%self.url)
-
-        try:
-            lang = self._parse_language(root)
-            if lang:
-                mi.language = lang
-        except:
-            self.log.exception('Error parsing language for url: %r'%self.url)
-
         mi.source_relevance = self.relevance
 
-        if self.shelfari_id:
-            if self.isbn:
-                self.plugin.cache_isbn_to_identifier(self.isbn, self.shelfari_id)
-            if self.cover_url:
-                self.plugin.cache_identifier_to_cover_url(self.shelfari_id,
-                        self.cover_url)
+        store = self.plugin.metadata_store
+        record = None
+        if store is not None and self.shelfari_id:
+            record = record_from_metadata(mi, self.cover_url)
 
         self.plugin.clean_downloaded_metadata(mi)
 
+        self.mi = mi
         self.result_queue.put(mi)
 
+        # The result is already out, a failure to remember it (a locked or
+        # full database) must not lose it
+        try:
+            if self.shelfari_id:
+                if self.isbn:
+                    self.plugin.cache_isbn_to_identifier(self.isbn, self.shelfari_id)
+                if self.cover_url:
+                    self.plugin.cache_identifier_to_cover_url(self.shelfari_id,
+                            self.cover_url)
+            if record is not None:
+                store.put(self.shelfari_id, record)
+        except:
+            self.log.exception('Failed to cache the details of: %r'%self.url)
+
     def parse_shelfari_id(self, url):
-        return re.search('/books/(\d+)', url).groups(0)[0]
+        return RE_SHELFARI_ID.search(url).groups(0)[0]
 
-    def parse_title_series(self, root):
+    def parse_title_series(self, containers):
         # Default values
         title_text, series_text, book_year, book_number = (None,)*4
         
         # Get the title from the source
-        title_node = root.xpath('//h1[@class="hover_title"]')
+        title_node = containers.all('title')
         if not title_node:
             return (None, None, None)
         title_text = title_node[0].text_content().strip()
         
         # The book title may have a year in it, we can split that out
-        match = re.search('\((\d{4})\)$', title_text)
+        match = RE_TITLE_YEAR.search(title_text)
         if match:
             book_year = match.groups(0)
-            title_text = re.sub('\((\d{4})\)$', '', title_text).strip()
+            title_text = title_text[:match.start()].strip()
             
         # Find the series if the book is a part of one
-        series_node = root.xpath('//span[@class="series"]')
+        series_node = containers.all('series')
         if not series_node:
             return (title_text, None, None)
         series_text = series_node[0].text_content().strip()
         
         # Series text may or may not have a book number, let's see if it's there
-        match = re.search(': Book (\d+)', series_text)
+        match = RE_SERIES_BOOK.search(series_text)
         if match:
             book_number = match.groups(0)
-            series_text = re.sub(': Book (\d+)', '', series_text).strip()
+            series_text = RE_SERIES_BOOK.sub('', series_text).strip()
         
         return (title_text, series_text, book_number)
 
-    def parse_authors(self, root):
+    def parse_authors(self, containers):
         # Build a dict of authors with their contribution if any in values
-        div_authors = root.xpath('//div[@id="WikiModule_Contributors"]//ol/li')
+        div_authors = containers.select('contributors', XPATH_AUTHORS)
         if not div_authors:
             return
         authors = []
         for li in div_authors:
             li_text = li.text_content()
-            author = re.sub('\s*\([\w\s]*\)', '', li_text).strip()
+            author = RE_CONTRIBUTION.sub('', li_text).strip()
             authors.append(author)
         return authors
 
-    def parse_rating(self, root):
-        rating_node = root.xpath('//ul[@class=rating]/li[@class="current"]')
+    def parse_rating(self, containers):
+        rating_node = containers.select('rating', XPATH_RATING)
         if rating_node:
             rating_text = rating_node[0].text_content()
-            rating_text = re.sub('[^0-9]', '', rating_text)
+            rating_text = RE_NON_DIGITS.sub('', rating_text)
             rating_value = float(rating_text)
             if rating_value >= 100:
                 return rating_value / 100
             return rating_value
 
-    def parse_comments(self, root):
-        description_node = root.xpath('//div[@class="ugc nonTruncatedSum"]/p')
+    def parse_comments(self, containers):
+        description_node = containers.select('description', XPATH_COMMENTS)
         if description_node:
             desc = description_node[0]
+            # Pulls in BeautifulSoup, so it is left out of the plugin's load
+            from calibre.library.comments import sanitize_comments_html
             comments = tostring(desc, method='html', encoding=unicode).strip()
             while comments.find('  ') >= 0:
                 comments = comments.replace('  ',' ')
             comments = sanitize_comments_html(comments)
             return comments
 
-    def parse_cover(self, root):
-        imgcol_node = root.xpath('//div[@id="BookMasterImage"]//img/@src')
+    def parse_cover(self, containers):
+        imgcol_node = containers.select('master image', XPATH_COVER)
         if imgcol_node:
             img_url = imgcol_node[0]
             return img_url
 
-    def parse_isbn(self, root):
-        isbn_node = root.xpath('//acronym[@title="International Standard Book Number"]')
+    def parse_isbn(self, containers):
+        isbn_node = containers.all('isbn')
         if isbn_node:
             isbn_text = isbn_node[0].text_content()
-            isbn_text = re.sub('[^0-9]', '', isbn_text).strip()
+            isbn_text = RE_NON_DIGITS.sub('', isbn_text).strip()
             return isbn_text
 
-    def parse_publisher_and_date(self, root):
+    def parse_publisher_and_date(self, containers):
         publisher = None
         pub_date = None
-        edition_node = root.xpath('//div[@id="WikiModule_FirstEdition"]//div')
+        edition_node = containers.select('first edition', XPATH_FIRST_EDITION)
         if edition_node:
             for div in edition_node:
                 if 'Publisher' in div.text_content():
-                    match = re.search('Publisher: ([\w\s]+)', div).strip()
+                    match = RE_PUBLISHER.search(div).strip()
                     if match:
                         publisher = match.groups(0).strip()
             
@@ -329,17 +633,17 @@ class Worker(Thread): # Get details
                     pub_date = self._convert_date_text(pubdate_text)
         return (publisher, pub_date)
 
-    def parse_tags(self, root):
+    def parse_tags(self, containers):
         return None
         # Shelfari does not have "tags", but it does have Genres (wrapper around popular shelves)
         # We will use those as tags (with a bit of massaging)
-        genres_node = root.xpath('//div[@class="stacked"]/div/div/div[contains(@class, "bigBoxContent")]/div/div[@class="left"]')
+        genres_node = containers.select('genres', XPATH_GENRES)
         #self.log.info("Parsing tags")
         if genres_node:
             #self.log.info("Found genres_node")
             genre_tags = list()
             for genre_node in genres_node:
-                sub_genre_nodes = genre_node.xpath('a')
+                sub_genre_nodes = XPATH_GENRE_LINKS(genre_node)
                 genre_tags_list = [sgn.text_content().strip() for sgn in sub_genre_nodes]
                 #self.log.info("Found genres_tags list:", genre_tags_list)
                 if genre_tags_list:
@@ -349,17 +653,8 @@ class Worker(Thread): # Get details
                 return calibre_tags
 
     def _convert_genres_to_calibre_tags(self, genre_tags):
-        # for each tag, add if we have a dictionary lookup
-        calibre_tag_lookup = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GENRE_MAPPINGS]
-        calibre_tag_map = dict((k.lower(),v) for (k,v) in calibre_tag_lookup.iteritems())
-        tags_to_add = list()
-        for genre_tag in genre_tags:
-            tags = calibre_tag_map.get(genre_tag.lower(), None)
-            if tags:
-                for tag in tags:
-                    if tag not in tags_to_add:
-                        tags_to_add.append(tag)
-        return list(tags_to_add)
+        # for each tag, add if we have a mapping for it
+        return self.prefs.genre_mapper.tags_for(genre_tags)
 
     def _convert_date_text(self, date_text):
         # Note that the date text could be "2003", "December 2003" or "December 10th 2003"
@@ -372,16 +667,14 @@ class Worker(Thread): # Get details
             # Need to convert the month name into a numeric value
             # For now I am "assuming" the Shelfari website only displays in English
             # If it doesn't will just fallback to assuming January
-            month_dict = {"January":1, "February":2, "March":3, "April":4, "May":5, "June":6,
-                "July":7, "August":8, "September":9, "October":10, "November":11, "December":12}
-            month = month_dict.get(month_name, 1)
+            month = MONTHS.get(month_name, 1)
             if len(text_parts[2]) > 0:
-                day = int(re.match('([0-9]+)', text_parts[2]).groups(0)[0])
+                day = int(RE_LEADING_DIGITS.match(text_parts[2]).groups(0)[0])
         from calibre.utils.date import utc_tz
         return datetime.datetime(year, month, day, tzinfo=utc_tz)
 
-    def _parse_language(self, root):
-        lang_node = root.xpath('//div[@id="metacol"]/div[@id="details"]/div[@class="buttons"]/div[@id="bookDataBox"]/div/div[@itemprop="inLanguage"]')
+    def _parse_language(self, containers):
+        lang_node = containers.select('metacol', XPATH_LANGUAGE)
         if lang_node:
             raw = tostring(lang_node[0], method='text', encoding=unicode).strip()
             ans = self.lang_map.get(raw, None)